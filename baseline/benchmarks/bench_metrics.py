@@ -0,0 +1,218 @@
+"""
+Equivalence and speed of the batched baseline metrics and collate against the
+previous per-sample implementations.
+
+- metrics:     state_change_accuracy / keyframe_distance (previous python loops)
+               versus state_change_stats / keyframe_distance_stats
+- collate:     previous c_fn versus datasets.loader.collate_batch, in the main
+               process and in DataLoader workers (where collate_batch stacks
+               frames into shared memory directly)
+- all-reduce:  metric stats of random shards summed over gloo processes with
+               all_reduce_stats match the stats of the whole set
+
+Usage (from baseline/):
+
+    python -m benchmarks.bench_metrics --batch_size 64 --world_size 2
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from datasets.loader import collate_batch
+from evaluation.metrics import (
+    state_change_stats,
+    keyframe_distance_stats,
+    all_reduce_stats,
+    stats_to_metric,
+    clip_frames,
+)
+
+
+def previous_state_change_accuracy(preds, labels):
+    correct = 0
+    total = 0
+    for pred, label in zip(preds, labels):
+        pred_ = torch.argmax(pred)
+        if pred_.item() == label.item():
+            correct += 1
+        total += 1
+    accuracy = correct/total
+    return accuracy
+
+
+def previous_keyframe_distance(preds, labels, sc_preds, sc_labels, fps, info):
+    distance_list = list()
+    for pred, label, sc_pred, sc_label, ind_info, ind_fps in zip(
+        preds, labels, sc_preds, sc_labels, info, fps
+    ):
+        if sc_label.item() == 1:
+            keyframe_loc_pred = torch.argmax(pred).item()
+            keyframe_loc_pred_mapped = (
+                ind_info['clip_end_frame'] - ind_info['clip_start_frame']
+            ) / 16 * keyframe_loc_pred
+            gt = ind_info['pnr_frame'] - ind_info['clip_start_frame']
+            err_frame = abs(keyframe_loc_pred_mapped - gt)
+            err_sec = err_frame/ind_fps
+            distance_list.append(err_sec)
+    if len(distance_list) == 0:
+        return np.mean(0.0)
+    return np.mean(distance_list)
+
+
+def previous_c_fn(batch_lst):
+    frames = []
+    label = []
+    state = []
+    fps = []
+    info = []
+    for batch in batch_lst:
+        _frames, _label, _state, _fps, _info = batch
+        fps.append(_fps)
+        info.append(_info)
+        frames.extend(_frames)
+        label.append(torch.from_numpy(_label).long())
+        state.append(torch.tensor(_state).long())
+    frames = torch.stack(frames,dim=0)
+    label = torch.stack(label, dim=0)
+    state = torch.stack(state, dim=0)
+    return [frames], label, state, fps, info
+
+
+def random_samples(rng, batch_size, clip_size):
+    samples = []
+    for _ in range(batch_size):
+        state = int(rng.integers(2))
+        start = int(rng.integers(0, 10000))
+        end = start + int(rng.integers(200, 300))
+        labels = np.zeros(16)
+        labels[rng.integers(16)] = 1
+        info = {
+            'clip_start_frame': start,
+            'clip_end_frame': end,
+            'pnr_frame': int(rng.integers(start, end)) if state else None,
+        }
+        frames = torch.randn(3, 16, clip_size, clip_size)
+        fps = (end - start + 1) / float(rng.uniform(7.5, 8.5))
+        samples.append(([frames], labels, state, fps, info))
+    return samples
+
+
+def timed(func, *args, iters=20):
+    start = time.perf_counter()
+    for _ in range(iters):
+        out = func(*args)
+    return out, (time.perf_counter() - start) / iters * 1000
+
+
+def check_all_reduce(rank, world_size, port, batches):
+    dist.init_process_group(
+        "gloo", init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank, world_size=world_size,
+    )
+    stats = {"state_change": 0, "keyframe_distance": 0}
+    for batch in batches[rank::world_size]:
+        keyframe_preds, state_change_preds, (_, labels, states, fps, info) = batch
+        stats["state_change"] += state_change_stats(state_change_preds, states)
+        stats["keyframe_distance"] += keyframe_distance_stats(
+            keyframe_preds, labels, states, fps, info
+        )
+    stats = all_reduce_stats(stats)
+    if rank == 0:
+        print("all-reduce: " + ", ".join(
+            f"{key} {stats_to_metric(value):.6f}" for key, value in stats.items()
+        ))
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser("baseline metrics benchmark")
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--num_batches", default=8, type=int)
+    parser.add_argument("--clip_size", default=32, type=int)
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--world_size", default=2, type=int)
+    parser.add_argument("--port", default=29650, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+
+    batches = []
+    total = {"state_change": 0, "keyframe_distance": 0}
+    for _ in range(args.num_batches):
+        samples = random_samples(rng, args.batch_size, args.clip_size)
+        batch = collate_batch(samples)
+        previous = previous_c_fn(samples)
+        assert torch.equal(batch[0][0], previous[0][0])
+        for a, b in zip(batch[1:3], previous[1:3]):
+            assert torch.equal(a, b)
+        assert batch[3].tolist() == previous[3]
+        assert torch.equal(batch[4], clip_frames(previous[4]))
+
+        labels, states, fps, info = batch[1:]
+        keyframe_preds = torch.randn(args.batch_size, 16, 1, device=device)
+        state_change_preds = torch.randn(args.batch_size, 2, device=device)
+        states = states.to(device)
+
+        acc, acc_time = timed(state_change_stats, state_change_preds, states)
+        prev_acc, prev_acc_time = timed(
+            previous_state_change_accuracy, state_change_preds, states
+        )
+        dist_stats, dist_time = timed(
+            keyframe_distance_stats, keyframe_preds, labels, states, fps, info
+        )
+        prev_dist, prev_dist_time = timed(
+            previous_keyframe_distance, keyframe_preds, labels,
+            state_change_preds, states, previous[3], previous[4]
+        )
+        assert stats_to_metric(acc) == prev_acc
+        assert np.isclose(stats_to_metric(dist_stats), prev_dist, rtol=1e-12)
+
+        total["state_change"] += acc.cpu()
+        total["keyframe_distance"] += dist_stats.cpu()
+        batches.append((keyframe_preds.cpu(), state_change_preds.cpu(), batch))
+
+    print(f"metrics match on {args.num_batches} batches of {args.batch_size}")
+    print(f"state change accuracy: previous {prev_acc_time:.3f} ms, "
+          f"batched {acc_time:.3f} ms")
+    print(f"keyframe distance: previous {prev_dist_time:.3f} ms, "
+          f"batched {dist_time:.3f} ms")
+
+    _, collate_time = timed(collate_batch, samples)
+    _, c_fn_time = timed(previous_c_fn, samples)
+    print(f"collate: previous {c_fn_time:.2f} ms, tensor {collate_time:.2f} ms")
+
+    loader_times = []
+    for collate_fn in [previous_c_fn, collate_batch]:
+        loader = torch.utils.data.DataLoader(
+            samples * 8, batch_size=args.batch_size, num_workers=2,
+            collate_fn=collate_fn, persistent_workers=True,
+        )
+        for _ in loader:
+            pass
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        loader_times.append(time.perf_counter() - start)
+    print(f"loader with 2 workers: previous {loader_times[0] * 1000:.1f} ms/epoch, "
+          f"tensor {loader_times[1] * 1000:.1f} ms/epoch")
+
+    print("whole set:  " + ", ".join(
+        f"{key} {stats_to_metric(value):.6f}" for key, value in total.items()
+    ))
+    mp.start_processes(
+        check_all_reduce,
+        args=(args.world_size, args.port, batches),
+        nprocs=args.world_size,
+        start_method="fork",
+    )
+
+
+if __name__ == "__main__":
+    main()
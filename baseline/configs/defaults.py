@@ -112,6 +112,9 @@ _C.DATA_LOADER.SHUFFLE = True
 # Drop the last batch
 _C.DATA_LOADER.DROP_LAST = True
 
+# Keep data loader workers alive between epochs
+_C.DATA_LOADER.PERSISTENT_WORKERS = True
+
 # If True, then load the non-state change clip's frames too
 _C.DATA_LOADER.IS_NO_STATE_CHANGE = True
 
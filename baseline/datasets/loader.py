@@ -2,8 +2,12 @@
 Data Loader
 """
 
+import numpy as np
 import torch
 from torch.utils.data.dataloader import default_collate
+
+import utils.distributed as du
+from evaluation.metrics import clip_frames
 from .build_dataset import build_dataset
 
 def construct_loader(cfg, split):
@@ -37,49 +41,49 @@ def construct_loader(cfg, split):
     dataset = build_dataset(dataset_name, cfg, split)
     if cfg.SOLVER.ACCELERATOR == 'dp':
         sampler =  None
+    elif cfg.SOLVER.ACCELERATOR.startswith('ddp'):
+        # Lightning is run with replace_sampler_ddp=False, every process reads
+        # its own shard. The epoch of the sampler is set by Lightning.
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset,
+            num_replicas=du.get_world_size(),
+            rank=du.get_rank(),
+            shuffle=shuffle,
+            drop_last=drop_last,
+        )
     else:
         raise NotImplementedError("{} not implemented".format(
             cfg.SOLVER.ACCELERATOR
         ))
-    # sampler = torch.utils.data.distributed.DistributedSampler(
-    #     dataset,
-    #     num_replicas = ,
-    #     rank = ,
-    #     shuffle = shuffle,
-    #     drop_last=drop_last,
-    # )
+    num_workers = cfg.DATA_LOADER.NUM_WORKERS
     loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=batch_size,
         shuffle=(False if sampler else shuffle),
         sampler=sampler,
-        num_workers=cfg.DATA_LOADER.NUM_WORKERS,
+        num_workers=num_workers,
         pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
         drop_last=drop_last,
-        collate_fn = c_fn,
+        collate_fn=collate_batch,
+        persistent_workers=num_workers > 0 and cfg.DATA_LOADER.PERSISTENT_WORKERS,
     )
     return loader
 
 
-def c_fn(batch_lst):
-    
-    frames = []
-    label = []
-    state = []
-    fps = []
-    info = []
+def collate_batch(batch_lst):
+    """
+    Collate samples of StateChangeDetectionAndKeyframeLocalisation.
+    Frames are stacked by default_collate, into shared memory in worker
+    processes so that the batch is not copied again on its way to the main
+    process. Labels, states and fps are batched as tensors, the frames of the
+    info dicts as a (B, 3) tensor (see evaluation.metrics.clip_frames) so that
+    dp scatters them with the rest of the batch.
+    """
+    frames, labels, states, fps, info = zip(*batch_lst)
+    # every sample holds a single pathway
+    frames = default_collate([f[0] for f in frames])
+    labels = torch.from_numpy(np.stack(labels)).long()
+    states = torch.as_tensor(states).long()
+    fps = torch.as_tensor(fps, dtype=torch.float64)
 
-    for batch in batch_lst:
-        _frames, _label, _state, _fps, _info = batch
-        # _frames is a lst that contains torch.Tensor of shape (b,c,t,h,w)
-        fps.append(_fps)
-        info.append(_info)
-        frames.extend(_frames)
-        label.append(torch.from_numpy(_label).long())
-        state.append(torch.tensor(_state).long())
-    
-    frames = torch.stack(frames,dim=0)
-    label = torch.stack(label, dim=0)
-    state = torch.stack(state, dim=0)
- 
-    return [frames], label, state, fps, info
+    return [frames], labels, states, fps, clip_frames(info)
@@ -1,17 +1,104 @@
 import torch
 import numpy as np
 
+import utils.distributed as du
+
+
+def state_change_stats(preds, labels):
+    """
+    Number of correct state change predictions and number of samples of a batch.
+    Args:
+        preds (tensor): state change logits of shape (B, ...), the prediction of
+            a sample is the argmax of its flattened logits.
+        labels (tensor): state change labels with one element per sample.
+    Returns:
+        stats (tensor): float64 tensor [correct, total] on the device of preds.
+    """
+    pred = preds.reshape(len(preds), -1).argmax(dim=1)
+    correct = (pred == labels.reshape(-1).to(pred.device)).sum()
+    return torch.stack([correct, correct.new_tensor(len(preds))]).double()
+
+
+def clip_frames(info):
+    """
+    Frame info of a batch of clips as a tensor, so that DataParallel scatters it
+    along with the other tensors of the batch.
+    Args:
+        info (list): clip info dicts with `clip_start_frame`, `clip_end_frame`
+            and `pnr_frame` (None for clips without state change).
+    Returns:
+        frames (tensor): float64 tensor (B, 3) of start, end and pnr frames,
+            pnr is 0 for clips without state change.
+    """
+    return torch.tensor(
+        [
+            [x['clip_start_frame'], x['clip_end_frame'], x['pnr_frame'] or 0]
+            for x in info
+        ],
+        dtype=torch.float64,
+    ).reshape(-1, 3)
+
+
+def keyframe_distance_stats(preds, labels, sc_labels, fps, info):
+    """
+    Sum of keyframe localisation errors (in seconds) and number of clips with a
+    state change of a batch.
+    Args:
+        preds (tensor): keyframe logits of shape (B, 16, ...), the location of a
+            sample is the argmax of its flattened logits.
+        labels (tensor): keyframe labels, unused and kept for the signature of
+            keyframe_distance.
+        sc_labels (tensor): state change labels with one element per sample.
+        fps (tensor or list): effective fps of every clip.
+        info (tensor or list): clip frames as returned by clip_frames, or the
+            clip info dicts it takes.
+    Returns:
+        stats (tensor): float64 tensor [error sum, count] on the device of preds.
+    """
+    device = preds.device
+    loc = preds.reshape(len(preds), -1).argmax(dim=1).double()
+    if not torch.is_tensor(info):
+        info = clip_frames(info)
+    frames = info.to(device=device, dtype=torch.float64)
+    fps = torch.as_tensor(fps, dtype=torch.float64, device=device)
+    valid = sc_labels.reshape(-1).to(device) == 1
+
+    start, end, pnr = frames.unbind(dim=1)
+    err_sec = ((end - start) / 16 * loc - (pnr - start)).abs() / fps
+    return torch.stack([
+        torch.where(valid, err_sec, torch.zeros_like(err_sec)).sum(),
+        valid.sum().double(),
+    ])
+
+
+def all_reduce_stats(stats):
+    """
+    Sum metric stats over all processes with a single all-reduce.
+    Args:
+        stats (dict): name -> stats tensor, all on the same device.
+    Returns:
+        stats (dict): name -> stats tensor summed over processes.
+    """
+    if du.get_world_size() == 1:
+        return stats
+    names = list(stats.keys())
+    flat = torch.cat([stats[name].reshape(-1) for name in names])
+    torch.distributed.all_reduce(flat)
+    return dict(zip(names, flat.split([stats[name].numel() for name in names])))
+
+
+def stats_to_metric(stats, empty=0.0):
+    """
+    Ratio of [sum, count] stats, `empty` if the count is zero.
+    """
+    total, count = stats.tolist()
+    if count == 0:
+        return empty
+    return total / count
+
 
 def state_change_accuracy(preds, labels):
-    correct = 0
-    total = 0
-    for pred, label in zip(preds, labels):
-        pred_ = torch.argmax(pred)
-        if pred_.item() == label.item():
-            correct += 1
-        total += 1
-    accuracy = correct/total
-    return accuracy
+    return stats_to_metric(state_change_stats(preds, labels))
 
 
 def keyframe_distance(
@@ -23,27 +110,8 @@ def keyframe_distance(
     info,
     evaluate_trained=False
 ):
-    distance_list = list()
-    for pred, label, sc_pred, sc_label, ind_info, ind_fps in zip(
-        preds,
-        labels,
-        sc_preds,
-        sc_labels,
-        info,
-        fps
-    ):
-        if sc_label.item() == 1:
-            keyframe_loc_pred = torch.argmax(pred).item()
-            keyframe_loc_pred_mapped = (
-                ind_info['clip_end_frame'] - ind_info['clip_start_frame']
-            ) / 16 * keyframe_loc_pred
-            
-            gt = ind_info['pnr_frame'] - ind_info['clip_start_frame']
-            err_frame = abs(keyframe_loc_pred_mapped - gt)
-            err_sec = err_frame/ind_fps
-            distance_list.append(err_sec)
-          
-    if len(distance_list) == 0:
+    stats = keyframe_distance_stats(preds, labels, sc_labels, fps, info)
+    if stats[1] == 0:
         # If evaluating the trained model, use this
         if evaluate_trained:
             return None
@@ -51,5 +119,5 @@ def keyframe_distance(
         # Due to this, the Tensorboard graphs' results for keyframe distance
         # will be a little inaccurate.
         return np.mean(0.0)
-    
-    return np.mean(distance_list)
+
+    return np.float64(stats_to_metric(stats))
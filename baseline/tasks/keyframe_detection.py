@@ -6,7 +6,12 @@ import torch
 from torch.nn import MSELoss
 
 from tasks.video_task import VideoTask
-from evaluation.metrics import state_change_accuracy, keyframe_distance
+from evaluation.metrics import (
+    state_change_stats,
+    keyframe_distance_stats,
+    all_reduce_stats,
+    stats_to_metric,
+)
 
 
 
@@ -47,14 +52,9 @@ class StateChangeAndKeyframeLocalisation(VideoTask):
         lambda_2 = self.cfg.MODEL.LAMBDA_2
         loss = (keyframe_loss * lambda_2) + (state_change_loss * lambda_1)
 
-        accuracy = state_change_accuracy(
-            state_change_preds,
-            state_change_label
-        )
-
         # print(state_change_label)
         # print(info)
-        keyframe_avg_time_dist = keyframe_distance(
+        stats = self._metric_stats(
             keyframe_preds,
             labels,
             state_change_preds,
@@ -74,19 +74,16 @@ class StateChangeAndKeyframeLocalisation(VideoTask):
             "state_change_loss": state_change_loss,
             "train_loss": loss,
             "loss": loss,
-            "state_change_metric_train": accuracy,
-            "keyframe_loc_metric_time_dist_train": keyframe_avg_time_dist
+            "stats": stats,
         }
 
     def training_epoch_end(self, training_step_outputs):
         
         #print(training_step_outputs)
-        keys = [x for x in training_step_outputs[0].keys() if "metric" in x]
-        for key in keys:
-            metric = torch.Tensor( [item[key].mean() for item in training_step_outputs] ).float().mean()
-            self.log(key, metric, on_epoch=True, prog_bar=True, logger=True)
-            # wandb.log(key, metric)
-            # print(key, metric)
+        self._log_epoch_metrics(training_step_outputs, {
+            "state_change": "state_change_metric_train",
+            "keyframe_distance": "keyframe_loc_metric_time_dist_train",
+        }, on_epoch=True, prog_bar=True, logger=True)
 
     def validation_step(self, batch, batch_idx):
 
@@ -115,11 +112,7 @@ class StateChangeAndKeyframeLocalisation(VideoTask):
         loss = (keyframe_loss * lambda_2) + (state_change_loss * lambda_1)
         # until here
 
-        accuracy = state_change_accuracy(
-            state_change_preds,
-            state_change_label
-        )
-        keyframe_avg_time_dist = keyframe_distance(
+        stats = self._metric_stats(
             keyframe_preds,
             labels,
             state_change_preds,
@@ -132,28 +125,21 @@ class StateChangeAndKeyframeLocalisation(VideoTask):
         self.log('val_loss', loss, on_epoch=True, prog_bar=True, logger=True)
         # print(f"val_acc:{accuracy}")
         return {
-            "state_change_metric_val": accuracy,
-            "keyframe_loc_metric_time_dist_val": keyframe_avg_time_dist,
+            "stats": stats,
             # added by jieming 7/15/2022
             "val_loss": loss
         }
 
     def validation_epoch_end(self, validation_step_outputs):
-        keys = [x for x in validation_step_outputs[0].keys() if "metric" in x]
-
-        for key in keys:
-            metric = torch.Tensor( [item[key].mean() for item in validation_step_outputs] ).float().mean()
-            self.log(key, metric, on_epoch=True, prog_bar=True, logger=True)
-            # print(key, metric)
+        self._log_epoch_metrics(validation_step_outputs, {
+            "state_change": "state_change_metric_val",
+            "keyframe_distance": "keyframe_loc_metric_time_dist_val",
+        }, on_epoch=True, prog_bar=True, logger=True)
 
     def test_step(self, batch, batch_idx):
         frames, labels, state_change_label, fps, info = batch
         keyframe_preds, state_change_preds = self.forward(frames)
-        accuracy = state_change_accuracy(
-            state_change_preds,
-            state_change_label
-        )
-        keyframe_avg_time_dist = keyframe_distance(
+        stats = self._metric_stats(
             keyframe_preds,
             labels,
             state_change_preds,
@@ -165,13 +151,37 @@ class StateChangeAndKeyframeLocalisation(VideoTask):
         return {
             "labels": labels,
             "preds": keyframe_preds,
-            "state_change_metric": accuracy,
-            "keyframe_loc_metric_time": keyframe_avg_time_dist
+            "stats": stats,
         }
 
     def test_epoch_end(self, test_step_outputs):
-        keys = [x for x in test_step_outputs[0].keys() if "metric" in x]
-        for key in keys:
-            metric = torch.Tensor( [item[key].mean() for item in test_step_outputs] ).float().mean()
-            self.log(key, metric, prog_bar=True)
-            # print(key, metric)
+        self._log_epoch_metrics(test_step_outputs, {
+            "state_change": "state_change_metric",
+            "keyframe_distance": "keyframe_loc_metric_time",
+        }, prog_bar=True)
+
+    def _metric_stats(self, keyframe_preds, labels, state_change_preds,
+                      state_change_label, fps, info):
+        # [sum, count] of every metric, summed over the epoch and the processes
+        # in _log_epoch_metrics
+        return {
+            "state_change": state_change_stats(
+                state_change_preds, state_change_label
+            ),
+            "keyframe_distance": keyframe_distance_stats(
+                keyframe_preds, labels, state_change_label, fps, info
+            ),
+        }
+
+    def _log_epoch_metrics(self, step_outputs, names, **kwargs):
+        # with dp, the *_step_end methods of VideoTask return the stats of the
+        # replicas concatenated by the gather instead of averaged
+        stats = {
+            key: torch.cat(
+                [item["stats"][key] for item in step_outputs]
+            ).reshape(-1, 2).sum(dim=0)
+            for key in names
+        }
+        stats = all_reduce_stats(stats)
+        for key, name in names.items():
+            self.log(name, stats_to_metric(stats[key]), **kwargs)
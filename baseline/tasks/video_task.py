@@ -34,6 +34,13 @@ class VideoTask(LightningModule):
             training_step_outputs['loss'] = training_step_outputs['loss'].mean()
         return training_step_outputs
 
+    def validation_step_end(self, validation_step_outputs):
+        # outputs of the dp replicas are returned as gathered, not averaged
+        return validation_step_outputs
+
+    def test_step_end(self, test_step_outputs):
+        return test_step_outputs
+
     def validation_step(self, batch, batch_idx):
         raise NotImplementedError
 
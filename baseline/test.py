@@ -6,7 +6,7 @@ import torch.nn as nn
 from datasets import loader
 from models.build import build_model
 from utils.parser import parse_args, load_config
-from evaluation.metrics import state_change_accuracy, keyframe_distance
+from evaluation.metrics import state_change_stats, keyframe_distance_stats, stats_to_metric
 
 
 def main(cfg):
@@ -29,36 +29,31 @@ def main(cfg):
 
     model.eval()
     dataloader = loader.construct_loader(cfg, "test")
-    accuracy_list = list()
-    keyframe_dist_list = list()
+    accuracy_stats = 0
+    keyframe_dist_stats = 0
 
     for batch in tqdm(dataloader):
         frames, labels, state_change_label, fps, info = batch
         assert len(frames) == 1
         frames = [frames[0].to('cuda:1')]
         keyframe_preds, state_change_preds = model.forward(frames)
-        accuracy = state_change_accuracy(
+        accuracy_stats += state_change_stats(
             state_change_preds,
             state_change_label
-        )
-        keyframe_avg_time_dist = keyframe_distance(
+        ).cpu()
+        keyframe_dist_stats += keyframe_distance_stats(
             keyframe_preds,
             labels,
-            state_change_preds,
             state_change_label,
             fps,
-            evaluate_trained=True,
-        )
-        accuracy_list.append(accuracy)
-        if keyframe_avg_time_dist is not None:
-            keyframe_dist_list.append(keyframe_avg_time_dist)
+            info,
+        ).cpu()
         frames = [frames[0].detach().cpu()]
         del frames
     print(
-        f'State change accuracy: {sum(accuracy_list)/len(accuracy_list)}; '
-        f'Keyframe distance: {sum(keyframe_dist_list)/len(keyframe_dist_list)}'
+        f'State change accuracy: {stats_to_metric(accuracy_stats)}; '
+        f'Keyframe distance: {stats_to_metric(keyframe_dist_stats)}'
     )
 
-
 if __name__ == '__main__':
     main(load_config(parse_args()))
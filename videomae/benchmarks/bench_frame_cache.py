@@ -0,0 +1,180 @@
+"""
+multi-process clip reading throughput: tar files read directly, CacheManager and the shared-memory FrameCache
+
+- tarfile:        read_from_tarfile() on the source tar files (DATA.READ_FROM_TAR)
+- cache_manager:  every process asks the CacheManager socket server whether the tar file is cached locally,
+                  copies it with shutil.copy if not, then reads the local copy
+- frame_cache:    read_from_tarfile() through the node-local FrameCache (DATA.FRAME_CACHE)
+
+Each process reads random clips of consecutive frames, throughput is reported per epoch (the first one
+is cold for cache_manager and frame_cache). Synthetic tar files of jpeg frames are written to a
+temporary directory unless --data_dir is given.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_frame_cache --num_workers 8 --data_dir /path/to/rgb_frames/P01
+
+"""
+
+import os
+import io
+import sys
+import time
+import glob
+import shutil
+import random
+import logging
+import tarfile
+import argparse
+import tempfile
+import multiprocessing as mp
+
+import numpy as np
+from PIL import Image
+
+from epickitchens_utils import CacheManager, read_from_tarfile
+from frame_cache import FrameCache, get_frame_cache
+
+
+def write_synthetic_tars(data_dir, num_videos, num_frames, frame_size):
+    rng = np.random.default_rng(0)
+    for v in range(num_videos):
+        with tarfile.open(os.path.join(data_dir, f"video_{v}.tar"), "w") as tf:
+            for idx in range(1, num_frames + 1):
+                # smooth noise, compresses like natural frames
+                img = rng.integers(0, 256, (frame_size // 8, frame_size // 8, 3), dtype=np.uint8)
+                img = Image.fromarray(img).resize((frame_size * 4 // 3, frame_size), Image.BILINEAR)
+                buffer = io.BytesIO()
+                img.save(buffer, format="JPEG", quality=90)
+                info = tarfile.TarInfo("frame_{:010d}.jpg".format(idx))
+                info.size = buffer.tell()
+                buffer.seek(0)
+                tf.addfile(info, buffer)
+
+
+def count_frames(path):
+    with tarfile.open(path) as tf:
+        return len(tf.getmembers())
+
+
+def worker(rank, mode, args, videos, barrier, results):
+    logging.getLogger("epickitchens_utils").setLevel(logging.ERROR)
+    rng = random.Random(args.seed + rank)
+    local_dir = os.path.join(args.local_dir, "rgb")
+
+    if mode == "cache_manager":
+        client = CacheManager(("127.0.0.1", args.port), args.num_workers)
+        client.connect()
+    elif mode == "frame_cache":
+        frame_cache = get_frame_cache(args.frame_cache)
+
+    for epoch in range(args.epochs):
+        barrier.wait()
+        start = time.perf_counter()
+        for _ in range(args.clips_per_worker):
+            path, num_frames = videos[rng.randrange(len(videos))]
+            st = rng.randint(1, max(num_frames - args.clip_len * args.sampling_rate, 1))
+            frame_idx = [min(st + i * args.sampling_rate, num_frames) for i in range(args.clip_len)]
+            source, name = os.path.dirname(path), os.path.basename(path)[:-len(".tar")]
+
+            if mode == "tarfile":
+                read_from_tarfile(source, name, frame_idx, as_pil=True)
+            elif mode == "cache_manager":
+                local_path = os.path.join(local_dir, name + ".tar")
+                if not client.call(["exists_auto_acquire", [local_path]]):
+                    shutil.copy(path, local_dir)
+                    client.call(["release_and_check", [local_path]])
+                read_from_tarfile(local_dir, name, frame_idx, as_pil=True)
+            else:
+                read_from_tarfile(source, name, frame_idx, as_pil=True, frame_cache=frame_cache)
+        results.put((epoch, time.perf_counter() - start))
+
+    if mode == "cache_manager":
+        client.s.close()
+
+
+def serve_cache_manager(args):
+    # client handlers of CacheManager exit with EOFError when the benchmark processes disconnect
+    sys.stderr = open(os.devnull, "w")
+    CacheManager(("127.0.0.1", args.port), args.num_workers, log_path=args.local_dir).start()
+
+
+def run(mode, args, videos):
+    barrier = mp.Barrier(args.num_workers)
+    results = mp.Queue()
+    server = None
+    if mode == "cache_manager":
+        os.makedirs(os.path.join(args.local_dir, "rgb"), exist_ok=True)
+        server = mp.Process(target=serve_cache_manager, args=(args, ))
+        server.start()
+        time.sleep(1)
+
+    workers = [mp.Process(target=worker, args=(rank, mode, args, videos, barrier, results)) for rank in range(args.num_workers)]
+    for p in workers:
+        p.start()
+    elapsed = [0.] * args.epochs
+    for _ in range(args.num_workers * args.epochs):
+        epoch, seconds = results.get(timeout=args.timeout)
+        elapsed[epoch] = max(elapsed[epoch], seconds)
+    for p in workers:
+        p.join()
+
+    if server is not None:
+        # the server and its SyncManager exit once all clients are disconnected
+        server.join(timeout=10)
+        if server.is_alive():
+            server.terminate()
+        # the SyncManager listens on port + 1
+        args.port += 2
+    return [args.num_workers * args.clips_per_worker / seconds for seconds in elapsed]
+
+
+def main():
+    parser = argparse.ArgumentParser("frame cache benchmark")
+    parser.add_argument("--data_dir", default="", type=str, help="directory of <video>.tar files of frames")
+    parser.add_argument("--num_videos", default=32, type=int, help="number of synthetic videos")
+    parser.add_argument("--frames_per_video", default=300, type=int)
+    parser.add_argument("--frame_size", default=256, type=int)
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--clips_per_worker", default=100, type=int)
+    parser.add_argument("--clip_len", default=16, type=int)
+    parser.add_argument("--sampling_rate", default=2, type=int)
+    parser.add_argument("--epochs", default=3, type=int)
+    parser.add_argument("--cache_gb", default=4, type=float)
+    parser.add_argument("--modes", default="tarfile,cache_manager,frame_cache", type=str)
+    parser.add_argument("--port", default=29700, type=int, help="port of the CacheManager server")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--timeout", default=600, type=int, help="seconds to wait for an epoch of a worker")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    args.local_dir = os.path.join(tmp_dir, "local")
+    args.frame_cache = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tmp_dir, f"bench_frame_cache_{os.getpid()}")
+    try:
+        if not args.data_dir:
+            args.data_dir = os.path.join(tmp_dir, "data")
+            os.makedirs(args.data_dir)
+            write_synthetic_tars(args.data_dir, args.num_videos, args.frames_per_video, args.frame_size)
+        videos = [(path, count_frames(path)) for path in sorted(glob.glob(os.path.join(args.data_dir, "*.tar")))]
+
+        report = {}
+        for mode in args.modes.split(","):
+            cache = FrameCache(args.frame_cache, size=int(args.cache_gb * 2 ** 30)) if mode == "frame_cache" else None
+            report[mode] = run(mode, args, videos)
+            if cache is not None:
+                stats = cache.stats()
+                print(f"frame cache: {stats['used_bytes'] / 2 ** 20:.1f} MB used, {stats['puts']} puts, "
+                      f"{stats['evictions']} evictions")
+                cache.unlink()
+
+        print(f"{'clips/s':>14}" + "".join(f"{f'epoch {e}':>10}" for e in range(args.epochs)))
+        for mode, speeds in report.items():
+            print(f"{mode:>14}" + "".join(f"{s:>10.1f}" for s in speeds))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.exists(args.frame_cache):
+            os.remove(args.frame_cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+model startup time: eager construction + full checkpoint load versus meta-device construction
+with weights assigned from a memory-mapped checkpoint (fast_init.create_model_from_checkpoint)
+
+A checkpoint of the model is saved to a temporary file when --ckpt is not given. The previous
+numpy implementation of the sinusoid position table is timed against the vectorised, cached one.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_model_startup --model vit_large_patch16_224 --nb_classes 400
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from timm.models import create_model
+
+import modeling_finetune
+import modeling_pretrain  # register models
+from fast_init import create_model_from_checkpoint, get_model_state_dict
+
+
+def numpy_sinusoid_encoding_table(n_position, d_hid):
+    """ previous implementation in modeling_finetune """
+    def get_position_angle_vec(position):
+        return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)]
+
+    sinusoid_table = np.array([get_position_angle_vec(pos_i) for pos_i in range(n_position)])
+    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])
+    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])
+
+    return torch.FloatTensor(sinusoid_table).unsqueeze(0)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def eager_startup(args, model_kwargs):
+    """ previous startup: random initialization, read the whole checkpoint, then copy """
+    model = create_model(args.model, pretrained=False, **model_kwargs)
+    checkpoint = torch.load(args.ckpt, map_location="cpu")
+    model.load_state_dict(get_model_state_dict(checkpoint), strict=True)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser("model startup benchmark")
+    parser.add_argument("--model", default="vit_base_patch16_224", type=str)
+    parser.add_argument("--ckpt", default="", type=str, help="checkpoint of the model, a random one is saved if empty")
+    parser.add_argument("--nb_classes", default=400, type=int, help="number of classes of finetuning models")
+    parser.add_argument("--num_frames", default=16, type=int)
+    args = parser.parse_args()
+
+    model_kwargs = {} if args.model.startswith("pretrain") else {"num_classes": args.nb_classes, "all_frames": args.num_frames}
+
+    tmp_path = None
+    if not args.ckpt:
+        tmp_path = tempfile.mktemp(suffix=".pth")
+        torch.save({"model": create_model(args.model, **model_kwargs).state_dict(), "epoch": 0}, tmp_path)
+        args.ckpt = tmp_path
+
+    try:
+        eager, eager_time = timed(eager_startup, args, model_kwargs)
+        fast, fast_time = timed(create_model_from_checkpoint, args.model, args.ckpt, pretrained=False, **model_kwargs)
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+    for (name, a), b in zip(eager.state_dict().items(), fast.state_dict().values()):
+        assert torch.equal(a, b), f"{name} differs"
+    print(f"{args.model}: eager + torch.load {eager_time:.2f}s, meta + mmap {fast_time:.2f}s "
+          f"({eager_time / fast_time:.1f}x)")
+
+    n_position, d_hid = 8 * 14 * 14, eager.embed_dim if hasattr(eager, "embed_dim") else 768
+    modeling_finetune._sinusoid_encoding_table.cache_clear()
+    numpy_table, numpy_time = timed(numpy_sinusoid_encoding_table, n_position, d_hid)
+    table, torch_time = timed(modeling_finetune.get_sinusoid_encoding_table, n_position, d_hid)
+    _, cached_time = timed(modeling_finetune.get_sinusoid_encoding_table, n_position, d_hid)
+    assert torch.equal(numpy_table, table), "sinusoid tables differ"
+    print(f"sinusoid table {n_position}x{d_hid}: numpy {numpy_time * 1000:.1f} ms, "
+          f"torch {torch_time * 1000:.2f} ms, cached {cached_time * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+equivalence check and step-time benchmark of the packed MultiModalBlock
+
+MultiModalBlock runs the rgb, flow and cross-modality sequences in a single norm/attention/mlp call.
+This script compares it against the previous implementation (one call per sequence) and measures
+the forward/backward step time of PretrainMultiModalTransformer with both implementations.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_multimodal_block --device cuda --batch_size 8
+
+"""
+
+import time
+import argparse
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+import modeling_pretrain
+from modeling_pretrain import MultiModalBlock, PretrainMultiModalTransformer
+
+
+def sequential_forward(self, token_dict):
+    """ previous MultiModalBlock.forward: one attention/mlp call per sequence """
+    x1, x2 = token_dict["tokens"]
+    N1 = token_dict["split_point"]
+
+    if N1 > 0:
+        x1_rgb, x1_flow = x1[:, :N1, :], x1[:, N1:, :]
+        x1_rgb = x1_rgb + self.drop_path(self.attn(self.norm1(x1_rgb)))
+        x1_rgb = x1_rgb + self.drop_path(self.mlp(self.norm2(x1_rgb)))
+        x1_flow = x1_flow + self.drop_path(self.attn(self.norm1(x1_flow)))
+        x1_flow = x1_flow + self.drop_path(self.mlp(self.norm2(x1_flow)))
+        x1 = torch.cat([x1_rgb, x1_flow], dim=1)
+    else:
+        x1 = x1 + self.drop_path(self.attn(self.norm1(x1)))
+        x1 = x1 + self.drop_path(self.mlp(self.norm2(x1)))
+
+    if x2 is not None:
+        x2 = x2 + self.drop_path(self.attn(self.norm1(x2)))
+        x2 = x2 + self.drop_path(self.mlp(self.norm2(x2)))
+
+    token_dict["tokens"] = [x1, x2]
+    return token_dict
+
+
+def build_model(args):
+    return PretrainMultiModalTransformer(
+        img_size=args.img_size,
+        patch_size=16,
+        encoder_embed_dim=args.embed_dim,
+        encoder_depth=args.depth,
+        encoder_num_heads=args.num_heads,
+        decoder_embed_dim=args.embed_dim // 2,
+        decoder_depth=2,
+        decoder_num_heads=args.num_heads // 2,
+        rgb_num_classes=1536,
+        flow_num_classes=512,
+        qkv_bias=True,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6),
+    )
+
+
+def make_inputs(args, device):
+    num_patches = 8 * (args.img_size // 16) ** 2
+    num_mask = int(args.mask_ratio * num_patches)
+
+    rgb = torch.randn(args.batch_size, 3, 16, args.img_size, args.img_size, device=device)
+    flow = torch.randn(args.batch_size, 2, 8, args.img_size, args.img_size, device=device)
+
+    def random_mask():
+        index = torch.rand(args.batch_size, num_patches, device=device).argsort(dim=1)[:, :num_mask]
+        return torch.zeros(args.batch_size, num_patches, dtype=torch.bool, device=device).scatter_(1, index, True)
+
+    return rgb, flow, random_mask(), random_mask()
+
+
+def check_equivalence(model, inputs):
+    model.eval()
+    with torch.no_grad():
+        packed = model(*inputs)
+        MultiModalBlock.forward, packed_forward = sequential_forward, MultiModalBlock.forward
+        try:
+            sequential = model(*inputs)
+        finally:
+            MultiModalBlock.forward = packed_forward
+
+    for name, a, b in zip(("rgb", "flow"), packed, sequential):
+        print(f"{name}: max abs diff {(a - b).abs().max().item():.3e}")
+        assert torch.allclose(a, b, atol=1e-4, rtol=1e-4), f"{name} outputs differ"
+
+
+def step_time(model, inputs, args):
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    def step():
+        rgb_hat, flow_hat = model(*inputs)
+        loss = rgb_hat.float().pow(2).mean() + flow_hat.float().pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    def synchronize():
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+
+    for _ in range(args.warmup):
+        step()
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    synchronize()
+    return (time.perf_counter() - start) / args.iters
+
+
+def main():
+    parser = argparse.ArgumentParser("MultiModalBlock packed attention benchmark")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument("--img_size", default=112, type=int)
+    parser.add_argument("--embed_dim", default=192, type=int)
+    parser.add_argument("--depth", default=4, type=int)
+    parser.add_argument("--num_heads", default=4, type=int)
+    parser.add_argument("--mask_ratio", default=0.9, type=float)
+    parser.add_argument("--warmup", default=3, type=int)
+    parser.add_argument("--iters", default=10, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    model = build_model(args).to(device)
+    inputs = make_inputs(args, device)
+
+    check_equivalence(model, inputs)
+
+    packed = step_time(model, inputs, args)
+    MultiModalBlock.forward, packed_forward = sequential_forward, MultiModalBlock.forward
+    try:
+        sequential = step_time(model, inputs, args)
+    finally:
+        MultiModalBlock.forward = packed_forward
+
+    print(f"sequential: {sequential * 1000:.1f} ms/step, packed: {packed * 1000:.1f} ms/step, "
+          f"speedup: {sequential / packed:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
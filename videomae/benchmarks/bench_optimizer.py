@@ -0,0 +1,121 @@
+"""
+optimizer step time of create_optimizer() with flattened parameter groups and multi-tensor (foreach / fused)
+kernels versus the per-layer groups and per-parameter loop
+
+- equivalence:  parameters after a few AdamW steps with layer decay and the per-step lr and weight decay
+                assignment of the training loops match those of the per-parameter loop
+- throughput:   time of optimizer.step() of a finetuning ViT with layer decay, for opt_impl for_loop
+                (the per-layer groups of get_parameter_groups, one update per parameter), foreach and fused
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_optimizer --embed_dim 768 --depth 12 --layer_decay 0.75
+
+"""
+
+import copy
+import time
+import argparse
+from functools import partial
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+from modeling_finetune import VisionTransformer
+from optim_factory import create_optimizer, LayerDecayValueAssigner
+
+
+IMPLS = ["for_loop", "foreach", "fused"]
+
+
+def build_model(args):
+    return VisionTransformer(
+        img_size=args.input_size, patch_size=16, num_classes=400, embed_dim=args.embed_dim, depth=args.depth,
+        num_heads=args.embed_dim // 64, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6),
+    )
+
+
+def build_optimizer(model, opt_impl, args):
+    num_layers = model.get_num_layers()
+    assigner = None
+    if args.layer_decay < 1.0:
+        assigner = LayerDecayValueAssigner(list(args.layer_decay ** (num_layers + 1 - i) for i in range(num_layers + 2)))
+
+    opt_args = SimpleNamespace(opt="adamw", lr=1e-3, weight_decay=0.05, opt_eps=1e-8, opt_betas=None,
+                               momentum=0.9, opt_impl=opt_impl)
+    return create_optimizer(
+        opt_args, model, skip_list=model.no_weight_decay(),
+        get_num_layer=assigner.get_layer_id if assigner is not None else None,
+        get_layer_scale=assigner.get_scale if assigner is not None else None,
+    )
+
+
+def set_grads(model, seed):
+    generator = torch.Generator().manual_seed(seed)
+    for param in model.parameters():
+        param.grad = torch.randn(param.shape, generator=generator) * 1e-2
+
+
+def schedule(optimizer, it):
+    # lr and weight decay assignment of the training loops
+    for param_group in optimizer.param_groups:
+        param_group["lr"] = 1e-3 * (0.9 ** it) * param_group["lr_scale"]
+        if param_group["weight_decay"] > 0:
+            param_group["weight_decay"] = 0.05 + 0.001 * it
+
+
+def check_equivalence(model, args, steps=5):
+    models = {impl: copy.deepcopy(model) for impl in IMPLS}
+    optimizers = {impl: build_optimizer(models[impl], impl, args) for impl in IMPLS}
+    for it in range(steps):
+        for impl in IMPLS:
+            set_grads(models[impl], it)
+            schedule(optimizers[impl], it)
+            optimizers[impl].step()
+
+    reference = dict(models["for_loop"].named_parameters())
+    for impl in IMPLS[1:]:
+        err = max((param - reference[name]).abs().max().item() for name, param in models[impl].named_parameters())
+        assert err < 1e-5, f"parameters of {impl} differ by {err}"
+        print(f"{impl}: parameters after {steps} steps match the per-parameter loop, max error {err:.2e}")
+
+
+def timed(func, iters):
+    func()
+    start = time.perf_counter()
+    for _ in range(iters):
+        func()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser("optimizer step benchmark")
+    parser.add_argument("--input_size", default=224, type=int)
+    parser.add_argument("--embed_dim", default=384, type=int)
+    parser.add_argument("--depth", default=12, type=int)
+    parser.add_argument("--layer_decay", default=0.75, type=float)
+    parser.add_argument("--threads", default=1, type=int)
+    parser.add_argument("--iters", default=10, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = build_model(args)
+    check_equivalence(model, args)
+
+    num_params = sum(p.numel() for p in model.parameters())
+    num_tensors = len(list(model.parameters()))
+    print(f"{num_tensors} parameter tensors, {num_params / 1e6:.1f}M parameters, layer decay {args.layer_decay}")
+
+    results = {}
+    for impl in IMPLS:
+        optimizer = build_optimizer(model, impl, args)
+        set_grads(model, 0)
+        results[impl] = timed(optimizer.step, args.iters)
+        print(f"{impl:<10} {len(optimizer.param_groups):>3} groups  {results[impl]:8.2f} ms/step "
+              f"({results['for_loop'] / results[impl]:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+packed-sequence pretraining of clips with different numbers of frames versus resampling every clip to num_frames
+
+- equivalence:  PretrainVisionTransformer.forward_packed() of packed clips matches the outputs of every clip on its own
+                (and forward() for a clip of num_frames frames),
+                with the tube masks of MaskGenerator.packed() and per-clip decode masks of sample_decode_mask(),
+                build_rgb_target() of the packed video matches the targets of every clip
+- throughput:   one training step (forward, backward) of a batch of clips of random lengths, packed, versus the same
+                batch with every clip resampled to num_frames as Egoclip does without packing
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_packed_pretraining --batch_size 8 --min_frames 4 --num_frames 16
+
+"""
+
+import time
+import argparse
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from masking_generator import MaskGenerator
+from modeling_pretrain import PretrainVisionTransformer
+from reconstruction_target import build_rgb_target, sample_decode_mask
+
+
+def build_model(args):
+    return PretrainVisionTransformer(
+        img_size=args.input_size, patch_size=16,
+        encoder_embed_dim=args.embed_dim, encoder_depth=args.depth, encoder_num_heads=args.embed_dim // 64,
+        decoder_embed_dim=args.embed_dim // 2, decoder_depth=2, decoder_num_heads=args.embed_dim // 128,
+        decoder_num_classes=3 * 2 * 16 * 16, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6),
+    )
+
+
+def check_equivalence(model, mask_generator, args):
+    h = w = args.input_size // 16
+    num_frames = [4, 16, 8, 8, 12]
+    clips = [torch.randn(3, t, args.input_size, args.input_size) for t in num_frames]
+    tubelets = [t // 2 for t in num_frames]
+    seqlens = [t * h * w for t in tubelets]
+
+    videos = torch.cat(clips, dim=1).unsqueeze(0)
+    mask = torch.from_numpy(mask_generator.packed(tubelets)[0]).to(torch.bool).reshape(1, -1)
+    decode_mask = sample_decode_mask(mask, 0.5, seqlens=seqlens)
+
+    masks, decode_masks = mask.split(seqlens, dim=1), decode_mask.split(seqlens, dim=1)
+    for m, d, t in zip(masks, decode_masks, tubelets):
+        assert m.sum() == t * int(0.75 * h * w), "tube mask ratio of a clip"
+        assert not (d & ~m).any() and d.sum() == round(int(m.sum()) * 0.5), "decode ratio of a clip"
+
+    with torch.no_grad():
+        packed = model(videos, mask, decode_mask=decode_mask, seqlens=seqlens)
+        # every clip alone, as a sequence of its own tokens only
+        single = [model(c[None], m, decode_mask=d, seqlens=[n]) for c, m, d, n in zip(clips, masks, decode_masks, seqlens)]
+        # the full length clip through the fixed length forward()
+        full = model(clips[1][None], masks[1], decode_mask=decode_masks[1])
+    err = (packed - torch.cat(single, dim=1)).abs().max().item()
+    assert err < 1e-4, f"packed outputs differ by {err}"
+    err_full = (single[1] - full).abs().max().item()
+    assert err_full < 1e-4, f"outputs of a full length clip differ by {err_full}"
+
+    target = build_rgb_target(videos, decode_mask)
+    single_target = torch.cat([build_rgb_target(c[None], d) for c, d in zip(clips, decode_masks)], dim=1)
+    assert torch.equal(target, single_target), "packed targets differ"
+    print(f"packed outputs of {len(clips)} clips of {num_frames} frames match, max error {err:.2e} "
+          f"({err_full:.2e} against forward() of the {num_frames[1]} frame clip)")
+
+
+def train_step(model, videos, mask, seqlens=None):
+    outputs = model(videos, mask, seqlens=seqlens)
+    labels = build_rgb_target(videos, mask)
+    loss = nn.functional.mse_loss(outputs, labels)
+    model.zero_grad()
+    loss.backward()
+
+
+def timed(func, iters):
+    func()
+    start = time.perf_counter()
+    for _ in range(iters):
+        func()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser("packed pretraining benchmark")
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--num_frames", default=16, type=int)
+    parser.add_argument("--min_frames", default=4, type=int)
+    parser.add_argument("--input_size", default=112, type=int)
+    parser.add_argument("--embed_dim", default=384, type=int)
+    parser.add_argument("--depth", default=4, type=int)
+    parser.add_argument("--iters", default=5, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = build_model(args).eval()
+    h = w = args.input_size // 16
+    mask_generator = MaskGenerator(["tube"], [(args.num_frames // 2, h, w)], [0.75])
+    check_equivalence(model, mask_generator, args)
+
+    model.train()
+    # clip lengths as given by Egoclip.clip_num_frames(): even, between min_frames and num_frames
+    num_frames = np.random.randint(args.min_frames // 2, args.num_frames // 2 + 1, size=args.batch_size) * 2
+    tubelets = (num_frames // 2).tolist()
+    seqlens = [t * h * w for t in tubelets]
+    packed_videos = torch.randn(1, 3, int(num_frames.sum()), args.input_size, args.input_size)
+    packed_mask = torch.from_numpy(mask_generator.packed(tubelets)[0]).to(torch.bool).reshape(1, -1)
+
+    videos = torch.randn(args.batch_size, 3, args.num_frames, args.input_size, args.input_size)
+    mask = torch.from_numpy(np.stack(mask_generator(args.batch_size)[0])).to(torch.bool)
+
+    resampled = timed(lambda: train_step(model, videos, mask), args.iters)
+    packed = timed(lambda: train_step(model, packed_videos, packed_mask, seqlens), args.iters)
+    print(f"clip lengths {num_frames.tolist()}")
+    print(f"resampled to {args.num_frames} frames: {mask.numel()} tokens, {resampled:.1f} ms/step")
+    print(f"packed: {sum(seqlens)} tokens, {packed:.1f} ms/step ({resampled / packed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
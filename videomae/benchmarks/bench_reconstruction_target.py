@@ -0,0 +1,119 @@
+"""
+time and memory of building reconstruction targets
+
+Compares the previous target construction in the pretraining loops (patchify and normalize all tokens,
+then select the masked ones) against reconstruction_target (gather masked tubelets, then normalize),
+and checks that both produce the same targets.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_reconstruction_target --device cuda --batch_size 16
+
+"""
+
+import time
+import argparse
+
+import torch
+from einops import rearrange
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+
+from reconstruction_target import build_rgb_target, build_flow_target
+
+
+@torch.no_grad()
+def dense_rgb_target(videos, mask, patch_size, normalize):
+    """ previous implementation in engine_for_pretraining """
+    device = videos.device
+    mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
+    std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
+    unnorm_videos = videos * std + mean
+
+    if normalize:
+        videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
+        videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
+            ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
+        videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
+    else:
+        videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
+
+    B, _, C = videos_patch.shape
+    return videos_patch[mask].reshape(B, -1, C)
+
+
+@torch.no_grad()
+def dense_flow_target(flows, mask, patch_size):
+    B = flows.shape[0]
+    flow_target = rearrange(flows, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
+    return rearrange(flow_target[mask], '(b n) d -> b n d', b=B)
+
+
+def random_mask(batch_size, num_tokens, mask_ratio, device):
+    num_mask = int(mask_ratio * num_tokens)
+    index = torch.rand(batch_size, num_tokens, device=device).argsort(dim=1)[:, :num_mask]
+    return torch.zeros(batch_size, num_tokens, dtype=torch.bool, device=device).scatter_(1, index, True)
+
+
+def measure(func, args, iters, device):
+    """
+        Return:
+            seconds per call, peak memory in MB (cuda only, None otherwise)
+    """
+    func(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+
+    start = time.perf_counter()
+    for _ in range(iters):
+        func(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak = None
+
+    return (time.perf_counter() - start) / iters, peak
+
+
+def main():
+    parser = argparse.ArgumentParser("reconstruction target benchmark")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--input_size", default=224, type=int)
+    parser.add_argument("--num_frames", default=16, type=int)
+    parser.add_argument("--patch_size", default=16, type=int)
+    parser.add_argument("--mask_ratios", default=[0.75, 0.9], type=float, nargs="+")
+    parser.add_argument("--iters", default=10, type=int)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    B, T, S, p = args.batch_size, args.num_frames, args.input_size, args.patch_size
+    videos = torch.randn(B, 3, T, S, S, device=device)
+    flows = torch.rand(B, 2, T // 2, S, S, device=device)
+    num_tokens = (T // 2) * (S // p) ** 2
+
+    for mask_ratio in args.mask_ratios:
+        mask = random_mask(B, num_tokens, mask_ratio, device)
+
+        cases = [
+            ("rgb (normalized)", dense_rgb_target, build_rgb_target, (videos, mask, p, True)),
+            ("rgb", dense_rgb_target, build_rgb_target, (videos, mask, p, False)),
+            ("flow", dense_flow_target, build_flow_target, (flows, mask, p)),
+        ]
+        for name, dense, masked, inputs in cases:
+            diff = (dense(*inputs) - masked(*inputs)).abs().max().item()
+            assert diff < 1e-4, f"{name}: targets differ by {diff}"
+
+            dense_time, dense_mem = measure(dense, inputs, args.iters, device)
+            masked_time, masked_mem = measure(masked, inputs, args.iters, device)
+            line = (f"mask ratio {mask_ratio:.2f} {name:>16}: dense {dense_time * 1000:.2f} ms, "
+                    f"masked {masked_time * 1000:.2f} ms ({dense_time / masked_time:.2f}x)")
+            if dense_mem is not None:
+                line += f", peak memory dense {dense_mem:.0f} MB, masked {masked_mem:.0f} MB"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
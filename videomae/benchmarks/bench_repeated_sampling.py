@@ -0,0 +1,108 @@
+"""
+per-sample time of repeated sampling in Epickitchens (DATA.REPEATED_SAMPLING views of one clip)
+
+- independent:  every view is decoded and augmented on its own with pack_frames_to_video_clip()
+                and DataAugmentationForVideoMAE, i.e. what real repeated augmentation costs without sharing
+- decode_once:  pack_repeated_views() decodes one wider window, DataAugmentationForVideoMAE.repeated()
+                crops and resizes all views from it
+
+Frames and u/v flow images of synthetic videos are written as jpeg files to a temporary directory
+in the epic-kitchens 100 layout.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_repeated_sampling --num_views 4 --num_frames 16
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+from datasets import DataAugmentationForVideoMAE
+from epickitchens import pack_frames_to_video_clip, pack_repeated_views
+
+
+def write_synthetic_video(root, num_frames, frame_size):
+    rng = np.random.default_rng(0)
+    rgb_dir = os.path.join(root, "P01", "rgb_frames", "P01_01")
+    os.makedirs(rgb_dir)
+    for d in ["u", "v"]:
+        os.makedirs(os.path.join(root, "P01", "flow_frames", "P01_01", d))
+
+    def smooth_noise(channels):
+        img = rng.integers(0, 256, (frame_size // 8, frame_size // 8, channels), dtype=np.uint8)
+        return Image.fromarray(img if channels == 3 else img[..., 0]).resize((frame_size * 4 // 3, frame_size), Image.BILINEAR)
+
+    for idx in range(1, num_frames + 1):
+        smooth_noise(3).save(os.path.join(rgb_dir, "frame_{:010d}.jpg".format(idx)), quality=90)
+    for idx in range(1, num_frames // 2 + 2):
+        for d in ["u", "v"]:
+            smooth_noise(1).save(os.path.join(root, "P01", "flow_frames", "P01_01", d, "frame_{:010d}.jpg".format(idx)), quality=90)
+
+
+def independent(cfg, record, transform, num_views):
+    frames, flows = [], []
+    for _ in range(num_views):
+        rgb, *flow = pack_frames_to_video_clip(cfg, record, as_pil=True)
+        rgb, flow = transform((rgb, flow))
+        frames.append(rgb.view((cfg.DATA.NUM_FRAMES, 3) + rgb.size()[-2:]).transpose(0, 1))
+        flows.append(flow)
+    return torch.stack(frames, dim=0), torch.stack(flows, dim=0)
+
+
+def decode_once(cfg, record, transform, num_views):
+    frames, flows, frame_views, flow_views = pack_repeated_views(cfg, record, num_views,
+                                                                 window_scale=cfg.DATA.REPEATED_SAMPLING_WINDOW)
+    return transform.repeated(frames, flows, frame_views, flow_views)
+
+
+def main():
+    parser = argparse.ArgumentParser("repeated sampling benchmark")
+    parser.add_argument("--num_views", default=4, type=int)
+    parser.add_argument("--num_frames", default=16, type=int)
+    parser.add_argument("--sampling_rate", default=2, type=int)
+    parser.add_argument("--window_scale", default=1.5, type=float)
+    parser.add_argument("--video_frames", default=240, type=int)
+    parser.add_argument("--frame_size", default=256, type=int)
+    parser.add_argument("--input_size", default=224, type=int)
+    parser.add_argument("--iters", default=20, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_video(tmp_dir, args.video_frames, args.frame_size)
+        cfg = SimpleNamespace(
+            VERSION=100, ONINE_EXTRACTING=False,
+            EPICKITCHENS=SimpleNamespace(VISUAL_DATA_DIR=tmp_dir),
+            DATA=SimpleNamespace(NUM_FRAMES=args.num_frames, SAMPLING_RATE=args.sampling_rate,
+                                 REPEATED_SAMPLING=args.num_views, REPEATED_SAMPLING_WINDOW=args.window_scale),
+        )
+        # odd start frame so that every sampled pair has its flow image
+        record = SimpleNamespace(participant="P01", untrimmed_video_name="P01_01", fps=60,
+                                 start_frame=1, num_frames=args.video_frames - 2)
+        transform = DataAugmentationForVideoMAE(SimpleNamespace(input_size=args.input_size))
+
+        times = {}
+        for name, func in [("independent", independent), ("decode_once", decode_once)]:
+            frames, flows = func(cfg, record, transform, args.num_views)
+            start = time.perf_counter()
+            for _ in range(args.iters):
+                func(cfg, record, transform, args.num_views)
+            times[name] = (time.perf_counter() - start) / args.iters * 1000
+            print(f"{name:>12}: {times[name]:.1f} ms/sample, frames {tuple(frames.shape)}, flows {tuple(flows.shape)}")
+        print(f"speedup: {times['independent'] / times['decode_once']:.2f}x")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+decode throughput of kinetics.VideoClsDataset with pooled decord readers and planned get_batch calls
+
+- test:   every temporal/spatial view of a video (test_num_segment x test_num_crop samples). Previously each
+          view opened a new VideoReader and decoded every frame_sample_rate-th frame of the whole video,
+          now the frames of all temporal views are decoded by one get_batch call and reused by the other views
+- train:  random clips of random videos, a new VideoReader per sample versus the per-process reader pool
+- order:  get_batch of shuffled frame indices versus the ascending order of plan_decode_order(), with the
+          number of GOPs entered (counted from the key frame indices of the video)
+
+Synthetic mp4 files (h264, one key frame every --gop frames) are written to a temporary directory with PyAV
+unless --data_dir is given.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_video_decode --num_videos 8 --video_frames 300
+
+"""
+
+import os
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from decord import VideoReader, cpu
+
+import kinetics
+from kinetics import VideoClsDataset, get_frames, plan_decode_order
+
+
+def write_synthetic_videos(data_dir, num_videos, num_frames, width, height, gop):
+    import av
+
+    rng = np.random.default_rng(0)
+    for v in range(num_videos):
+        with av.open(os.path.join(data_dir, f"video_{v}.mp4"), "w") as container:
+            stream = container.add_stream("libx264", rate=30)
+            stream.width, stream.height, stream.pix_fmt = width, height, "yuv420p"
+            stream.options = {"g": str(gop), "keyint_min": str(gop), "sc_threshold": "0"}
+            base = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+            base = np.repeat(np.repeat(base, 8, axis=0), 8, axis=1)
+            for i in range(num_frames):
+                frame = av.VideoFrame.from_ndarray(np.roll(base, i, axis=1), format="rgb24")
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+
+
+def previous_loadvideo_test(dataset, fname):
+    """ previous test mode of loadvideo_decord: new reader, every frame_sample_rate-th frame of the video """
+    vr = VideoReader(fname, num_threads=1, ctx=cpu(0))
+    all_index = [x for x in range(0, len(vr), dataset.frame_sample_rate)]
+    while len(all_index) < dataset.clip_len:
+        all_index.append(all_index[-1])
+    vr.seek(0)
+    return vr.get_batch(all_index).asnumpy()
+
+
+def previous_test_view(dataset, fname, chunk_nb):
+    buffer = previous_loadvideo_test(dataset, fname)
+    temporal_step = max(1.0 * (buffer.shape[0] - dataset.clip_len) / (dataset.test_num_segment - 1), 0)
+    temporal_start = int(chunk_nb * temporal_step)
+    return buffer[temporal_start:temporal_start + dataset.clip_len]
+
+
+def build_dataset(mode, videos, args):
+    anno_path = os.path.join(args.tmp_dir, f"{mode}.csv")
+    with open(anno_path, "w") as f:
+        f.write("path,label\n")
+        f.writelines(f"{path},0\n" for path in videos)
+    return VideoClsDataset(anno_path, "", mode=mode, clip_len=args.clip_len, frame_sample_rate=args.sampling_rate,
+                           test_num_segment=args.test_num_segment, test_num_crop=args.test_num_crop,
+                           args=SimpleNamespace(reprob=0))
+
+
+def gops_entered(key_indices, order):
+    """ number of times decoding has to start from a key frame, decoding forward from the previous frame """
+    gops = np.searchsorted(key_indices, order, side="right") - 1
+    entered, current, position = 0, -1, -1
+    for gop, frame in zip(gops, order):
+        if gop != current or frame < position:
+            entered += 1
+            current = gop
+        position = frame
+    return entered
+
+
+def main():
+    parser = argparse.ArgumentParser("video decode benchmark")
+    parser.add_argument("--data_dir", default="", type=str, help="directory of mp4 files")
+    parser.add_argument("--num_videos", default=8, type=int)
+    parser.add_argument("--video_frames", default=300, type=int)
+    parser.add_argument("--width", default=340, type=int)
+    parser.add_argument("--height", default=256, type=int)
+    parser.add_argument("--gop", default=32, type=int, help="key frame interval of synthetic videos")
+    parser.add_argument("--clip_len", default=16, type=int)
+    parser.add_argument("--sampling_rate", default=4, type=int)
+    parser.add_argument("--test_num_segment", default=5, type=int)
+    parser.add_argument("--test_num_crop", default=3, type=int)
+    parser.add_argument("--train_samples", default=64, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    args.tmp_dir = tempfile.mkdtemp()
+    try:
+        if not args.data_dir:
+            args.data_dir = os.path.join(args.tmp_dir, "data")
+            os.makedirs(args.data_dir)
+            write_synthetic_videos(args.data_dir, args.num_videos, args.video_frames, args.width, args.height, args.gop)
+        videos = sorted(glob.glob(os.path.join(args.data_dir, "*.mp4")))
+
+        # test: all views of every video
+        dataset = build_dataset("test", videos, args)
+        start = time.perf_counter()
+        for index in range(len(dataset)):
+            previous_test_view(dataset, dataset.test_dataset[index], dataset.test_seg[index][0])
+        previous = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in range(len(dataset)):
+            dataset.loadvideo_decord(dataset.test_dataset[index], chunk_nb=dataset.test_seg[index][0])
+        pooled = time.perf_counter() - start
+
+        for index in range(len(dataset)):
+            fname, chunk_nb = dataset.test_dataset[index], dataset.test_seg[index][0]
+            assert np.array_equal(previous_test_view(dataset, fname, chunk_nb),
+                                  dataset.loadvideo_decord(fname, chunk_nb=chunk_nb)), f"view {index} differs"
+        print(f"test views: previous {len(dataset) / previous:.1f} views/s, planned {len(dataset) / pooled:.1f} views/s "
+              f"({previous / pooled:.1f}x)")
+
+        # train: random clips, new reader per sample versus the reader pool
+        dataset = build_dataset("train", videos, args)
+        rng = np.random.default_rng(0)
+        samples = [videos[i] for i in rng.integers(len(videos), size=args.train_samples)]
+        times = []
+        for pool_size in [0, len(videos)]:
+            kinetics._reader_pool = kinetics.VideoReaderPool(max_readers=pool_size)
+            start = time.perf_counter()
+            for fname in samples:
+                dataset.loadvideo_decord(fname)
+            times.append(time.perf_counter() - start)
+        print(f"train clips: new reader {len(samples) / times[0]:.1f} clips/s, "
+              f"pooled readers {len(samples) / times[1]:.1f} clips/s ({times[0] / times[1]:.1f}x)")
+
+        # order: shuffled indices versus planned order
+        vr = VideoReader(videos[0], num_threads=1, ctx=cpu(0))
+        key_indices = vr.get_key_indices()
+        indices = rng.choice(len(vr), size=min(64, len(vr)), replace=False)
+        order, _ = plan_decode_order(indices)
+        times = []
+        for batch in [indices.tolist(), None]:
+            start = time.perf_counter()
+            if batch is None:
+                get_frames(vr, indices)
+            else:
+                vr.seek(0)
+                vr.get_batch(batch).asnumpy()
+            times.append(time.perf_counter() - start)
+        print(f"{len(indices)} random frames: shuffled {times[0] * 1000:.1f} ms "
+              f"({gops_entered(key_indices, indices)} GOPs entered), planned {times[1] * 1000:.1f} ms "
+              f"({gops_entered(key_indices, order)} GOPs entered)")
+    finally:
+        shutil.rmtree(args.tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
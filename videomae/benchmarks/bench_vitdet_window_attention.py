@@ -0,0 +1,114 @@
+"""
+forward time of Ego4dGeneralizedRCNN with the fused window attention path of VitDet
+
+The previous path partitions/unpartitions the tokens in every window attention block, runs the explicit
+softmax(q @ k^T) @ v attention and copies the position table to the device at every forward. The fused
+path keeps the tokens in window order across consecutive window blocks, calls
+F.scaled_dot_product_attention and caches the position table / padding mask per input size.
+
+The model is built from the ego4d_detection config, inputs are random clips with random boxes.
+
+Usage (from videomae/):
+
+    python -m benchmarks.bench_vitdet_window_attention --device cuda --batch_size 8
+
+"""
+
+import time
+import argparse
+
+import torch
+from detectron2.config import instantiate
+from detectron2.structures import Boxes, Instances
+
+import ego4d_detection
+
+
+def random_inputs(batch_size, img_size, device):
+    batched_inputs = []
+    for _ in range(batch_size):
+        xy = torch.rand(4, 2) * img_size / 2
+        wh = torch.rand(4, 2) * img_size / 2 + 8
+        instances = Instances((img_size, img_size))
+        instances.gt_boxes = Boxes(torch.cat([xy, xy + wh], dim=1))
+        instances.gt_classes = torch.zeros(4, dtype=torch.long)
+        batched_inputs.append({
+            "image": torch.randint(0, 256, (3, img_size, img_size), dtype=torch.uint8),
+            "vit_input": torch.randn(3, 2, img_size, img_size, device=device),
+            "height": img_size,
+            "width": img_size,
+            "instances": instances,
+        })
+    return batched_inputs
+
+
+def timed_steps(func, iters, warmup, device):
+    for _ in range(warmup):
+        func()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        func()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser("VitDet window attention benchmark")
+    parser.add_argument("--device", default="cuda", type=str)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--window_size", default=0, type=int, help="0 keeps the window size of the config")
+    parser.add_argument("--iters", default=20, type=int)
+    parser.add_argument("--warmup", default=5, type=int)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    cfg = ego4d_detection.model
+    cfg.backbone.net.img_size = args.img_size
+    cfg.backbone.square_pad = args.img_size
+    if args.window_size > 0:
+        cfg.backbone.net.window_size = args.window_size
+    model = instantiate(cfg).to(device)
+    vitdet = model.backbone.net
+
+    batched_inputs = random_inputs(args.batch_size, args.img_size, device)
+    vit_input = model._backbone_pre_process_input(batched_inputs)
+
+    # equivalence of the backbone features
+    vitdet.eval()
+    with torch.no_grad():
+        vitdet.set_fused_window_attention(False)
+        reference = vitdet(vit_input)["last_feat"]
+        vitdet.set_fused_window_attention(True)
+        fused = vitdet(vit_input)["last_feat"]
+    print(f"max abs diff of backbone features: {(reference - fused).abs().max().item():.2e}")
+
+    def backbone_forward():
+        with torch.no_grad():
+            vitdet(vit_input)
+
+    def train_forward():
+        with torch.no_grad():
+            model(batched_inputs)
+
+    def train_step():
+        losses = model(batched_inputs)
+        sum(losses.values()).backward()
+
+    print(f"{'':>26} {'previous':>10} {'fused':>10}")
+    for name, func, training in [("backbone forward (ms)", backbone_forward, False),
+                                 ("rcnn forward (ms)", train_forward, True),
+                                 ("rcnn forward+backward (ms)", train_step, True)]:
+        model.train(training)
+        times = []
+        for enabled in [False, True]:
+            vitdet.set_fused_window_attention(enabled)
+            times.append(timed_steps(func, args.iters, args.warmup, device) * 1000)
+        print(f"{name:>26} {times[0]:>10.1f} {times[1]:>10.1f} ({times[0] / times[1]:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+synthetic datasets for the benchmark suite, written to a (temporary) directory
+
+- egoclip:       egoclip.csv and frames.zip / flows.zip of every clip in the layout read by ego4d.Egoclip
+- epickitchens:  a csv annotation list and one rgb and one flow zip per segment in the epic-kitchens 100 layout
+                 read by epickitchens.pack_frames_to_video_clip with DATA.READ_FROM_ZIP
+- merge:         per-rank prediction files of final_test() read by engine_for_finetuning.merge
+
+Frames are jpeg images of upsampled noise so that their size and decode time are close to real frames.
+"""
+
+import io
+import os
+import zipfile
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+
+def jpeg_bytes(rng, width, height, channels=3, quality=90):
+    img = rng.integers(0, 256, (height // 8, width // 8, channels), dtype=np.uint8)
+    img = Image.fromarray(img if channels == 3 else img[..., 0]).resize((width, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def write_zip(path, members):
+    # frames are stored as they are, as by the preprocessing scripts
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+
+
+def write_egoclip(root, num_clips=4, clip_frames=48, width=340, height=256, seed=0):
+    """
+        Return:
+            cfg: Namespace, dataset config of Egoclip for pretraining
+    """
+    rng = np.random.default_rng(seed)
+    ann_dir, frame_dir = os.path.join(root, "annotations"), os.path.join(root, "egoclip")
+    os.makedirs(ann_dir)
+
+    rows = ["video_uid\tvideo_dur\tnarration_source\tnarration_ind\tnarration_time\tclip_start\tclip_end\tclip_text"]
+    for clip in range(num_clips):
+        uid = f"video{clip:04d}"
+        start = 30 * clip
+        # clip_start/clip_end in seconds, frames are numbered at 30 fps
+        rows.append(f"{uid}\t600\tnarration_pass_1\t{clip}\t{start / 30 + 1:.3f}\t{start / 30:.3f}\t"
+                    f"{(start + clip_frames - 1) / 30:.3f}\t#C C picks a knife")
+
+        clip_dir = os.path.join(frame_dir, uid, f"{uid}_00000")
+        os.makedirs(clip_dir)
+        write_zip(os.path.join(clip_dir, "frames.zip"), [
+            (f"frame_{i:010d}_{start + i:010d}.jpg", jpeg_bytes(rng, width, height)) for i in range(clip_frames)
+        ])
+        write_zip(os.path.join(clip_dir, "flows.zip"), [
+            (f"{d}/frame_{i:010d}_{start + i:010d}.jpg", jpeg_bytes(rng, width, height, channels=1))
+            for d in ["u", "v"] for i in range(clip_frames - 1)
+        ])
+
+    with open(os.path.join(ann_dir, "egoclip.csv"), "w") as f:
+        f.write("\n".join(rows) + "\n")
+
+    return SimpleNamespace(
+        ANN_DIR=ann_dir, FRAME_DIR_PATH=frame_dir, NUM_FRAMES=16,
+        MEAN=[0.485, 0.456, 0.406], STD=[0.229, 0.224, 0.225],
+        repeat_sample=1, short_side_size=256, input_size=224,
+        task="egoclip", load_flow="local",
+    )
+
+
+def write_epickitchens(root, num_segments=4, segment_frames=240, width=340, height=256, seed=0):
+    """
+        Return:
+            cfg: Namespace, dataset config of Epickitchens (version 100) reading frames from zip files
+    """
+    rng = np.random.default_rng(seed)
+    rgb_dir = os.path.join(root, "P01", "rgb_frames", "P01_101")
+    flow_dir = os.path.join(root, "P01", "flow_frames", "P01_101")
+    os.makedirs(rgb_dir)
+    os.makedirs(flow_dir)
+
+    rows = []
+    fps = 50
+    for segment in range(num_segments):
+        index = f"P01_101_{segment}"
+        start = 60 * fps * segment + fps
+        stop = start + segment_frames
+        timestamp = lambda frame: "{:02d}:{:05.2f}".format(frame // fps // 60, frame / fps % 60)
+        # narration_id, participant_id, video_id, narration_timestamp, start, stop, ..., verb_class, ..., noun_class
+        rows.append([index, "P01", "P01_101", "", timestamp(start), timestamp(stop), "", "", "", "", "1", "", "2"])
+
+        # archives are named <video_id>_<narration_id>, indexes sampled by temporal_sampling lie in
+        # [start_frame + 1, end_frame + 1]
+        write_zip(os.path.join(rgb_dir, f"P01_101_{index}.zip"), [
+            ("frame_{:010d}.jpg".format(idx), jpeg_bytes(rng, width, height)) for idx in range(start, stop + 2)
+        ])
+        write_zip(os.path.join(flow_dir, f"P01_101_{index}.zip"), [
+            ("{}/frame_{:010d}.jpg".format(d, idx), jpeg_bytes(rng, width, height, channels=1))
+            for d in ["u", "v"] for idx in range(start // 2, stop // 2 + 3)
+        ])
+
+    with open(os.path.join(root, "train.csv"), "w") as f:
+        f.writelines(",".join(row) + "\n" for row in rows)
+
+    return SimpleNamespace(
+        VERSION=100, ONINE_EXTRACTING=False,
+        EPICKITCHENS=SimpleNamespace(VISUAL_DATA_DIR=root, ANNOTATIONS_DIR=root, TRAIN_LIST="train.csv", VAL_LIST=""),
+        DATA=SimpleNamespace(NUM_FRAMES=16, SAMPLING_RATE=2, REPEATED_SAMPLING=0, READ_FROM_ZIP=True),
+    )
+
+
+def write_merge_outputs(root, num_tasks=2, num_videos=64, num_views=6, num_classes=400, seed=0):
+    """ prediction files 0.txt, ..., {num_tasks-1}.txt, every view of a video is written by one rank """
+    rng = np.random.default_rng(seed)
+    files = [open(os.path.join(root, f"{rank}.txt"), "w") for rank in range(num_tasks)]
+    for f in files:
+        f.write("0.0, 0.0\n")   # acc1, acc5 header line
+    for video in range(num_videos):
+        label = int(rng.integers(num_classes))
+        for view in range(num_views):
+            logits = rng.standard_normal(num_classes).round(4).tolist()
+            files[(video * num_views + view) % num_tasks].write(
+                f"video_{video} {logits} {label} {view // 3} {view % 3}\n")
+    for f in files:
+        f.close()
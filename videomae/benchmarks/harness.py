@@ -0,0 +1,225 @@
+"""
+registry, timing and json results of the benchmark suite (see suite.py)
+
+A benchmark is a setup function registered with @benchmark(name, group). It is called once with the
+run context, prepares its inputs outside of the timed region and returns the callable to be timed.
+Raising SkipBenchmark (or ImportError for a missing optional dependency) records the benchmark as skipped.
+
+Results are written as json:
+
+    {
+        "meta": {"commit": ..., "torch": ..., "threads": ..., ...},
+        "results": {
+            "<name>": {"group": ..., "median_ms": ..., "min_ms": ..., "mean_ms": ..., "repeat": ..., "number": ...},
+            "<skipped name>": {"group": ..., "skipped": "<reason>"},
+        }
+    }
+
+Two result files are compared with a relative regression threshold on the median time:
+
+    python -m benchmarks.harness old.json new.json --threshold 0.1
+
+"""
+
+import sys
+import json
+import time
+import math
+import argparse
+import platform
+import statistics
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+BENCHMARKS = OrderedDict()
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Benchmark(object):
+    def __init__(self, name, group, setup, repeat=None):
+        self.name = name
+        self.group = group
+        self.setup = setup
+        self.repeat = repeat
+
+
+def benchmark(name, group, repeat=None):
+    """
+        register a benchmark
+
+        Parameters:
+            name: str, unique name, the key of the results
+            group: str, group used to select benchmarks, e.g. data, masking, model
+            repeat: int, number of timed repeats, the value of the run context if None
+    """
+    def register(setup):
+        assert name not in BENCHMARKS, f"benchmark {name} registered twice"
+        BENCHMARKS[name] = Benchmark(name, group, setup, repeat)
+        return setup
+    return register
+
+
+def measure(func, repeat=10, min_time=0.05, warmup=1):
+    """
+        time func like timeit.autorange: each of the repeats calls func number times, number being
+        chosen so that a repeat takes at least min_time seconds
+
+        Return:
+            dict, statistics of the time of one call in milliseconds
+    """
+    for _ in range(warmup):
+        func()
+
+    start = time.perf_counter()
+    func()
+    once = time.perf_counter() - start
+    number = max(1, math.ceil(min_time / max(once, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number * 1000)
+
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "mean_ms": statistics.mean(times),
+        "stdev_ms": statistics.stdev(times) if len(times) > 1 else 0.,
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_meta():
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def run_benchmarks(ctx, names=None, groups=None, repeat=10, min_time=0.05, log=print):
+    """
+        run registered benchmarks
+
+        Parameters:
+            ctx: object passed to every setup function
+            names: list of str, substrings of the names of benchmarks to run, all if None
+            groups: list of str, groups of benchmarks to run, all if None
+
+        Return:
+            dict, results keyed by benchmark name
+    """
+    results = OrderedDict()
+    for bench in BENCHMARKS.values():
+        if groups and bench.group not in groups:
+            continue
+        if names and not any(name in bench.name for name in names):
+            continue
+
+        try:
+            func = bench.setup(ctx)
+            result = measure(func, repeat=bench.repeat or repeat, min_time=min_time)
+        except (SkipBenchmark, ImportError) as e:
+            result = {"skipped": f"{type(e).__name__}: {e}"}
+            log(f"{bench.name:<48} skipped ({result['skipped']})")
+        else:
+            log(f"{bench.name:<48} {result['median_ms']:>10.3f} ms  (min {result['min_ms']:.3f}, "
+                f"{result['repeat']}x{result['number']})")
+        results[bench.name] = {"group": bench.group, **result}
+
+    return results
+
+
+def save_results(path, results, meta=None):
+    with open(path, "w") as f:
+        json.dump({"meta": meta or run_meta(), "results": results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, threshold=0.1, key="median_ms"):
+    """
+        compare two result dicts (the "results" of two json files)
+
+        Parameters:
+            threshold: float, relative slowdown above which a benchmark is a regression
+            key: str, statistic that is compared
+
+        Return:
+            rows: list of (name, baseline ms, current ms, ratio, status), status is one of
+                  regression, improvement, ok, skipped, new, removed
+    """
+    rows = []
+    for name in list(baseline.keys()) + [name for name in current.keys() if name not in baseline]:
+        old, new = baseline.get(name), current.get(name)
+        if old is None or new is None:
+            rows.append((name, None, None, None, "new" if old is None else "removed"))
+        elif key not in old or key not in new:
+            rows.append((name, old.get(key), new.get(key), None, "skipped"))
+        else:
+            ratio = new[key] / old[key] if old[key] > 0 else math.inf
+            if ratio > 1 + threshold:
+                status = "regression"
+            elif ratio < 1 / (1 + threshold):
+                status = "improvement"
+            else:
+                status = "ok"
+            rows.append((name, old[key], new[key], ratio, status))
+    return rows
+
+
+def print_comparison(rows, threshold, log=print):
+    log(f"{'benchmark':<48} {'baseline':>11} {'current':>11} {'ratio':>7}  status (threshold {threshold:.0%})")
+    for name, old, new, ratio, status in rows:
+        fmt = lambda value: f"{value:>8.3f} ms" if value is not None else f"{'-':>11}"
+        log(f"{name:<48} {fmt(old)} {fmt(new)} {ratio if ratio is not None else float('nan'):>7.2f}  {status}")
+
+    regressions = [row[0] for row in rows if row[4] == "regression"]
+    if regressions:
+        log(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("compare two benchmark result files")
+    parser.add_argument("baseline", type=str, help="json results of the reference commit")
+    parser.add_argument("current", type=str, help="json results to check")
+    parser.add_argument("--threshold", default=0.1, type=float, help="relative slowdown reported as a regression")
+    parser.add_argument("--key", default="median_ms", choices=["median_ms", "min_ms", "mean_ms"])
+    args = parser.parse_args()
+
+    baseline, current = load_results(args.baseline), load_results(args.current)
+    print(f"baseline {baseline['meta'].get('commit')}, current {current['meta'].get('commit')}")
+    rows = compare_results(baseline["results"], current["results"], args.threshold, args.key)
+    regressions = print_comparison(rows, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
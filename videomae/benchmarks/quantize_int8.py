@@ -0,0 +1,107 @@
+"""
+calibration and report of post-training int8 quantization for CPU inference
+
+Calibrates the static quantization of a finetuned OSCC/PNR or LTA checkpoint on a random subset of
+its validation set, saves the calibrated int8 state_dict (used by test_on_ego4d --quantize static
+--quantized_ckpt) and reports the validation score and clips/s of the fp32 and int8 models on cpu.
+
+Arguments other than the ones below are parsed by run_class_finetuning, so the configuration file
+of the finetuning run is used as it is.
+
+Usage (from videomae/):
+
+    python -m benchmarks.quantize_int8 --ckpt /path/to/checkpoint-best.pth --mode static \
+        --output /path/to/checkpoint-int8.pth --config configs/oscc.yml
+
+"""
+
+import sys
+import copy
+import argparse
+
+import torch
+
+from datasets import build_dataset
+from utils import samples_collate_fho
+from quantization import quantize_model
+from engine_for_finetuning import validation_one_epoch
+from loss import ActionAnticipationLoss
+from config_utils import parse_yml, combine
+import run_class_finetuning
+from benchmarks.sweep_token_merging import build_model, throughput
+
+
+def get_quant_args():
+    parser = argparse.ArgumentParser("int8 quantization", add_help=False)
+    parser.add_argument("--ckpt", required=True, help="finetuned fp32 checkpoint")
+    parser.add_argument("--mode", default="static", choices=["dynamic", "static"])
+    parser.add_argument("--backend", default="fbgemm", type=str, help="fbgemm/x86 for x86 cpus, qnnpack for arm cpus")
+    parser.add_argument("--calib_batches", default=16, type=int, help="number of validation batches for calibration")
+    parser.add_argument("--eval_samples", default=0, type=int,
+                        help="number of validation samples to evaluate, 0 for the whole validation set")
+    parser.add_argument("--num_threads", default=0, type=int, help="cpu threads, 0 keeps the torch default")
+    parser.add_argument("--throughput_iters", default=10, type=int)
+    parser.add_argument("--output", default="", help="path to save the calibrated int8 state_dict")
+    quant_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args, _ = run_class_finetuning.get_args()
+    config = parse_yml(args.config)
+    if config is not None:
+        args = combine(args, config)
+
+    return quant_args, args
+
+
+def build_loader(dataset, args, indices):
+    if indices is not None:
+        dataset = torch.utils.data.Subset(dataset, indices)
+
+    return torch.utils.data.DataLoader(
+        dataset, sampler=torch.utils.data.SequentialSampler(dataset),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        drop_last=False,
+        collate_fn=samples_collate_fho,
+    )
+
+
+def main():
+    quant_args, args = get_quant_args()
+    device = torch.device("cpu")
+    if quant_args.num_threads > 0:
+        torch.set_num_threads(quant_args.num_threads)
+
+    dataset_val, num_classes = build_dataset(mode="val", args=args, flow_extractor=None)
+    generator = torch.Generator().manual_seed(args.seed)
+    permutation = torch.randperm(len(dataset_val), generator=generator).tolist()
+    calib_loader = build_loader(dataset_val, args, permutation[:quant_args.calib_batches * args.batch_size])
+    eval_loader = build_loader(dataset_val, args, sorted(permutation[:quant_args.eval_samples])
+                               if quant_args.eval_samples > 0 else None)
+
+    if "lta" in args.cfg.task:
+        criterion = ActionAnticipationLoss(celoss="", head_type=args.head_type)
+    else:
+        criterion = torch.nn.CrossEntropyLoss()
+
+    model = build_model(args, num_classes, quant_args.ckpt).eval()
+    quantized = quantize_model(copy.deepcopy(model), quant_args.mode, data_loader=calib_loader,
+                               num_calib_batches=quant_args.calib_batches, backend=quant_args.backend)
+    if quant_args.output:
+        torch.save(quantized.state_dict(), quant_args.output)
+        print(f"Save calibrated int8 state_dict to {quant_args.output}")
+
+    report = {}
+    for name, m in [("fp32", model), ("int8", quantized)]:
+        stats = validation_one_epoch(eval_loader, m, device, criterion, task=args.cfg.task)
+        report[name] = (stats["score"], throughput(m, eval_loader, device, quant_args.throughput_iters))
+
+    (fp32_score, fp32_speed), (int8_score, int8_speed) = report["fp32"], report["int8"]
+    print(f"{'':>6} {'score':>10} {'clips/s':>10}")
+    print(f"{'fp32':>6} {fp32_score:>10.3f} {fp32_speed:>10.2f}")
+    print(f"{'int8':>6} {int8_score:>10.3f} {int8_speed:>10.2f}")
+    print(f"score delta: {int8_score - fp32_score:+.3f}, speedup: {int8_speed / fp32_speed:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
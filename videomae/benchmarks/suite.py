@@ -0,0 +1,381 @@
+"""
+CPU microbenchmark suite of data loading, masking, evaluation and model step time, results are written as json
+and can be compared against the results of another commit (see harness.py)
+
+- data:     Egoclip / Epickitchens samples read from synthetic zip fixtures, DataAugmentationForVideoMAE
+- masking:  every masking generator, for fixed length and packed clips
+- misc:     get_sinusoid_encoding_table, built and cached
+- eval:     engine_for_finetuning.merge of per-rank prediction files, lta_metric, hands_metric, top-k accuracy
+- model:    forward + backward step of tiny configs of each pretraining model
+- optim:    AdamW step of create_optimizer() with layer decay, per-parameter loop and default implementation
+
+Usage (from videomae/):
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --groups masking model --compare results.json --threshold 0.1
+
+With --compare the exit status is 1 if a benchmark is slower than in the given results by more than the threshold.
+Timings are taken with --threads torch threads (1 by default) so that results of different machines loads are
+comparable, compare results of the same machine only.
+"""
+
+import io
+import os
+import shutil
+import contextlib
+import argparse
+import tempfile
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from benchmarks import fixtures
+from benchmarks.harness import (
+    benchmark, run_benchmarks, run_meta, save_results, load_results, compare_results, print_comparison,
+)
+
+
+def fixture(ctx, name, build):
+    """ fixtures are written once per run and shared by the benchmarks that read them """
+    if name not in ctx.fixtures:
+        root = os.path.join(ctx.tmp_dir, name)
+        os.makedirs(root)
+        ctx.fixtures[name] = build(root)
+    return ctx.fixtures[name]
+
+
+def cycle(func, n):
+    """ callable calling func(0), func(1), ..., func(n - 1), func(0), ... """
+    state = {"i": 0}
+
+    def call():
+        out = func(state["i"] % n)
+        state["i"] += 1
+        return out
+    return call
+
+
+def pil_clip(num_frames, width=340, height=256, seed=0):
+    rng = np.random.default_rng(seed)
+    rgb = [Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)) for _ in range(num_frames)]
+    flows = [[Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8)) for _ in range(num_frames // 2)]
+             for _ in range(2)]
+    return rgb, flows
+
+
+def video_transform(input_size=224):
+    from datasets import DataAugmentationForVideoMAE
+    return DataAugmentationForVideoMAE(SimpleNamespace(input_size=input_size))
+
+
+############# data #############
+
+def egoclip_dataset(ctx, packed=False):
+    from ego4d import Egoclip
+
+    cfg = fixture(ctx, "egoclip", fixtures.write_egoclip)
+    cfg = SimpleNamespace(**{**vars(cfg), "PACKED": packed})
+    return Egoclip("train", cfg, pretrain=True, pretrain_transform=video_transform(),
+                   output_path=ctx.tmp_dir, rank="0_0")
+
+
+@benchmark("data/egoclip_sample", "data")
+def bench_egoclip_sample(ctx):
+    dataset = egoclip_dataset(ctx)
+    return cycle(dataset.__getitem__, len(dataset))
+
+
+@benchmark("data/egoclip_sample_packed", "data")
+def bench_egoclip_sample_packed(ctx):
+    dataset = egoclip_dataset(ctx, packed=True)
+    return cycle(dataset.__getitem__, len(dataset))
+
+
+def epickitchens_dataset(ctx, repeated_sampling=0):
+    from epickitchens import Epickitchens
+
+    cfg = fixture(ctx, "epickitchens", fixtures.write_epickitchens)
+    cfg = SimpleNamespace(**vars(cfg))
+    cfg.DATA = SimpleNamespace(**{**vars(cfg.DATA), "REPEATED_SAMPLING": repeated_sampling})
+    return Epickitchens(cfg, "train", pretrain_transform=video_transform())
+
+
+@benchmark("data/epickitchens_sample", "data")
+def bench_epickitchens_sample(ctx):
+    dataset = epickitchens_dataset(ctx)
+    return cycle(dataset.__getitem__, len(dataset))
+
+
+@benchmark("data/epickitchens_sample_repeated4", "data")
+def bench_epickitchens_sample_repeated(ctx):
+    dataset = epickitchens_dataset(ctx, repeated_sampling=4)
+    return cycle(dataset.__getitem__, len(dataset))
+
+
+@benchmark("data/augmentation_videomae", "data")
+def bench_augmentation(ctx):
+    transform = video_transform()
+    rgb, flows = pil_clip(16)
+    return lambda: transform((rgb, flows))
+
+
+@benchmark("data/augmentation_videomae_repeated4", "data")
+def bench_augmentation_repeated(ctx):
+    transform = video_transform()
+    frames = torch.randint(0, 256, (24, 256, 340, 3), dtype=torch.uint8)
+    flows = torch.randint(0, 256, (12, 256, 340, 2), dtype=torch.uint8)
+    frame_views = torch.stack([torch.arange(16) + i * 2 for i in range(4)])
+    flow_views = torch.stack([torch.arange(8) + i for i in range(4)])
+    return lambda: transform.repeated(frames, flows, frame_views, flow_views)
+
+
+############# masking #############
+
+MASK_INPUT_SIZE = (8, 14, 14)
+
+
+def masking_generator(mask_type, mask_ratio):
+    from masking_generator import MaskGenerator
+    return MaskGenerator([mask_type], [MASK_INPUT_SIZE], [mask_ratio])
+
+
+@benchmark("masking/tube_b64", "masking")
+def bench_tube_mask(ctx):
+    return partial(masking_generator("tube", 0.9), 64)
+
+
+@benchmark("masking/agnostic_b64", "masking")
+def bench_agnostic_mask(ctx):
+    return partial(masking_generator("agnostic", 0.9), 64)
+
+
+@benchmark("masking/multimodal_b64", "masking")
+def bench_multimodal_mask(ctx):
+    return partial(masking_generator("multimodal", 0.9), 64)
+
+
+@benchmark("masking/tube_packed_b64", "masking")
+def bench_tube_mask_packed(ctx):
+    frames = np.random.default_rng(0).integers(2, 9, size=64).tolist()
+    return partial(masking_generator("tube", 0.9).packed, frames)
+
+
+@benchmark("masking/agnostic_packed_b64", "masking")
+def bench_agnostic_mask_packed(ctx):
+    frames = np.random.default_rng(0).integers(2, 9, size=64).tolist()
+    return partial(masking_generator("agnostic", 0.9).packed, frames)
+
+
+############# misc #############
+
+@benchmark("misc/sinusoid_table_build_1568x768", "misc")
+def bench_sinusoid_table_build(ctx):
+    from modeling_finetune import _sinusoid_encoding_table
+    # the table without the cache of get_sinusoid_encoding_table
+    return partial(_sinusoid_encoding_table.__wrapped__, 1568, 768)
+
+
+@benchmark("misc/sinusoid_table_cached_1568x768", "misc")
+def bench_sinusoid_table_cached(ctx):
+    from modeling_finetune import get_sinusoid_encoding_table
+    return partial(get_sinusoid_encoding_table, 1568, 768)
+
+
+############# eval #############
+
+@benchmark("eval/merge_64videos_6views", "eval", repeat=3)
+def bench_merge(ctx):
+    from engine_for_finetuning import merge
+
+    root = fixture(ctx, "merge", lambda root: fixtures.write_merge_outputs(root) or root)
+
+    def run():
+        # merge() prints its progress
+        with contextlib.redirect_stdout(io.StringIO()):
+            return merge(root, 2)
+    return run
+
+
+@benchmark("eval/lta_metric_b64", "eval")
+def bench_lta_metric(ctx):
+    from engine_for_finetuning import lta_metric
+
+    out_actions = [torch.randn(64, 115) for _ in range(20)]
+    target_actions = [torch.randint(0, 115, (64,)) for _ in range(20)]
+    return partial(lta_metric, out_actions, target_actions)
+
+
+@benchmark("eval/hands_metric_b64", "eval")
+def bench_hands_metric(ctx):
+    from engine_for_finetuning import hands_metric
+
+    output, target = torch.rand(64, 20), torch.rand(64, 20)
+    masks = (torch.rand(64, 20) > 0.3).float()
+    return partial(hands_metric, output, [target, masks])
+
+
+@benchmark("eval/accuracy_top5_b64", "eval")
+def bench_accuracy(ctx):
+    from timm.utils import accuracy
+
+    output, target = torch.randn(64, 400), torch.randint(0, 400, (64,))
+    return partial(accuracy, output, target, topk=(1, 5))
+
+
+############# model #############
+
+# tiny configs: 112x112 inputs, 2 encoder blocks, 1 decoder block
+TINY = dict(img_size=112, patch_size=16, encoder_embed_dim=192, encoder_depth=2, encoder_num_heads=3,
+            decoder_embed_dim=96, decoder_depth=1, decoder_num_heads=3, mlp_ratio=4, qkv_bias=True,
+            norm_layer=partial(nn.LayerNorm, eps=1e-6))
+BATCH_SIZE = 2
+
+
+def tensors(output):
+    if torch.is_tensor(output):
+        return [output]
+    if isinstance(output, (list, tuple)):
+        return [t for item in output for t in tensors(item)]
+    if isinstance(output, dict):
+        return [t for item in output.values() for t in tensors(item)]
+    return []
+
+
+def train_step(model, *inputs, **kwargs):
+    """ forward and backward, the loss is the mean square of every output so that every head gets gradients """
+    def step():
+        model.zero_grad(set_to_none=True)
+        outputs = model(*inputs, **kwargs)
+        loss = sum(t.float().pow(2).mean() for t in tensors(outputs))
+        loss.backward()
+    return step
+
+
+def tiny_inputs():
+    from masking_generator import AgnosticMaskingGenerator
+
+    rgb = torch.randn(BATCH_SIZE, 3, 16, 112, 112)
+    flow = torch.randn(BATCH_SIZE, 2, 8, 112, 112)
+    generator = AgnosticMaskingGenerator((8, 7, 7), 0.9)
+    rgb_mask = torch.from_numpy(np.stack(generator(BATCH_SIZE))).to(torch.bool)
+    flow_mask = torch.from_numpy(np.stack(generator(BATCH_SIZE))).to(torch.bool)
+    return rgb, flow, rgb_mask, flow_mask
+
+
+@benchmark("model/mae_step", "model")
+def bench_mae_step(ctx):
+    from modeling_pretrain import PretrainVisionTransformer
+
+    model = PretrainVisionTransformer(decoder_num_classes=1536, **TINY)
+    rgb, _, mask, _ = tiny_inputs()
+    return train_step(model, rgb, mask)
+
+
+@benchmark("model/mae_packed_step", "model")
+def bench_mae_packed_step(ctx):
+    from modeling_pretrain import PretrainVisionTransformer
+    from masking_generator import TubeMaskingGenerator
+
+    model = PretrainVisionTransformer(decoder_num_classes=1536, **TINY)
+    # the tokens of BATCH_SIZE clips of 16 frames packed into clips of 4 to 16 frames
+    num_frames = [4, 16, 8, 4]
+    videos = torch.randn(1, 3, sum(num_frames), 112, 112)
+    tubelets = [t // 2 for t in num_frames]
+    mask = torch.from_numpy(TubeMaskingGenerator((8, 7, 7), 0.9).packed(tubelets)).to(torch.bool).reshape(1, -1)
+    return train_step(model, videos, mask, seqlens=[t * 49 for t in tubelets])
+
+
+def multimodal_step(modality):
+    from modeling_pretrain import PretrainMultiModalTransformer
+
+    model = PretrainMultiModalTransformer(modality=modality, rgb_num_classes=1536, flow_num_classes=512, **TINY)
+    return train_step(model, *tiny_inputs())
+
+
+@benchmark("model/multimodal_rgbflow_step", "model")
+def bench_multimodal_rgbflow_step(ctx):
+    return multimodal_step("rgbflow")
+
+
+@benchmark("model/multimodal_rgb_step", "model")
+def bench_multimodal_rgb_step(ctx):
+    return multimodal_step("rgb")
+
+
+@benchmark("model/bottleneck_step", "model")
+def bench_bottleneck_step(ctx):
+    from modeling_pretrain import PretrainBottleneckTransformer
+
+    # the decoders have 2 cross attention blocks, indexing the drop path rates of decoder_depth blocks
+    model = PretrainBottleneckTransformer(rgb_num_classes=1536, flow_num_classes=512, **{**TINY, "decoder_depth": 2})
+    return train_step(model, *tiny_inputs())
+
+
+############# optim #############
+
+def optimizer_step(opt_impl):
+    from benchmarks.bench_optimizer import build_model, build_optimizer, set_grads
+
+    args = SimpleNamespace(input_size=112, embed_dim=384, depth=12, layer_decay=0.75)
+    model = build_model(args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimizer = build_optimizer(model, opt_impl, args)
+    set_grads(model, 0)
+    return optimizer.step
+
+
+@benchmark("optim/adamw_step_for_loop", "optim")
+def bench_adamw_for_loop(ctx):
+    return optimizer_step("for_loop")
+
+
+@benchmark("optim/adamw_step_auto", "optim")
+def bench_adamw_auto(ctx):
+    return optimizer_step("auto")
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark suite")
+    parser.add_argument("--output", default="benchmark_results.json", type=str, help="json file of the results")
+    parser.add_argument("--groups", default=None, type=str, nargs="+", help="groups to run (data masking misc eval model optim)")
+    parser.add_argument("--filter", default=None, type=str, nargs="+", help="run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", default=10, type=int, help="number of timed repeats of each benchmark")
+    parser.add_argument("--min_time", default=0.05, type=float, help="minimum time of a repeat in seconds")
+    parser.add_argument("--threads", default=1, type=int, help="number of torch threads")
+    parser.add_argument("--compare", default="", type=str, help="json results to compare against")
+    parser.add_argument("--threshold", default=0.1, type=float, help="relative slowdown reported as a regression")
+    parser.add_argument("--list", action="store_true", help="list benchmarks and exit")
+    args = parser.parse_args()
+
+    from benchmarks.harness import BENCHMARKS
+    if args.list:
+        for bench in BENCHMARKS.values():
+            print(f"{bench.group:<8} {bench.name}")
+        return
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    ctx = SimpleNamespace(tmp_dir=tempfile.mkdtemp(), fixtures={})
+    try:
+        results = run_benchmarks(ctx, names=args.filter, groups=args.groups, repeat=args.repeat, min_time=args.min_time)
+    finally:
+        shutil.rmtree(ctx.tmp_dir, ignore_errors=True)
+
+    save_results(args.output, results, run_meta())
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        baseline = load_results(args.compare)
+        rows = compare_results(baseline["results"], results, args.threshold)
+        if print_comparison(rows, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+accuracy/throughput sweep of token merging at inference
+
+Evaluates a finetuned OSCC/PNR or LTA checkpoint on its validation set with different numbers of
+merged tokens per block (token_merging.set_token_merging) and reports the validation metrics of
+engine_for_finetuning.validation_one_epoch together with the model throughput.
+
+Arguments other than the sweep arguments below are parsed by run_class_finetuning, so the
+configuration file of the finetuning run is used as it is.
+
+Usage (from videomae/):
+
+    python -m benchmarks.sweep_token_merging --ckpt /path/to/checkpoint-best.pth \
+        --merge_rs 0 8 16 32 64 --config configs/oscc.yml
+
+"""
+
+import sys
+import json
+import time
+import argparse
+
+import torch
+
+import modeling_finetune  # register models
+from datasets import build_dataset
+from utils import samples_collate_fho
+from token_merging import set_token_merging
+from fast_init import create_model_from_checkpoint
+from engine_for_finetuning import validation_one_epoch
+from loss import ActionAnticipationLoss
+from config_utils import parse_yml, combine
+import run_class_finetuning
+
+
+def get_sweep_args():
+    parser = argparse.ArgumentParser("token merging sweep", add_help=False)
+    parser.add_argument("--ckpt", required=True, help="finetuned checkpoint to evaluate")
+    parser.add_argument("--merge_rs", default=[0, 8, 16, 32, 64], type=int, nargs="+",
+                        help="numbers of tokens merged per block, 0 is the baseline without merging")
+    parser.add_argument("--merge_schedules", default=["constant"], type=str, nargs="+",
+                        choices=["constant", "decreasing"])
+    parser.add_argument("--throughput_iters", default=20, type=int)
+    parser.add_argument("--output", default="", help="json file to save the results")
+    sweep_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args, _ = run_class_finetuning.get_args()
+    config = parse_yml(args.config)
+    if config is not None:
+        args = combine(args, config)
+
+    return sweep_args, args
+
+
+def build_model(args, num_classes, ckpt):
+    if "lta" in args.cfg.task:
+        all_frames = args.cfg.NUM_FRAMES * args.cfg.input_clip_num
+        task_specific_params = {"head_type": args.head_type}
+    else:
+        all_frames = args.cfg.NUM_FRAMES
+        task_specific_params = {"task": args.cfg.task} if args.cfg.task in ["pnr", "oscc"] else {}
+
+    model = create_model_from_checkpoint(
+        args.model,
+        ckpt,
+        model_key=args.model_key,
+        pretrained=False,
+        num_classes=num_classes,
+        all_frames=all_frames,
+        tubelet_size=args.tubelet_size,
+        use_mean_pooling=args.use_mean_pooling,
+        **task_specific_params,
+    )
+
+    return model
+
+
+@torch.no_grad()
+def throughput(model, data_loader, device, iters):
+    """
+        Return:
+            clips per second of the model forward (data loading excluded)
+    """
+    model.eval()
+    videos = next(iter(data_loader))[0].to(device, non_blocking=True)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    with torch.cuda.amp.autocast(enabled=device.type == "cuda"):
+        for _ in range(3):
+            model(videos)
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(videos)
+        synchronize()
+
+    return iters * videos.shape[0] / (time.perf_counter() - start)
+
+
+def main():
+    sweep_args, args = get_sweep_args()
+    device = torch.device(args.device)
+
+    dataset_val, num_classes = build_dataset(mode="val", args=args, flow_extractor=None)
+    data_loader_val = torch.utils.data.DataLoader(
+        dataset_val, sampler=torch.utils.data.SequentialSampler(dataset_val),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=False,
+        collate_fn=samples_collate_fho,
+    )
+
+    model = build_model(args, num_classes, sweep_args.ckpt).to(device)
+    if "lta" in args.cfg.task:
+        criterion = ActionAnticipationLoss(celoss="", head_type=args.head_type)
+    else:
+        criterion = torch.nn.CrossEntropyLoss()
+
+    results = []
+    for schedule in sweep_args.merge_schedules:
+        for r in sweep_args.merge_rs:
+            rs = set_token_merging(model, r, schedule)
+            stats = validation_one_epoch(data_loader_val, model, device, criterion, task=args.cfg.task)
+            clips_per_sec = throughput(model, data_loader_val, device, sweep_args.throughput_iters)
+            results.append({"schedule": schedule, "r": r, "merged_per_block": rs,
+                            "score": stats["score"], "throughput": clips_per_sec, "stats": stats})
+
+    baseline = next((res for res in results if res["r"] == 0), None)
+    print(f"{'schedule':>10} {'r':>4} {'score':>10} {'clips/s':>10} {'speedup':>8}")
+    for res in results:
+        speedup = res["throughput"] / baseline["throughput"] if baseline is not None else float("nan")
+        print(f"{res['schedule']:>10} {res['r']:>4} {res['score']:>10.3f} {res['throughput']:>10.1f} {speedup:>8.2f}")
+
+    if sweep_args.output:
+        with open(sweep_args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import torch
 from torchvision import transforms
 from transforms import *
 
@@ -31,6 +32,43 @@ class DataAugmentationForVideoMAE(object):
         process_data, flows_or_none = self.transform(images)
         return process_data, flows_or_none
 
+    def repeated(self, frames, flows, frame_views, flow_views):
+        """
+            augment several views of one decoded window in a single pass, each view gets its own crop
+
+            Parameters:
+                frames: uint8 tensor, N x H x W x 3
+                flows: uint8 tensor, Nf x H x W x 2
+                frame_views: long tensor, R x T, indexes of the frames of every view
+                flow_views: long tensor, R x Tf, indexes of the flows of every view
+
+            Return:
+                frames: float tensor, R x 3 x T x S x S, normalized
+                flows: float tensor, R x 2 x Tf x S x S, in [0, 1]
+        """
+        num_views, num_frames = frame_views.shape
+        num_flows = flow_views.shape[1]
+        height, width = frames.shape[1:3]
+        input_w, input_h = self.train_augmentation.input_size
+        size = (input_h, input_w)
+
+        # resizing stays in uint8 (channels last for rgb), which is much faster than float on cpu
+        out_frames = torch.empty((num_views, num_frames, 3, input_h, input_w), dtype=torch.uint8)
+        out_flows = torch.empty((num_views, num_flows, 2, input_h, input_w), dtype=torch.uint8)
+        for i, (frame_idx, flow_idx) in enumerate(zip(frame_views, flow_views)):
+            crop_w, crop_h, offset_w, offset_h = self.train_augmentation._sample_crop_size((width, height))
+            rows, cols = slice(offset_h, offset_h + crop_h), slice(offset_w, offset_w + crop_w)
+            view = frames[:, rows, cols].index_select(0, frame_idx).permute(0, 3, 1, 2)
+            out_frames[i] = torch.nn.functional.interpolate(view, size=size, mode="bilinear", antialias=True)
+            view = flows[:, rows, cols].index_select(0, flow_idx).permute(0, 3, 1, 2).reshape(num_flows * 2, 1, crop_h, crop_w)
+            out_flows[i] = torch.nn.functional.interpolate(view, size=size, mode="bilinear", antialias=True).view(num_flows, 2, input_h, input_w)
+
+        mean = torch.as_tensor(self.input_mean)[:, None, None] * 255.
+        std = torch.as_tensor(self.input_std)[:, None, None] * 255.
+        frames = out_frames.float().sub_(mean).div_(std).transpose(1, 2)
+        flows = out_flows.float().div_(255.).transpose(1, 2)
+        return frames, flows
+
     def __repr__(self):
         repr = "(DataAugmentationForVideoMAE,\n"
         repr += "  transform = %s,\n" % str(self.transform)
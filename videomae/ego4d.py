@@ -27,6 +27,7 @@ import video_transforms as video_transforms
 import volume_transforms as volume_transforms
 from random_erasing import RandomErasing
 from ego4d_trim import _get_frames
+from ego4d_annotation import load_annotation_table, compile_fho_oscc_pnr, compile_fho_lta, compile_fho_hands, ViewIndex
 
 # import detectron2.data.transforms as detection_transform
 # from detectron2.data import detection_utils
@@ -475,8 +476,24 @@ class Egoclip(Ego4dBase):
         self.log_path = self.kwargs["output_path"]
         self.rank = self.kwargs["rank"]
 
+        # packed-sequence pretraining: clips keep a number of frames proportional to their duration,
+        # one (pair of) frame(s) every PACKED_FRAME_STRIDE frames, between MIN_FRAMES and NUM_FRAMES
+        self.packed = getattr(self.cfg, "PACKED", False)
+        self.frame_stride = getattr(self.cfg, "PACKED_FRAME_STRIDE", 8)
+        self.min_frames = getattr(self.cfg, "MIN_FRAMES", 4) if self.packed else self.cfg.NUM_FRAMES
+        assert self.min_frames % 2 == 0 and self.cfg.NUM_FRAMES % 2 == 0, "frames are sampled in pairs"
+
         assert self.load_flow != "online", "Only support load flow locally while using egoclip"
 
+    def clip_num_frames(self, length):
+        """
+            number of frames sampled from a clip of length frames, NUM_FRAMES unless packed
+        """
+        if not self.packed:
+            return self.cfg.NUM_FRAMES
+        num_frames = length // self.frame_stride // 2 * 2
+        return min(max(num_frames, self.min_frames), self.cfg.NUM_FRAMES)
+
     def logtofile(self, msg, dest="/mnt/shuang/Data/ego4d/preprocessed_data/egoclip_error_reading.log"):
 
         dest = os.path.join(self.log_path, f"egoclip_error_reading_{self.rank}.log")
@@ -528,7 +545,7 @@ class Egoclip(Ego4dBase):
                     "spatial_temporal_idx": 0,
             }
 
-            if pack["end_frame"] - pack["start_frame"] + 1 < self.cfg.NUM_FRAMES:
+            if pack["end_frame"] - pack["start_frame"] + 1 < self.min_frames:
                 # if the length of the clip is smaller than required number of frames to be sampled then skip this clip
                 # this metric is inaccurate, since actual number of frames might be smaller than recordings in the annotation file
                 self.skip_lst.append(pack)
@@ -678,13 +695,14 @@ class Egoclip(Ego4dBase):
             end_frame  = int( frame_name.split(".")[0].split("_")[-1] )
         
         length = end_frame - start_frame + 1
-        if length < self.cfg.NUM_FRAMES:
+        num_frames = self.clip_num_frames(length)
+        if length < num_frames:
             return None
 
         frame_name_lst = []
         uflow_name_lst = []
         vflow_name_lst = []
-        frame_idx_lst = self.sample_frames_idx(0, length, self.cfg.NUM_FRAMES)
+        frame_idx_lst = self.sample_frames_idx(0, length, num_frames)
 
         for i in range(0, len(frame_idx_lst), 2):
             idx = frame_idx_lst[i]
@@ -751,6 +769,7 @@ class Egoclip(Ego4dBase):
         # (4) too many opened zip file descriptors
 
 
+        start = time.perf_counter()
         ret = 0
         while isinstance(ret, int):
             ret = self.prepare_clip_frames_flows(info=info)
@@ -772,9 +791,13 @@ class Egoclip(Ego4dBase):
             label = info["verb"] if "verb" in self.cfg.task else info["noun"]
             return frames, flows, label
         else:
+            decoded = time.perf_counter()
+            num_frames = len(frames)
             frames, flows = self.data_transform((frames, flows))
-            frames = frames.view((self.cfg.NUM_FRAMES, 3) + frames.size()[-2:]).transpose(0,1)
-            return frames, flows
+            frames = frames.view((num_frames, 3) + frames.size()[-2:]).transpose(0,1)
+            # seconds spent in the worker, see utils.worker_timing
+            timing = {"decode": decoded - start, "augment": time.perf_counter() - decoded}
+            return frames, flows, {"timing": timing}
 
 
     def __len__(self):
@@ -831,156 +854,80 @@ class Ego4dFhoOscc(Ego4dBase):
         negative_vid_err_msg = "Wrong negative clips' frame path provided"
         assert os.path.exists(self.negative_vid_dir), negative_vid_err_msg
 
-        self.package = list()
-        self.ann_data = json.load(open(self.ann_path, 'r'))["clips"]
-
-        num_pos = 0
-        num_neg = 0
-
+        # compact table of clips, memory-mapped and shared by all processes
+        self.table = load_annotation_table(
+            self.ann_path, compile_fho_oscc_pnr, getattr(self.cfg, "ANN_CACHE_DIR", None)
+        )
 
         # pnr
         # train: 653680(pos:316976 neg:336704)
         # val:   449028(pos:213508 neg:235520)
-        
-        for value in tqdm(self.ann_data, desc='Preparing data'):  
-
-            clip_start_sec = value['parent_start_sec']
-            clip_end_sec = value['parent_end_sec']
-            clip_start_frame = value['parent_start_frame']
-            clip_end_frame = value['parent_end_frame']
-            video_id = value['video_uid']
-            unique_id = value['unique_id']
-
-            if self.mode in ['train', 'val']:
-                state_change = value['state_change']
-                if "parent_pnr_frame" in value.keys():
-                    pnr_frame = value['parent_pnr_frame']
-                else:
-                    pnr_frame = value["pnr_frame"]
-
-
-                if self.task == "oscc":
-                    self.package.append({
-                        'unique_id': unique_id,
-                        'pnr_frame': pnr_frame,
-                        # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                        'clip_start_sec': clip_start_sec,
-                        'clip_end_sec': clip_end_sec,
-                        'clip_start_frame': int(clip_start_frame),
-                        'clip_end_frame': int(clip_end_frame),
-                        'video_id': video_id,
-
-                        "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                        "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                    })
-                elif self.task == "pnr":
-
-                    self.package.append({
-                        'unique_id': unique_id,
-                        'pnr_frame': pnr_frame,
-                        # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                        'clip_start_sec': clip_start_sec,
-                        'clip_end_sec': clip_end_sec,
-                        'clip_start_frame': int(clip_start_frame),
-                        'clip_end_frame': int(clip_end_frame),
-
-                        'video_id': video_id,
-                        "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                        "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                    })
-
-                    # multi-class classification dense sampling strategy
-                    # see experiment pnr/noble-brook-2 on wandb for more information
-                    # if pnr_frame:
-
-                        # for i in range(0, self.num_frames):
-                        #     st = max(int(clip_start_frame), pnr_frame - i)
-                        #     end = min(int(clip_end_frame), pnr_frame - i + self.num_frames-1 )
-                        #     if end - st + 1 < self.num_frames: continue
-
-                            # self.package.append({
-                            #     'unique_id': unique_id,
-                            #     'pnr_frame': pnr_frame,
-                            #     # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                            #     'clip_start_sec': clip_start_sec,
-                            #     'clip_end_sec': clip_end_sec,
-
-                            #     'clip_start_frame': st,
-                            #     'clip_end_frame': end,
-
-                            #     'video_id': video_id,
-                            #     "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                            #     "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                            # })
-                            #     num_pos += 1
-                            #     if end == int(clip_end_frame):
-                            #         break
 
-                    # else:
-                    #     # no state change occurs, repeat "num_frames" times.
-                    #     for i in range(0, self.num_frames):
-                    #         self.package.append({
-                    #             'unique_id': unique_id,
-                    #             'pnr_frame': pnr_frame,
-                    #             # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                    #             'clip_start_sec': clip_start_sec,
-                    #             'clip_end_sec': clip_end_sec,
-
-                    #             'clip_start_frame': int(clip_start_frame),
-                    #             'clip_end_frame': int(clip_end_frame),
-
-                    #             'video_id': video_id,
-                    #             "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                    #             "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                    #         })
-                    #         num_neg += 1
-            else:# test mode
-
-                state_change = None
-                pnr_frame = None
-                if self.task == "oscc":
-                    for temporal_idx in range(self.test_temporal_sample):
-                        for spatial_idx in range(self.test_spatial_sample):
- 
-                            self.package.append({
-                                'unique_id': unique_id,
-                                'pnr_frame': pnr_frame,
-                                # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                                'clip_start_sec': clip_start_sec,
-                                'clip_end_sec': clip_end_sec,
-                                'clip_start_frame': int(clip_start_frame),
-                                'clip_end_frame': int(clip_end_frame),
-                                'video_id': video_id,
-
-                                "temporal_idx": temporal_idx,
-                                "spatial_idx": spatial_idx,
-                                "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                                "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                            })
-
-                elif self.task == "pnr":
-                    # dense sampling every frame
-                    for spatial_idx in range(self.test_spatial_sample):
-                        temporal_idx = 0
-                        for frame_idx in range(int(clip_start_frame), int(clip_end_frame), self.num_frames):
-                            self.package.append({
-                                'unique_id': unique_id,
-                                'pnr_frame': pnr_frame,
-                                # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
-                                'clip_start_sec': clip_start_sec,
-                                'clip_end_sec': clip_end_sec,
-                                'clip_start_frame': frame_idx,
-                                'clip_end_frame': min(int(clip_end_frame), frame_idx+self.num_frames),
-                                'video_id': video_id,
-
-                                "temporal_idx": temporal_idx,
-                                "spatial_idx": spatial_idx,
-                                "video_path": os.path.join(self.video_dir, video_id+".mp4"),
-                                "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
-                            })
-                            temporal_idx += 1
-
-        print(f'Number of clips for {self.mode}: {len(self.package)}(pos:{num_pos} neg:{num_neg})')
+        if self.mode in ['train', 'val']:
+            # one sample per clip
+            self.index = ViewIndex(1, len(self.table))
+
+        else:# test mode
+            if self.task == "oscc":
+                # temporal_idx x spatial_idx views of each clip
+                self.index = ViewIndex(self.test_temporal_sample * self.test_spatial_sample, len(self.table))
+
+            elif self.task == "pnr":
+                # dense sampling every frame: spatial_idx x windows of num_frames frames of each clip
+                clip_len = np.asarray(self.table["parent_end_frame"]) - np.asarray(self.table["parent_start_frame"])
+                self.num_windows = np.maximum(0, -(-clip_len // self.num_frames))
+                self.index = ViewIndex(self.test_spatial_sample * self.num_windows)
+
+        num_pos = int((np.asarray(self.table["state_change"]) == 1).sum())
+        num_neg = len(self.table) - num_pos
+        print(f'Number of clips for {self.mode}: {len(self.index)}(pos:{num_pos} neg:{num_neg})')
+
+    def get_info(self, index):
+        """
+            build the information dict of a sample from the annotation table
+        """
+
+        row, view = self.index[index]
+
+        unique_id = self.table.string("unique_id", row)
+        video_id = self.table.string("video_uid", row)
+        pnr_frame = int(self.table["pnr_frame"][row])
+        state_change = int(self.table["state_change"][row]) == 1
+
+        info = {
+            'unique_id': unique_id,
+            'pnr_frame': pnr_frame if pnr_frame != -1 else None,
+            # 'state': 0 if not state_change else 1, # NOTE:state_change might be True, False or None
+            'clip_start_sec': float(self.table["parent_start_sec"][row]),
+            'clip_end_sec': float(self.table["parent_end_sec"][row]),
+            'clip_start_frame': int(self.table["parent_start_frame"][row]),
+            'clip_end_frame': int(self.table["parent_end_frame"][row]),
+            'video_id': video_id,
+
+            "video_path": os.path.join(self.video_dir, video_id+".mp4"),
+            "clip_path": os.path.join(self.positive_vid_dir, unique_id) if state_change else os.path.join(self.negative_vid_dir, unique_id)
+        }
+
+        if self.mode == "test":
+            if self.task == "oscc":
+                temporal_idx, spatial_idx = divmod(view, self.test_spatial_sample)
+            elif self.task == "pnr":
+                num_windows = int(self.num_windows[row])
+                spatial_idx, temporal_idx = divmod(view, num_windows)
+                frame_idx = info['clip_start_frame'] + temporal_idx * self.num_frames
+                info.update({
+                    'clip_start_frame': frame_idx,
+                    'clip_end_frame': min(info['clip_end_frame'], frame_idx+self.num_frames),
+                })
+
+            # state change is unknown in test set
+            info.update({
+                'pnr_frame': None,
+                "temporal_idx": temporal_idx,
+                "spatial_idx": spatial_idx,
+            })
+
+        return info
  
     def init_transformation(self):
 
@@ -1003,11 +950,11 @@ class Ego4dFhoOscc(Ego4dBase):
             ])
 
     def __len__(self):
-        return len(self.package)
+        return len(self.index)
     
     def __getitem__(self, index):
 
-        info = self.package[index]
+        info = self.get_info(index)
 
         try:
             # check existance of clip frames, if some frames are missing then re-extract from video
@@ -1467,53 +1414,36 @@ class Ego4dFhoLTA(Ego4dBase):
 
         assert os.path.exists(self.anno_path), "annotation file not found"
 
-        self.package = []
-        self.info = {}
-        with open(self.anno_path, "r") as anno_fp:
-            clips = json.load(anno_fp)["clips"] # list[dict]
-
-        # NOTE not used for now
-        verb_freq = {} # compute frequency of each verb label
-        noun_freq = {} # compute frequency of each noun label
-        for i, clip in enumerate(clips):
-            clip_uid = clip["clip_uid"]
-            if clip_uid not in self.info.keys():
-                self.info[clip_uid] = []
-
-            verb_label = clip.get("verb_label", -1)
-            noun_label = clip.get("noun_label", -1)
-            if verb_label not in verb_freq:
-                verb_freq[verb_label] = 0
-            if noun_label not in noun_freq:
-                noun_freq[noun_label] = 0
-
-            verb_freq[verb_label] += 1
-            noun_freq[noun_label] += 1
-
-            self.info[clip_uid].append({
-                "video_uid": clip["video_uid"],
-                "clip_uid": clip["clip_uid"],
-
-                "clip_parent_start_frame": clip["clip_parent_start_frame"],
-                "clip_parent_end_frame": clip["clip_parent_end_frame"],
-                "action_clip_start_frame": clip["action_clip_start_frame"],
-                "action_clip_end_frame": clip["action_clip_end_frame"],
-
-                "action_idx": clip["action_idx"],
-                "verb_label": verb_label,
-                "noun_label": noun_label,
-            })
+        # actions grouped by clip, memory-mapped and shared by all processes
+        self.table = load_annotation_table(
+            self.anno_path, compile_fho_lta, getattr(self.cfg, "ANN_CACHE_DIR", None)
+        )
 
-        for clip_uid in self.info.keys():
-            clips = self.info[clip_uid]
+        # each sample is a window of input_clip_num + num_action_predict consecutive actions of a clip,
+        # i.e., a (clip, first action of the window) pair
+        clip_uid = np.asarray(self.table["clip_uid"])
+        boundaries = np.flatnonzero(np.diff(clip_uid)) + 1
+        self.group_start = np.concatenate([[0], boundaries]).astype(np.int64)
+        group_end = np.concatenate([boundaries, [len(clip_uid)]]).astype(np.int64)
+        self.index = ViewIndex(np.maximum(0, group_end - self.group_start - self.input_clip_num - self.num_action_predict))
 
-            for i in range(len(clips) - self.input_clip_num - self.num_action_predict):
-                self.package.append(
-                    {
-                        "input_clips": clips[i:i+self.input_clip_num],
-                        "forecast_clips": clips[i+self.input_clip_num: i+self.input_clip_num+self.num_action_predict ]
-                    }
-                )
+    def get_clip_info(self, row):
+        """
+            information of the action in the given row of the annotation table
+        """
+        return {
+            "video_uid": self.table.string("video_uid", row),
+            "clip_uid": self.table.string("clip_uid", row),
+
+            "clip_parent_start_frame": int(self.table["clip_parent_start_frame"][row]),
+            "clip_parent_end_frame": int(self.table["clip_parent_end_frame"][row]),
+            "action_clip_start_frame": int(self.table["action_clip_start_frame"][row]),
+            "action_clip_end_frame": int(self.table["action_clip_end_frame"][row]),
+
+            "action_idx": int(self.table["action_idx"][row]),
+            "verb_label": int(self.table["verb_label"][row]),
+            "noun_label": int(self.table["noun_label"][row]),
+        }
 
     def init_transformation(self):
 
@@ -1585,10 +1515,12 @@ class Ego4dFhoLTA(Ego4dBase):
 
     def __getitem__(self, index):
 
-        info = self.package[index]
-
-        input_clips = info["input_clips"]
-        forecast_clips = info["forecast_clips"]
+        group, view = self.index[index]
+        st = int(self.group_start[group]) + view
+        input_clips = [self.get_clip_info(row) for row in range(st, st+self.input_clip_num)]
+        forecast_clips = [
+            self.get_clip_info(row) for row in range(st+self.input_clip_num, st+self.input_clip_num+self.num_action_predict)
+        ]
 
         frames = [] # list of numpy array
         frame_idx_lst = []
@@ -1609,7 +1541,7 @@ class Ego4dFhoLTA(Ego4dBase):
         return frames, flows, target
 
     def __len__(self):
-        return len(self.package)
+        return len(self.index)
 
 
 class Ego4dFhoHands(Ego4dBase):
@@ -1653,89 +1585,49 @@ class Ego4dFhoHands(Ego4dBase):
 
         assert os.path.exists(self.anno_path), "annotation file not found"
 
-        self.package = []
-        frame_types2index = {
-            "pre_45": 0, 
-            "pre_30": 4,
-            "pre_15": 8,
-            "pre_frame": 12,
-            "contact_frame": 16,
-        }
-
-        with open(self.anno_path, "r") as anno_fp:
-            clips = json.load(anno_fp)["clips"] # list[dict]
-
-        for clip in clips:
-
-            clip_meta = {
-                "clip_id": clip['clip_id'],
-                "clip_uid": clip['clip_uid'],
-                "video_uid": clip['video_uid'],
-
-                "spatial_temporal_index": 0,
-            }
-
-            for i, annot in enumerate(clip['frames']):
-                
-                if self.mode == "test":
-
-                    pre_45_frame = annot["pre_45"]["frame"]
-                    pre_frame = annot["pre_frame"]["frame"] if "pre_frame" in annot else -1
-                    st = max(0, pre_45_frame - self.max_observation_frame_num)
-                    end = pre_frame + 30 if pre_frame != -1 else pre_45_frame + 45 + 30
-                else:
-                    st = annot["action_start_frame"]
-                    end = annot["action_end_frame"]
-
-                clip_name = str(clip['clip_uid']) + "_{:05d}.zip".format(i)
-                clip_meta.update({
-                    # distinguish segments in clip by index of frame pre_45
-                    "idx": i,
-                    "clip_name": clip_name,
-                    "clip_path": os.path.join(self.source, clip["clip_uid"], clip_name),
-                    "action_start_frame": st,
-                    "action_end_frame": end,
-                })
+        # one row per annotated segment, memory-mapped and shared by all processes
+        self.table = load_annotation_table(
+            self.anno_path, compile_fho_hands, getattr(self.cfg, "ANN_CACHE_DIR", None)
+        )
 
-                # placeholder for the 1x20 hand gt vector (padd zero when GT is not available)
-                # 5 frames have the following order: pre_45, pre_40, pre_15, pre, contact
-                # GT for each frames has the following order: left_x,left_y,right_x,right_y
-                label= [0.0]*20
-                label_mask = [0.0]*20
-                for frame_type, frame_annot in annot.items():
-
-                    if frame_type in frame_types2index.keys():
-                        # if len(frame_annot)==2:
-                        #     print(frame_annot)
-                        #     continue
-                        lh_idx = frame_types2index[frame_type]
-                        rh_idx = frame_types2index[frame_type] + 2
-
-                        frame_gt = frame_annot['boxes']
-
-                        for single_hand in frame_gt:
-                            if 'left_hand' in single_hand:
-                                label_mask[lh_idx]=1.0
-                                label_mask[lh_idx+1]=1.0
-                                label[lh_idx]= single_hand['left_hand'][0]
-                                label[lh_idx+1]= single_hand['left_hand'][1]
-                            if 'right_hand' in single_hand:
-                                label_mask[rh_idx]=1.0
-                                label_mask[rh_idx+1]=1.0
-                                label[rh_idx]= single_hand['right_hand'][0]
-                                label[rh_idx+1]= single_hand['right_hand'][1]   
-
-                clip_meta.update({
-                    "label": label,
-                    "label_mask": label_mask,
-                })
+        if self.mode == "test":
+            pre_45_frame = np.asarray(self.table["pre_45_frame"])
+            pre_frame = np.asarray(self.table["pre_frame"])
+            self.action_start_frame = np.maximum(0, pre_45_frame - self.max_observation_frame_num)
+            self.action_end_frame = np.where(pre_frame != -1, pre_frame + 30, pre_45_frame + 45 + 30)
+            # every segment is tested with test_num_clips views
+            self.index = ViewIndex(self.test_num_clips, len(self.table))
+        else:
+            self.action_start_frame = self.table["action_start_frame"]
+            self.action_end_frame = self.table["action_end_frame"]
+            self.index = ViewIndex(1, len(self.table))
 
-                if self.mode == "test":
-                    for idx in range(self.test_num_clips):
-                        clip_meta["spatial_temporal_index"] = idx
-                        self.package.append(clip_meta)
-                else:
-                    self.package.append(clip_meta)
+    def get_info(self, index):
+        """
+            build the information dict of a sample from the annotation table
+        """
+        row, view = self.index[index]
+        clip_uid = self.table.string("clip_uid", row)
+        # distinguish segments in clip by index of frame pre_45
+        idx = int(self.table["idx"][row])
+        clip_name = clip_uid + "_{:05d}.zip".format(idx)
+
+        return {
+            "clip_id": int(self.table["clip_id"][row]),
+            "clip_uid": clip_uid,
+            "video_uid": self.table.string("video_uid", row),
+            "spatial_temporal_index": view,
+
+            "idx": idx,
+            "clip_name": clip_name,
+            "clip_path": os.path.join(self.source, clip_uid, clip_name),
+            "action_start_frame": int(self.action_start_frame[row]),
+            "action_end_frame": int(self.action_end_frame[row]),
+
+            # 1x20 hand gt vector (zero when GT is not available)
+            "label": self.table["label"][row].tolist(),
+            "label_mask": self.table["label_mask"][row].tolist(),
+        }
 
     def init_transformation(self):
 
@@ -1782,7 +1674,7 @@ class Ego4dFhoHands(Ego4dBase):
 
     def __getitem__(self, index):
 
-        clip_info = self.package[index]
+        clip_info = self.get_info(index)
     
         label = clip_info["label"]
         label = torch.tensor(label)
@@ -1802,7 +1694,7 @@ class Ego4dFhoHands(Ego4dBase):
         return frames, flows, label, mask
 
     def __len__(self):
-        return len(self.package)
+        return len(self.index)
 
     def train_transform(self, clip):
         """
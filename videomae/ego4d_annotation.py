@@ -0,0 +1,337 @@
+"""
+Compile Ego4D FHO annotation files (json) into compact, memory-mapped tables
+
+Annotation files of the FHO benchmarks are hundreds of MB of json. Loading them in every rank and every
+DataLoader worker costs a lot of start-up time and memory, so each json file is compiled once into a directory
+of numpy arrays (one array per column, strings are interned into integer ids) that is memory-mapped by datasets.
+
+    table = load_annotation_table(json_path, compile_fho_oscc_pnr, cache_dir)
+    len(table), table["parent_start_frame"][i], table.string("unique_id", i)
+
+Test-time expansion of rows into several views is handled by ViewIndex without materialising per-view records.
+
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+try:
+    import ijson
+    has_ijson = True
+except ImportError:
+    has_ijson = False
+
+
+def iter_json_items(json_path, key):
+    """
+        iterate items of a top-level list in a json file, streamed with ijson if it is installed
+    """
+    with open(json_path, "rb") as fp:
+        if has_ijson:
+            # ijson yields decimal.Decimal for floats
+            for item in ijson.items(fp, f"{key}.item", use_float=True):
+                yield item
+        else:
+            for item in json.load(fp)[key]:
+                yield item
+
+
+class StringInterner(object):
+    """ map strings to consecutive integer ids """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __call__(self, s):
+        s = str(s)
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+
+class AnnotationTable(object):
+    """
+        column-oriented annotation table whose columns are memory-mapped numpy arrays
+
+        String columns are stored as integer ids together with a vocabulary ("{column}_vocab.npy"),
+        use string(column, index) to get the original value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as fp:
+            self.meta = json.load(fp)
+
+        self.columns = {}
+        for name in self.meta["columns"]:
+            self.columns[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        self.vocabs = {}
+        for name in self.meta["string_columns"]:
+            self.vocabs[name] = np.load(os.path.join(path, name + "_vocab.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.meta["length"]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def string(self, name, index):
+        return str(self.vocabs[name][self.columns[name][index]])
+
+    @staticmethod
+    def write(path, columns, vocabs, source):
+        """
+            write a table to `path`, the directory is written elsewhere first and then renamed,
+            so concurrent readers never see a partially written table
+
+            Parameters:
+                columns: dict[str, np.ndarray], all arrays have the same length
+                vocabs: dict[str, list[str]], vocabulary of each string column
+                source: str, path of the compiled json file
+        """
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        lengths = set(len(v) for v in columns.values())
+        assert len(lengths) == 1, f"columns have different lengths: {lengths}"
+
+        for name, array in columns.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(array))
+        for name, strings in vocabs.items():
+            np.save(os.path.join(tmp_path, name + "_vocab.npy"), np.array(strings, dtype=str))
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as fp:
+            json.dump({
+                "columns": list(columns.keys()),
+                "string_columns": list(vocabs.keys()),
+                "length": lengths.pop(),
+                "source": source,
+                "source_mtime": os.path.getmtime(source),
+            }, fp)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # compiled by another process in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def compile_fho_oscc_pnr(json_path, path):
+    """
+        compile fho_oscc-pnr_{mode}.json, one row per clip
+
+        pnr_frame is -1 if there is no state change (or in test set)
+        state_change is 1/0, or -1 if it is missing (test set) or None
+    """
+    interner = {"unique_id": StringInterner(), "video_uid": StringInterner()}
+    rows = {k: [] for k in [
+        "unique_id", "video_uid", "parent_start_sec", "parent_end_sec",
+        "parent_start_frame", "parent_end_frame", "pnr_frame", "state_change",
+    ]}
+
+    for value in iter_json_items(json_path, "clips"):
+        rows["unique_id"].append(interner["unique_id"](value["unique_id"]))
+        rows["video_uid"].append(interner["video_uid"](value["video_uid"]))
+        rows["parent_start_sec"].append(value["parent_start_sec"])
+        rows["parent_end_sec"].append(value["parent_end_sec"])
+        rows["parent_start_frame"].append(int(value["parent_start_frame"]))
+        rows["parent_end_frame"].append(int(value["parent_end_frame"]))
+
+        pnr_frame = value["parent_pnr_frame"] if "parent_pnr_frame" in value else value.get("pnr_frame", None)
+        rows["pnr_frame"].append(-1 if pnr_frame is None else int(pnr_frame))
+        state_change = value.get("state_change", None)
+        rows["state_change"].append(-1 if state_change is None else int(state_change))
+
+    columns = {
+        "unique_id": np.array(rows["unique_id"], dtype=np.int32),
+        "video_uid": np.array(rows["video_uid"], dtype=np.int32),
+        "parent_start_sec": np.array(rows["parent_start_sec"], dtype=np.float64),
+        "parent_end_sec": np.array(rows["parent_end_sec"], dtype=np.float64),
+        "parent_start_frame": np.array(rows["parent_start_frame"], dtype=np.int64),
+        "parent_end_frame": np.array(rows["parent_end_frame"], dtype=np.int64),
+        "pnr_frame": np.array(rows["pnr_frame"], dtype=np.int64),
+        "state_change": np.array(rows["state_change"], dtype=np.int8),
+    }
+    vocabs = {k: v.strings for k, v in interner.items()}
+    AnnotationTable.write(path, columns, vocabs, json_path)
+
+
+def compile_fho_lta(json_path, path):
+    """
+        compile fho_lta_{mode}.json, one row per action
+
+        Rows are grouped by clip_uid (clips in order of first appearance, actions in file order),
+        so that the actions of a clip are contiguous. Missing labels are -1.
+    """
+    interner = {"clip_uid": StringInterner(), "video_uid": StringInterner()}
+    keys = [
+        "clip_parent_start_frame", "clip_parent_end_frame", "action_clip_start_frame",
+        "action_clip_end_frame", "action_idx",
+    ]
+    rows = {k: [] for k in ["clip_uid", "video_uid", "verb_label", "noun_label"] + keys}
+
+    for clip in iter_json_items(json_path, "clips"):
+        rows["clip_uid"].append(interner["clip_uid"](clip["clip_uid"]))
+        rows["video_uid"].append(interner["video_uid"](clip["video_uid"]))
+        for k in keys:
+            rows[k].append(int(clip[k]))
+        rows["verb_label"].append(clip.get("verb_label", -1))
+        rows["noun_label"].append(clip.get("noun_label", -1))
+
+    # clip ids are assigned in order of first appearance, a stable sort groups rows by clip
+    order = np.argsort(np.array(rows["clip_uid"], dtype=np.int32), kind="stable")
+    columns = {
+        "clip_uid": np.array(rows["clip_uid"], dtype=np.int32)[order],
+        "video_uid": np.array(rows["video_uid"], dtype=np.int32)[order],
+        "verb_label": np.array(rows["verb_label"], dtype=np.int64)[order],
+        "noun_label": np.array(rows["noun_label"], dtype=np.int64)[order],
+    }
+    for k in keys:
+        columns[k] = np.array(rows[k], dtype=np.int64)[order]
+    vocabs = {k: v.strings for k, v in interner.items()}
+    AnnotationTable.write(path, columns, vocabs, json_path)
+
+
+def compile_fho_hands(json_path, path):
+    """
+        compile fho_hands_{mode}.json, one row per annotated segment (clip["frames"][idx])
+
+        label/label_mask are (N, 20) arrays of left_x, left_y, right_x, right_y for
+        pre_45, pre_30, pre_15, pre_frame and contact_frame. Missing frames are -1.
+    """
+    frame_types2index = {
+        "pre_45": 0,
+        "pre_30": 4,
+        "pre_15": 8,
+        "pre_frame": 12,
+        "contact_frame": 16,
+    }
+    interner = {"clip_uid": StringInterner(), "video_uid": StringInterner()}
+    rows = {k: [] for k in [
+        "clip_id", "clip_uid", "video_uid", "idx", "action_start_frame", "action_end_frame",
+        "pre_45_frame", "pre_frame", "label", "label_mask",
+    ]}
+
+    for clip in iter_json_items(json_path, "clips"):
+        clip_uid = interner["clip_uid"](clip["clip_uid"])
+        video_uid = interner["video_uid"](clip["video_uid"])
+
+        for i, annot in enumerate(clip["frames"]):
+            rows["clip_id"].append(int(clip["clip_id"]))
+            rows["clip_uid"].append(clip_uid)
+            rows["video_uid"].append(video_uid)
+            rows["idx"].append(i)
+            rows["action_start_frame"].append(int(annot.get("action_start_frame", -1)))
+            rows["action_end_frame"].append(int(annot.get("action_end_frame", -1)))
+            rows["pre_45_frame"].append(int(annot["pre_45"]["frame"]) if "pre_45" in annot else -1)
+            rows["pre_frame"].append(int(annot["pre_frame"]["frame"]) if "pre_frame" in annot else -1)
+
+            # GT for each frames has the following order: left_x,left_y,right_x,right_y
+            label = [0.0]*20
+            label_mask = [0.0]*20
+            for frame_type, frame_annot in annot.items():
+                if frame_type not in frame_types2index.keys():
+                    continue
+                lh_idx = frame_types2index[frame_type]
+                rh_idx = frame_types2index[frame_type] + 2
+                for single_hand in frame_annot['boxes']:
+                    if 'left_hand' in single_hand:
+                        label_mask[lh_idx] = label_mask[lh_idx+1] = 1.0
+                        label[lh_idx] = single_hand['left_hand'][0]
+                        label[lh_idx+1] = single_hand['left_hand'][1]
+                    if 'right_hand' in single_hand:
+                        label_mask[rh_idx] = label_mask[rh_idx+1] = 1.0
+                        label[rh_idx] = single_hand['right_hand'][0]
+                        label[rh_idx+1] = single_hand['right_hand'][1]
+
+            rows["label"].append(label)
+            rows["label_mask"].append(label_mask)
+
+    columns = {
+        "clip_id": np.array(rows["clip_id"], dtype=np.int64),
+        "clip_uid": np.array(rows["clip_uid"], dtype=np.int32),
+        "video_uid": np.array(rows["video_uid"], dtype=np.int32),
+        "idx": np.array(rows["idx"], dtype=np.int32),
+        "action_start_frame": np.array(rows["action_start_frame"], dtype=np.int64),
+        "action_end_frame": np.array(rows["action_end_frame"], dtype=np.int64),
+        "pre_45_frame": np.array(rows["pre_45_frame"], dtype=np.int64),
+        "pre_frame": np.array(rows["pre_frame"], dtype=np.int64),
+        "label": np.array(rows["label"], dtype=np.float32).reshape(-1, 20),
+        "label_mask": np.array(rows["label_mask"], dtype=np.float32).reshape(-1, 20),
+    }
+    vocabs = {k: v.strings for k, v in interner.items()}
+    AnnotationTable.write(path, columns, vocabs, json_path)
+
+
+def load_annotation_table(json_path, compile_fn, cache_dir=None):
+    """
+        load the compiled table of `json_path`, compile it first if it does not exist or the json file is newer
+
+        Parameters:
+            json_path: str, path of annotation file
+            compile_fn: one of compile_fho_* functions
+            cache_dir: str, directory of compiled tables, default: "compiled" directory next to the json file
+
+        Return:
+            table: AnnotationTable
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(json_path), "compiled")
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, os.path.splitext(os.path.basename(json_path))[0])
+
+    if os.path.exists(path):
+        with open(os.path.join(path, "meta.json"), "r") as fp:
+            meta = json.load(fp)
+        if meta["source_mtime"] >= os.path.getmtime(json_path):
+            return AnnotationTable(path)
+        # stale, compile again
+        shutil.rmtree(path, ignore_errors=True)
+
+    compile_fn(json_path, path)
+    return AnnotationTable(path)
+
+
+class ViewIndex(object):
+    """
+        map a flat sample index to (row, view), where row `r` of an annotation table is expanded
+        into `num_views[r]` views (e.g., temporal windows x spatial crops in test mode)
+
+        Only one offset per row is stored, no per-view record is materialised.
+
+        Parameters:
+            num_views: int if all rows have the same number of views, otherwise np.ndarray of shape (num_rows, )
+            num_rows: int, number of rows, required when num_views is an int
+    """
+
+    def __init__(self, num_views, num_rows=None):
+        if np.isscalar(num_views):
+            assert num_rows is not None, "num_rows is required for a constant number of views"
+            self.num_views = int(num_views)
+            self.length = self.num_views * num_rows
+            self.offsets = None
+        else:
+            num_views = np.asarray(num_views, dtype=np.int64)
+            self.num_views = num_views
+            self.length = int(num_views.sum())
+            # offsets[r] is the flat index of the first view of row r
+            self.offsets = np.concatenate([[0], np.cumsum(num_views)[:-1]])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(f"index {index} out of range for {self.length} samples")
+
+        if self.offsets is None:
+            return index // self.num_views, index % self.num_views
+
+        row = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return row, index - int(self.offsets[row])
@@ -162,39 +162,44 @@ def lta_train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             # print(samples.shape, samples.device, targets[0].device, targets[1].device)
 
         
-        if loss_scaler is None:
-            # print("loss scaler is None")
-            samples = samples.half()
-            if flows is not None:
-                flows = flows.half()
-            loss, output = train_class_batch(
-                model, [samples, flows], targets, criterion)
-        else:
-            with torch.cuda.amp.autocast():
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, loss_scaler is not None and not update_grad):
+            if loss_scaler is None:
+                # print("loss scaler is None")
+                samples = samples.half()
+                if flows is not None:
+                    flows = flows.half()
                 loss, output = train_class_batch(
                     model, [samples, flows], targets, criterion)
+            else:
+                with torch.cuda.amp.autocast():
+                    loss, output = train_class_batch(
+                        model, [samples, flows], targets, criterion)
 
-        loss_value = loss.item()
+            loss_value = loss.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        if loss_scaler is None:
-            loss /= update_freq
-            model.backward(loss)
-            model.step()
+            if loss_scaler is None:
+                loss /= update_freq
+                model.backward(loss)
+                model.step()
 
-            grad_norm = None
-            loss_scale_value = get_loss_scale_for_deepspeed(model)
-        else:
-            # this attribute is added by timm on one optimizer (adahessian)
-            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-            loss /= update_freq
-            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                    parameters=model.parameters(), create_graph=is_second_order,
-                                    update_grad=(data_iter_step + 1) % update_freq == 0)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
+                grad_norm = None
+                loss_scale_value = get_loss_scale_for_deepspeed(model)
+            else:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                loss /= update_freq
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+                if update_grad:
+                    optimizer.zero_grad()
 
         torch.cuda.synchronize()
 
@@ -328,40 +333,45 @@ def osccpnr_train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             samples, targets = mixup_fn(samples, targets)
             # print(samples.shape, samples.device, targets[0].device, targets[1].device)
 
-        if loss_scaler is None:
-            # print("loss scaler is None")
-            samples = samples.half()
-            if flows is not None:
-                flows = flows.half()
-            loss, output = train_class_batch(
-                model, [samples, flows], targets, criterion)
-
-        else:
-            with torch.cuda.amp.autocast():
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, loss_scaler is not None and not update_grad):
+            if loss_scaler is None:
+                # print("loss scaler is None")
+                samples = samples.half()
+                if flows is not None:
+                    flows = flows.half()
                 loss, output = train_class_batch(
                     model, [samples, flows], targets, criterion)
+
+            else:
+                with torch.cuda.amp.autocast():
+                    loss, output = train_class_batch(
+                        model, [samples, flows], targets, criterion)
         
-        loss_value = loss.item()
+            loss_value = loss.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        if loss_scaler is None:
-            loss /= update_freq
-            model.backward(loss)
-            model.step()
+            if loss_scaler is None:
+                loss /= update_freq
+                model.backward(loss)
+                model.step()
 
-            grad_norm = None
-            loss_scale_value = get_loss_scale_for_deepspeed(model)
-        else:
-            # this attribute is added by timm on one optimizer (adahessian)
-            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-            loss /= update_freq
-            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                    parameters=model.parameters(), create_graph=is_second_order,
-                                    update_grad=(data_iter_step + 1) % update_freq == 0)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
+                grad_norm = None
+                loss_scale_value = get_loss_scale_for_deepspeed(model)
+            else:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                loss /= update_freq
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+                if update_grad:
+                    optimizer.zero_grad()
 
         torch.cuda.synchronize()
 
@@ -449,46 +459,51 @@ def hands_train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         # if mixup_fn is not None:
         #     samples, targets = mixup_fn(samples, targets)
 
-        if loss_scaler is None:
-            # print("loss scaler is None")
-            samples = samples.half()
-
-            if flows is None:
-                output = model(samples)
-            else:
-                flows = flows.half()
-                output = model(samples, flows)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, loss_scaler is not None and not update_grad):
+            if loss_scaler is None:
+                # print("loss scaler is None")
+                samples = samples.half()
 
-        else:
-            with torch.cuda.amp.autocast():
                 if flows is None:
                     output = model(samples)
                 else:
                     flows = flows.half()
                     output = model(samples, flows)
 
-        loss = criterion(output, target_lst)
-        loss_value = loss.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
-
-        if loss_scaler is None:
-            loss /= update_freq
-            model.backward(loss)
-            model.step()
-
-            grad_norm = None
-            loss_scale_value = get_loss_scale_for_deepspeed(model)
-        else:
-            # this attribute is added by timm on one optimizer (adahessian)
-            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-            loss /= update_freq
-            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                    parameters=model.parameters(), create_graph=is_second_order,
-                                    update_grad=(data_iter_step + 1) % update_freq == 0)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
+            else:
+                with torch.cuda.amp.autocast():
+                    if flows is None:
+                        output = model(samples)
+                    else:
+                        flows = flows.half()
+                        output = model(samples, flows)
+
+            loss = criterion(output, target_lst)
+            loss_value = loss.item()
+
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
+
+            if loss_scaler is None:
+                loss /= update_freq
+                model.backward(loss)
+                model.step()
+
+                grad_norm = None
+                loss_scale_value = get_loss_scale_for_deepspeed(model)
+            else:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                loss /= update_freq
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+                if update_grad:
+                    optimizer.zero_grad()
 
         torch.cuda.synchronize()
 
@@ -590,40 +605,45 @@ def egoclip_train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         # if mixup_fn is not None:
         #     samples, targets = mixup_fn(samples, targets)
 
-        if loss_scaler is None:
-            # print("loss scaler is None")
-            samples = samples.half()
-            if flows is not None:
-                flows = flows.half()
-            loss, output = train_class_batch(
-                model, [samples, flows], targets, criterion)
-
-        else:
-            with torch.cuda.amp.autocast():
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, loss_scaler is not None and not update_grad):
+            if loss_scaler is None:
+                # print("loss scaler is None")
+                samples = samples.half()
+                if flows is not None:
+                    flows = flows.half()
                 loss, output = train_class_batch(
                     model, [samples, flows], targets, criterion)
 
-        loss_value = loss.item()
+            else:
+                with torch.cuda.amp.autocast():
+                    loss, output = train_class_batch(
+                        model, [samples, flows], targets, criterion)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            loss_value = loss.item()
 
-        if loss_scaler is None:
-            loss /= update_freq
-            model.backward(loss)
-            model.step()
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-            grad_norm = None
-            loss_scale_value = get_loss_scale_for_deepspeed(model)
-        else:
-            # this attribute is added by timm on one optimizer (adahessian)
-            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-            loss /= update_freq
-            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                    parameters=model.parameters(), create_graph=is_second_order,
-                                    update_grad=(data_iter_step + 1) % update_freq == 0)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
+            if loss_scaler is None:
+                loss /= update_freq
+                model.backward(loss)
+                model.step()
+
+                grad_norm = None
+                loss_scale_value = get_loss_scale_for_deepspeed(model)
+            else:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                loss /= update_freq
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+                if update_grad:
+                    optimizer.zero_grad()
 
         torch.cuda.synchronize()
 
@@ -695,7 +715,7 @@ def validation_one_epoch(data_loader, model, device, criterion, task):
             targets = targets.to(device, non_blocking=True) # tensor
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(enabled=torch.device(device).type == "cuda"):
             if flows is not None:
                 output = model(videos, flows)
                 loss = criterion(output, targets)
@@ -818,7 +838,7 @@ def final_test(data_loader, model, device, file, criterion):
             target = [labels, states]
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(enabled=torch.device(device).type == "cuda"):
             output = model(videos)
             # print(output.shape)
             loss = criterion(output, target)
@@ -874,7 +894,7 @@ def merge(eval_path, num_tasks):
             label = line.split(']')[1].split(' ')[1]
             chunk_nb = line.split(']')[1].split(' ')[2]
             split_nb = line.split(']')[1].split(' ')[3]
-            data = np.fromstring(line.split('[')[1].split(']')[0], dtype=np.float, sep=',')
+            data = np.fromstring(line.split('[')[1].split(']')[0], dtype=np.float64, sep=',')
             if not name in dict_feats:
                 dict_feats[name] = []
                 dict_label[name] = 0
@@ -11,7 +11,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import utils
 from einops import rearrange
-from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+from reconstruction_target import build_rgb_target, build_flow_target, sample_decode_mask
 
 from torchvision.utils import save_image
 
@@ -80,7 +80,8 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
 
                     train_wo_amp = False,
                     predict_preprocessed_flow = False,
-
+                    decode_ratio = 1.,
+                    update_freq=1,
                     ):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -97,7 +98,11 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
     # else:
     loss_func = nn.MSELoss()
 
-    for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
         if lr_schedule_values is not None or wd_schedule_values is not None:
@@ -108,38 +113,23 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
                     param_group["weight_decay"] = wd_schedule_values[it]
 
         videos, bool_masked_pos = batch[0], batch[1]
+        metric_logger.update_spans(**utils.worker_timing(batch))
 
         if len(videos.shape) == 6: # repeated sampling is used
             B, Repeat, C, T, H, W = videos.shape
             videos = videos.reshape(-1, *videos.shape[2:])
             bool_masked_pos = bool_masked_pos.reshape(-1, *bool_masked_pos.shape[2: ])
 
-        videos = videos.to(device, non_blocking=True)
+        with metric_logger.span("h2d"):
+            videos = videos.to(device, non_blocking=True)
         bool_masked_pos = bool_masked_pos.to(device, non_blocking=True).flatten(1).to(torch.bool)
+        # only a subset of masked tokens is decoded and reconstructed if decode_ratio < 1
+        decode_mask = sample_decode_mask(bool_masked_pos, decode_ratio)
 
         # use given target or simply reconstruct input video
         if not predict_preprocessed_flow:
-            with torch.no_grad():
-                # calculate the predict label
-                mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
-                std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
-
-                unnorm_videos = videos * std + mean  # in [0, 1]
-
-                if normlize_target:
-                    videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
-                    videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
-                        ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
-                    # we find that the mean is about 0.48 and standard deviation is about 0.08.
-
-                    videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
-                    B, _, C = videos_patch.shape
-                    labels = videos_patch[bool_masked_pos].reshape(B, -1, C)
-                else:
-
-                    videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
-                    B, _, C = videos_patch.shape
-                    labels = videos_patch[bool_masked_pos].reshape(B, -1, C)
+            # calculate the predict label
+            labels = build_rgb_target(videos, decode_mask, patch_size, normalize=normlize_target)
 
         else:
             # target will be processed in dataset code
@@ -154,51 +144,180 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
             assert T%N == 0, f"Number of flows:{T} to be predicted should be divisible by number of frames:{N}"
             # print(labels.shape)
             # print(f"label shape: {labels.shape}")
-            labels = rearrange(labels, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
 
             tublet_size = 2
-            bool_masked_pos_label = rearrange(bool_masked_pos, "b (t h w) -> b t h w", t=T//tublet_size, h=H//patch_size,w=W//patch_size)
+            bool_masked_pos_label = rearrange(decode_mask, "b (t h w) -> b t h w", t=T//tublet_size, h=H//patch_size,w=W//patch_size)
             bool_masked_pos_label = bool_masked_pos_label.repeat(1, N//(T//tublet_size), 1, 1)
             bool_masked_pos_label = bool_masked_pos_label.reshape(B, -1)
             # print(bool_masked_pos_label.shape)
             # print(labels.shape)
 
-            labels = labels[bool_masked_pos_label]
-            labels = rearrange(labels, '(b n) d -> b n d', b=B)
-
+            labels = build_flow_target(labels, bool_masked_pos_label, patch_size)
             labels = labels.to(device, non_blocking=True)
             # print(f"final label: {labels.shape}")
  
-        with torch.cuda.amp.autocast(enabled=not train_wo_amp):
-            outputs = model(videos, bool_masked_pos)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with metric_logger.span("fwd"), torch.cuda.amp.autocast(enabled=not train_wo_amp):
+                outputs = model(videos, bool_masked_pos, decode_mask=decode_mask if decode_ratio < 1 else None)
+
+                loss = loss_func(input=outputs, target=labels)
+
+            loss_value = loss.item()
+
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
+
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
+
+            loss /= update_freq
+            if not train_wo_amp:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad, span=metric_logger.span)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+            else:
+                with metric_logger.span("bwd"):
+                    loss.backward()
+                if update_grad:
+                    with metric_logger.span("opt"):
+                        optimizer.step()
 
-            loss = loss_func(input=outputs, target=labels)
+                grad_norm = 0
+                loss_scale_value = 0
 
-        loss_value = loss.item()
+        metric_logger.update(loss=loss_value)
+        metric_logger.update(loss_scale=loss_scale_value)
+        min_lr = 10.
+        max_lr = 0.
+        for group in optimizer.param_groups:
+            min_lr = min(min_lr, group["lr"])
+            max_lr = max(max_lr, group["lr"])
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+        metric_logger.update(lr=max_lr)
+        metric_logger.update(min_lr=min_lr)
+        weight_decay_value = None
+        for group in optimizer.param_groups:
+            if group["weight_decay"] > 0:
+                weight_decay_value = group["weight_decay"]
+        metric_logger.update(weight_decay=weight_decay_value)
+        metric_logger.update(grad_norm=grad_norm)
 
-        optimizer.zero_grad()
+        if log_writer is not None:
+            log_writer.update(loss=loss_value, head="loss")
+            log_writer.update(loss_scale=loss_scale_value, head="opt")
+            log_writer.update(lr=max_lr, head="opt")
+            log_writer.update(min_lr=min_lr, head="opt")
+            log_writer.update(weight_decay=weight_decay_value, head="opt")
+            log_writer.update(grad_norm=grad_norm, head="opt")
+            log_writer.set_step()
 
-        if not train_wo_amp:
-            # this attribute is added by timm on one optimizer (adahessian)
-            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                    parameters=model.parameters(), create_graph=is_second_order)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
-        else:
-            loss.backward()
-            optimizer.step()
+        if lr_scheduler is not None:
+            lr_scheduler.step_update(start_steps + step)
+    # gather the stats from all processes
+    metric_logger.synchronize_between_processes()
+    print("Averaged stats:", metric_logger)
+    span_stats = metric_logger.span_summary(log_writer)
+    return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()}, **span_stats}
 
-            grad_norm = 0
-            loss_scale_value = 0
 
-        torch.cuda.synchronize()
+def train_packed_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: torch.optim.Optimizer,
+                    device: torch.device, epoch: int, loss_scaler, max_norm: float = 0, patch_size: int = 16,
+                    normlize_target: bool = True, log_writer=None, lr_scheduler=None, start_steps=None,
+                    lr_schedule_values=None, wd_schedule_values=None,
+
+                    mask_generator = None,
+                    tubelet_size = 2,
+                    train_wo_amp = False,
+                    decode_ratio = 1.,
+                    update_freq=1,
+                    ):
+    """
+        VideoMAE pretraining on clips of different lengths packed into one sequence per step,
+        batches are built by utils.packed_samples_collate(), see PretrainVisionTransformer.forward_packed().
+        The loss is averaged over all reconstructed tokens, longer clips weigh more.
+    """
+    model.train()
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    metric_logger.add_meter('min_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    header = 'Epoch: [{}]'.format(epoch)
+    print_freq = 10
+
+    loss_func = nn.MSELoss()
+
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
+        # assign learning rate & weight decay for each step
+        it = start_steps + step  # global training iteration
+        if lr_schedule_values is not None or wd_schedule_values is not None:
+            for i, param_group in enumerate(optimizer.param_groups):
+                if lr_schedule_values is not None:
+                    param_group["lr"] = lr_schedule_values[it] * param_group["lr_scale"]
+                if wd_schedule_values is not None and param_group["weight_decay"] > 0:
+                    param_group["weight_decay"] = wd_schedule_values[it]
+
+        videos, num_frames = batch[0], batch[1]
+        metric_logger.update_spans(**utils.worker_timing(batch))
+        _, _, H, W = videos.shape
+        tubelets = (num_frames // tubelet_size).tolist()
+        seqlens = [t * (H // patch_size) * (W // patch_size) for t in tubelets]
+
+        with metric_logger.span("h2d"):
+            videos = videos.unsqueeze(0).to(device, non_blocking=True)
+        bool_masked_pos = mask_generator.packed(tubelets)[0]
+        bool_masked_pos = torch.from_numpy(bool_masked_pos).to(device, non_blocking=True).reshape(1, -1).to(torch.bool)
+        # only a subset of masked tokens of each clip is decoded and reconstructed if decode_ratio < 1
+        decode_mask = sample_decode_mask(bool_masked_pos, decode_ratio, seqlens=seqlens)
+
+        labels = build_rgb_target(videos, decode_mask, patch_size, normalize=normlize_target, tubelet_size=tubelet_size)
+
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with metric_logger.span("fwd"), torch.cuda.amp.autocast(enabled=not train_wo_amp):
+                outputs = model(videos, bool_masked_pos, decode_mask=decode_mask if decode_ratio < 1 else None,
+                                seqlens=seqlens)
+
+                loss = loss_func(input=outputs, target=labels)
+
+            loss_value = loss.item()
+
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
+
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
+
+            loss /= update_freq
+            if not train_wo_amp:
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                                        parameters=model.parameters(), create_graph=is_second_order,
+                                        update_grad=update_grad, span=metric_logger.span)
+                loss_scale_value = loss_scaler.state_dict()["scale"]
+            else:
+                with metric_logger.span("bwd"):
+                    loss.backward()
+                if update_grad:
+                    with metric_logger.span("opt"):
+                        optimizer.step()
+                grad_norm = 0
+                loss_scale_value = 0
 
         metric_logger.update(loss=loss_value)
         metric_logger.update(loss_scale=loss_scale_value)
+        metric_logger.update(tokens=sum(seqlens))
         min_lr = 10.
         max_lr = 0.
         for group in optimizer.param_groups:
@@ -216,6 +335,7 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
 
         if log_writer is not None:
             log_writer.update(loss=loss_value, head="loss")
+            log_writer.update(tokens=sum(seqlens), head="loss")
             log_writer.update(loss_scale=loss_scale_value, head="opt")
             log_writer.update(lr=max_lr, head="opt")
             log_writer.update(min_lr=min_lr, head="opt")
@@ -228,7 +348,8 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    span_stats = metric_logger.span_summary(log_writer)
+    return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()}, **span_stats}
 
 
 class TwoStreamVitLoss(nn.Module):
@@ -493,7 +614,8 @@ def train_tsvit_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimiz
                     weighted_flow2rgb_recons = False,
                     ctr="easy",
                     tau = 0.8,
-                    lamb = [0.25, 0.25, 0.25, 0.25],                    
+                    lamb = [0.25, 0.25, 0.25, 0.25],
+                    update_freq=1,
                     ):
 
     model.train()
@@ -505,7 +627,11 @@ def train_tsvit_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimiz
 
     loss_func = TwoStreamVitLoss(ctr=ctr, lamb=lamb, tau=tau)
 
-    for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
 
@@ -534,25 +660,8 @@ def train_tsvit_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimiz
 
         # use given target or simply reconstruct input video
 
-        with torch.no_grad():
-            # calculate the predict label
-            mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
-            std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
-
-            unnorm_videos = videos * std + mean  # in [0, 1]
-
-            if normlize_target:
-                videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
-                videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
-                    ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
-
-                videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[bool_masked_pos].reshape(B, -1, C)
-            else:
-                videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[bool_masked_pos].reshape(B, -1, C)
+        # calculate the predict label
+        rgb_target = build_rgb_target(videos, bool_masked_pos, patch_size, normalize=normlize_target)
 
         # target will be processed in dataset code
         # reconstruct entire given flow images
@@ -563,16 +672,12 @@ def train_tsvit_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimiz
         assert T%N == 0, f"Number of flows:{T} to be predicted should be divisible by number of frames:{N}"
         # print(flows.shape)
 
-        flow_target = rearrange(flows, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
-
         tublet_size = 2
         bool_masked_pos_label = rearrange(bool_masked_pos, "b (t h w) -> b t h w", t=T//tublet_size, h=H//patch_size,w=W//patch_size)
         bool_masked_pos_label = bool_masked_pos_label.repeat(1, N//(T//tublet_size), 1, 1)
         bool_masked_pos_label = bool_masked_pos_label.reshape(B, -1)
 
-        flow_target = flow_target[bool_masked_pos_label]
-        flow_target = rearrange(flow_target, '(b n) d -> b n d', b=B)
-
+        flow_target = build_flow_target(flows, bool_masked_pos_label, patch_size)
         flow_target = flow_target.to(device, non_blocking=True)
 
         weight = None
@@ -598,28 +703,33 @@ def train_tsvit_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimiz
 
         # print(f"final label: {flows.shape}")
 
-        with torch.cuda.amp.autocast():
-            outputs = model(videos, flows, bool_masked_pos)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with torch.cuda.amp.autocast():
+                outputs = model(videos, flows, bool_masked_pos)
  
-            loss_dct = loss_func(outputs, [rgb_target, flow_target], weight=weight)
-            loss = loss_dct["sum"]
+                loss_dct = loss_func(outputs, [rgb_target, flow_target], weight=weight)
+                loss = loss_dct["sum"]
 
-        loss_value = new_func(loss)
+            loss_value = new_func(loss)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        optimizer.zero_grad()
-        if flow_optimizer is not None:
-            flow_optimizer.zero_grad()
-        # this attribute is added by timm on one optimizer (adahessian)
-        is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer if flow_optimizer is None else [optimizer, flow_optimizer], 
-                                clip_grad=max_norm, parameters=model.parameters(),
-                                create_graph=is_second_order)
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
+                if flow_optimizer is not None:
+                    flow_optimizer.zero_grad()
+            loss /= update_freq
+            # this attribute is added by timm on one optimizer (adahessian)
+            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+            grad_norm = loss_scaler(loss, optimizer if flow_optimizer is None else [optimizer, flow_optimizer], 
+                                    clip_grad=max_norm, parameters=model.parameters(),
+                                    create_graph=is_second_order, update_grad=update_grad)
 
-        loss_scale_value = loss_scaler.state_dict()["scale"]
+            loss_scale_value = loss_scaler.state_dict()["scale"]
 
         torch.cuda.synchronize()
 
@@ -778,6 +888,8 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
                     num_tokens = 1568,
                     mask_generator = None,
                     lamb = [1,1,1,1],
+                    decode_ratio = 1.,
+                    update_freq=1,
                     ):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -788,7 +900,11 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
 
     loss_func = MultiModalLoss(lamb=lamb)
 
-    for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
 
@@ -800,6 +916,7 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
                     param_group["weight_decay"] = wd_schedule_values[it]
 
         videos, flows = batch[0], batch[1]
+        metric_logger.update_spans(**utils.worker_timing(batch))
         B, *_ = videos.shape
         mask_batch = B # batch for generating mask
 
@@ -810,8 +927,9 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
             flows = flows.reshape(-1, *flows.shape[2:])
             mask_batch = B * repeat
 
-        videos = videos.to(device, non_blocking=True)
-        flows = flows.to(device, non_blocking=True)
+        with metric_logger.span("h2d"):
+            videos = videos.to(device, non_blocking=True)
+            flows = flows.to(device, non_blocking=True)
 
         # process mask
         mask_lst = mask_generator(batch_size=mask_batch)
@@ -831,27 +949,18 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
         rgb_mask = torch.from_numpy(rgb_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
         flow_mask = torch.from_numpy(flow_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
 
-        # use given target or simply reconstruct input video
-
-        with torch.no_grad():
-            # calculate the predict label
-            mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
-            std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
-
-            unnorm_videos = videos * std + mean  # in [0, 1]
+        # only a subset of masked tokens is decoded and reconstructed if decode_ratio < 1,
+        # rgb and flow share the sampling noise so that identical masks keep identical subsets
+        rgb_decode_mask, flow_decode_mask = rgb_mask, flow_mask
+        if decode_ratio < 1:
+            noise = torch.rand(rgb_mask.shape, device=device)
+            rgb_decode_mask = sample_decode_mask(rgb_mask, decode_ratio, noise)
+            flow_decode_mask = sample_decode_mask(flow_mask, decode_ratio, noise)
 
-            if normlize_target:
-                videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
-                videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
-                    ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
+        # use given target or simply reconstruct input video
 
-                videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
-            else:
-                videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
+        # calculate the predict label
+        rgb_target = build_rgb_target(videos, rgb_decode_mask, patch_size, normalize=normlize_target)
 
         # target will be processed in dataset code
         # reconstruct entire given flow images
@@ -862,39 +971,35 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
         assert T%N == 0, f"Number of flows:{N} to be predicted should be divisible by number of frames:{T}"
         # print(flows.shape)
 
-        flow_target = rearrange(flows, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
+        flow_target = build_flow_target(flows, flow_decode_mask, patch_size)
 
-        # tublet_size = 2
-        # bool_masked_pos_label = rearrange(bool_masked_pos, "b (t h w) -> b t h w", t=T//tublet_size, h=H//patch_size,w=W//patch_size)
-        # bool_masked_pos_label = bool_masked_pos_label.repeat(1, N//(T//tublet_size), 1, 1)
-        # bool_masked_pos_label = bool_masked_pos_label.reshape(B, -1)
-
-        flow_target = flow_target[flow_mask]
-        flow_target = rearrange(flow_target, '(b n) d -> b n d', b=B)
-        flow_target = flow_target.to(device, non_blocking=True)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with metric_logger.span("fwd"), torch.cuda.amp.autocast():
+                outputs = model(videos, flows, rgb_mask, flow_mask,
+                                rgb_decode_mask=rgb_decode_mask, flow_decode_mask=flow_decode_mask)
 
-        with torch.cuda.amp.autocast():
-            outputs = model(videos, flows, rgb_mask, flow_mask)
+                loss_dct = loss_func(outputs, rgb_target, flow_target)
+                loss = loss_dct["sum"]
 
-            loss_dct = loss_func(outputs, rgb_target, flow_target)
-            loss = loss_dct["sum"]
+            loss_value = new_func(loss)
 
-        loss_value = new_func(loss)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
 
-        optimizer.zero_grad()
-
-        # this attribute is added by timm on one optimizer (adahessian)
-        is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
-                                create_graph=is_second_order)
-
-        loss_scale_value = loss_scaler.state_dict()["scale"]
+            loss /= update_freq
+            # this attribute is added by timm on one optimizer (adahessian)
+            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
+                                    create_graph=is_second_order, update_grad=update_grad,
+                                    span=metric_logger.span)
 
-        torch.cuda.synchronize()
+            loss_scale_value = loss_scaler.state_dict()["scale"]
 
         recons_loss = 0
         cross_recons = 0
@@ -957,7 +1062,8 @@ def train_multimodal_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    span_stats = metric_logger.span_summary(log_writer)
+    return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()}, **span_stats}
 
 
 class BottleneckLoss(nn.Module):
@@ -1000,6 +1106,8 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
                     num_tokens = 1568,
                     mask_generator = None,
                     lamb = [1,1],
+                    decode_ratio = 1.,
+                    update_freq=1,
                     ):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -1010,7 +1118,11 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
 
     loss_func = BottleneckLoss(lamb=lamb)
 
-    for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
 
@@ -1022,6 +1134,7 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
                     param_group["weight_decay"] = wd_schedule_values[it]
 
         videos, flows = batch[0], batch[1]
+        metric_logger.update_spans(**utils.worker_timing(batch))
         B, *_ = videos.shape
         mask_batch = B # batch for generating mask
 
@@ -1032,8 +1145,9 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
             flows = flows.reshape(-1, *flows.shape[2:])
             mask_batch = B * repeat
 
-        videos = videos.to(device, non_blocking=True)
-        flows = flows.to(device, non_blocking=True)
+        with metric_logger.span("h2d"):
+            videos = videos.to(device, non_blocking=True)
+            flows = flows.to(device, non_blocking=True)
 
         # process mask
         mask_lst = mask_generator(batch_size=mask_batch)
@@ -1053,27 +1167,18 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
         rgb_mask = torch.from_numpy(rgb_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
         flow_mask = torch.from_numpy(flow_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
 
-        # use given target or simply reconstruct input video
-
-        with torch.no_grad():
-            # calculate the predict label
-            mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
-            std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
-
-            unnorm_videos = videos * std + mean  # in [0, 1]
+        # only a subset of masked tokens is decoded and reconstructed if decode_ratio < 1,
+        # rgb and flow share the sampling noise so that identical masks keep identical subsets
+        rgb_decode_mask, flow_decode_mask = rgb_mask, flow_mask
+        if decode_ratio < 1:
+            noise = torch.rand(rgb_mask.shape, device=device)
+            rgb_decode_mask = sample_decode_mask(rgb_mask, decode_ratio, noise)
+            flow_decode_mask = sample_decode_mask(flow_mask, decode_ratio, noise)
 
-            if normlize_target:
-                videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
-                videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
-                    ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
+        # use given target or simply reconstruct input video
 
-                videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
-            else:
-                videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
+        # calculate the predict label
+        rgb_target = build_rgb_target(videos, rgb_decode_mask, patch_size, normalize=normlize_target)
 
         # target will be processed in dataset code
         # reconstruct entire given flow images
@@ -1084,34 +1189,35 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
         assert T%N == 0, f"Number of flows:{N} to be predicted should be divisible by number of frames:{T}"
         # print(flows.shape)
 
-        flow_target = rearrange(flows, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
+        flow_target = build_flow_target(flows, flow_decode_mask, patch_size)
 
-        flow_target = flow_target[flow_mask]
-        flow_target = rearrange(flow_target, '(b n) d -> b n d', b=B)
-        flow_target = flow_target.to(device, non_blocking=True)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with metric_logger.span("fwd"), torch.cuda.amp.autocast():
+                outputs = model(videos, flows, rgb_mask, flow_mask,
+                                rgb_decode_mask=rgb_decode_mask, flow_decode_mask=flow_decode_mask)
 
-        with torch.cuda.amp.autocast():
-            outputs = model(videos, flows, rgb_mask, flow_mask)
+                loss_dct = loss_func(outputs, rgb_target, flow_target)
+                loss = loss_dct["sum"]
 
-            loss_dct = loss_func(outputs, rgb_target, flow_target)
-            loss = loss_dct["sum"]
+            loss_value = new_func(loss)
 
-        loss_value = new_func(loss)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
 
-        optimizer.zero_grad()
-
-        # this attribute is added by timm on one optimizer (adahessian)
-        is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
-                                create_graph=is_second_order)
-
-        loss_scale_value = loss_scaler.state_dict()["scale"]
+            loss /= update_freq
+            # this attribute is added by timm on one optimizer (adahessian)
+            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
+                                    create_graph=is_second_order, update_grad=update_grad,
+                                    span=metric_logger.span)
 
-        torch.cuda.synchronize()
+            loss_scale_value = loss_scaler.state_dict()["scale"]
 
         recons_loss = 0
         cross_recons = 0
@@ -1161,7 +1267,8 @@ def train_bottleneck_one_epoch(model: torch.nn.Module, data_loader: Iterable, op
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    span_stats = metric_logger.span_summary(log_writer)
+    return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()}, **span_stats}
 
 
 class MultiCAELoss(nn.Module):
@@ -1201,6 +1308,7 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
                     mask_generator = None,
                     num_tokens = None,
                     lamb = [1,1,1,1],
+                    update_freq=1,
                     ):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -1211,7 +1319,11 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
 
     loss_func = MultiCAELoss(lamb=lamb)
 
-    for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    num_training_steps_per_epoch = len(data_loader) // update_freq
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        step = data_iter_step // update_freq
+        if step >= num_training_steps_per_epoch:
+            continue
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
 
@@ -1223,6 +1335,7 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
                     param_group["weight_decay"] = wd_schedule_values[it]
 
         videos, flows = batch[0], batch[1]
+        metric_logger.update_spans(**utils.worker_timing(batch))
         mask_batch = videos.shape[0]
 
         if len(videos.shape) == 6: # repeated sampling is used
@@ -1244,31 +1357,15 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
             rgb_mask = np.stack(rgb_mask, axis=0)
             flow_mask = np.stack(flow_mask, axis=0)
 
-        videos = videos.to(device, non_blocking=True)
+        with metric_logger.span("h2d"):
+            videos = videos.to(device, non_blocking=True)
         rgb_mask = torch.from_numpy(rgb_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
         flow_mask = torch.from_numpy(flow_mask).to(device, non_blocking=True).flatten(1).to(torch.bool)
 
         # use given target or simply reconstruct input video
 
-        with torch.no_grad():
-            # calculate the predict label
-            mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(device)[None, :, None, None, None]
-            std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(device)[None, :, None, None, None]
-
-            unnorm_videos = videos * std + mean  # in [0, 1]
-
-            if normlize_target:
-                videos_squeeze = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2) c', p0=2, p1=patch_size, p2=patch_size)
-                videos_norm = (videos_squeeze - videos_squeeze.mean(dim=-2, keepdim=True)
-                    ) / (videos_squeeze.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6)
-
-                videos_patch = rearrange(videos_norm, 'b n p c -> b n (p c)')
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
-            else:
-                videos_patch = rearrange(unnorm_videos, 'b c (t p0) (h p1) (w p2) -> b (t h w) (p0 p1 p2 c)', p0=2, p1=patch_size, p2=patch_size)
-                B, _, C = videos_patch.shape
-                rgb_target = videos_patch[rgb_mask].reshape(B, -1, C)
+        # calculate the predict label
+        rgb_target = build_rgb_target(videos, rgb_mask, patch_size, normalize=normlize_target)
 
         # target will be processed in dataset code
         # reconstruct entire given flow images
@@ -1279,45 +1376,41 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
         assert T%N == 0, f"Number of flows:{T} to be predicted should be divisible by number of frames:{N}"
         # print(flows.shape)
 
-        flow_target = rearrange(flows, 'b c t (h p1) (w p2) -> b (t h w) (p1 p2 c)', p1=patch_size, p2=patch_size)
-
-        # tublet_size = 2
-        # bool_masked_pos_label = rearrange(bool_masked_pos, "b (t h w) -> b t h w", t=T//tublet_size, h=H//patch_size,w=W//patch_size)
-        # bool_masked_pos_label = bool_masked_pos_label.repeat(1, N//(T//tublet_size), 1, 1)
-        # bool_masked_pos_label = bool_masked_pos_label.reshape(B, -1)
-
-        with torch.cuda.amp.autocast():
-            p = random.random()
-            if p > 0.5:
-                flows = None
-                flow_target = flow_target[rgb_mask]
-            else:
-                flow_target = flow_target[flow_mask]
-
-            flow_target = rearrange(flow_target, '(b n) d -> b n d', b=B)
-            flow_target = flow_target.to(device, non_blocking=True)
+        # skip gradient all-reduce of DDP on accumulation steps
+        update_grad = (data_iter_step + 1) % update_freq == 0
+        with utils.no_sync_context(model, not update_grad):
+            with metric_logger.span("fwd"), torch.cuda.amp.autocast():
+                p = random.random()
+                if p > 0.5:
+                    flow_target = build_flow_target(flows, rgb_mask, patch_size)
+                    flows = None
+                else:
+                    flow_target = build_flow_target(flows, flow_mask, patch_size)
 
-            outputs = model(videos, flows, rgb_mask, flow_mask)
+                flow_target = flow_target.to(device, non_blocking=True)
 
-            loss_dct = loss_func(outputs, rgb_target, flow_target)
-            loss = loss_dct["sum"]
+                outputs = model(videos, flows, rgb_mask, flow_mask)
 
-        loss_value = new_func(loss)
+                loss_dct = loss_func(outputs, rgb_target, flow_target)
+                loss = loss_dct["sum"]
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+            loss_value = new_func(loss)
 
-        optimizer.zero_grad()
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
-        # this attribute is added by timm on one optimizer (adahessian)
-        is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
-                                create_graph=is_second_order)
+            if data_iter_step % update_freq == 0:
+                optimizer.zero_grad()
 
-        loss_scale_value = loss_scaler.state_dict()["scale"]
+            loss /= update_freq
+            # this attribute is added by timm on one optimizer (adahessian)
+            is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+            grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm, parameters=model.parameters(),
+                                    create_graph=is_second_order, update_grad=update_grad,
+                                    span=metric_logger.span)
 
-        torch.cuda.synchronize()
+            loss_scale_value = loss_scaler.state_dict()["scale"]
 
         metric_logger.update(loss=loss_value)
         metric_logger.update(rgb_recons_loss=loss_dct["rgb_recons"])
@@ -1369,7 +1462,8 @@ def train_multicae_one_epoch(model: torch.nn.Module, data_loader: Iterable, opti
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}    
+    span_stats = metric_logger.span_summary(log_writer)
+    return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()}, **span_stats}    
 
 
 
@@ -1,5 +1,6 @@
 import os
 import csv
+import time
 import pandas as pd
 import torch
 import torch.utils.data
@@ -13,6 +14,7 @@ from PIL import Image
 import video_transforms as transform
 import epickitchens_utils as utils
 from epickitchens_record import EpicKitchensVideoRecord
+from frame_cache import get_frame_cache
 
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
@@ -112,12 +114,14 @@ def pack_frames_to_video_clip(cfg, video_record, target_fps=60,
                             as_pil = False,
                             mode = "train",
                             cache_manager= None,
+                            frame_idx = None,
                             ):
 
     """
         ...
 
         as_pil (bool): whether return frames as pil image
+        frame_idx (tensor): indexes of frames to load, sampled randomly if None
         flow_mode (str): work with use_preprocessed_flow, indicates different flow image sampling strategy
         flow_pretrain (bool): whether predicting flow images at pretraining
     """
@@ -158,34 +162,40 @@ def pack_frames_to_video_clip(cfg, video_record, target_fps=60,
     assert num_samples % 2 == 0, \
         "When pretraining on Epic-kitchen and predicting flow images, number of sampled frames should be even number"
 
-    start_idx, end_idx = get_start_end_idx(
-        video_record.num_frames,
-        num_samples * sampling_rate * fps / target_fps,
-    )
+    if frame_idx is None:
+        start_idx, end_idx = get_start_end_idx(
+            video_record.num_frames,
+            num_samples * sampling_rate * fps / target_fps,
+        )
 
-    start_idx, end_idx = start_idx + 1, end_idx + 1
-    frame_idx = temporal_sampling(video_record.num_frames,
-                                  start_idx, end_idx, num_samples,
-                                  start_frame = video_record.start_frame,
-                                  )
+        start_idx, end_idx = start_idx + 1, end_idx + 1
+        frame_idx = temporal_sampling(video_record.num_frames,
+                                      start_idx, end_idx, num_samples,
+                                      start_frame = video_record.start_frame,
+                                      )
+
+    # node-local shared-memory cache of compressed frames, see frame_cache.py
+    frame_cache = None
+    if getattr(cfg.DATA, "FRAME_CACHE", None):
+        frame_cache = get_frame_cache(cfg.DATA.FRAME_CACHE, size=int(getattr(cfg.DATA, "FRAME_CACHE_GB", 0) * 2 ** 30))
 
     if getattr(cfg.DATA, "READ_FROM_TAR", None):
         source = path_to_video
         name = f"{video_record.untrimmed_video_name}_{video_record._index}"
-        frames = utils.read_from_tarfile(source, name, frame_idx, as_pil=as_pil, flow=False)
+        frames = utils.read_from_tarfile(source, name, frame_idx, as_pil=as_pil, flow=False, frame_cache=frame_cache)
 
         source = path_to_flow
-        uflows, vflows = utils.read_from_tarfile(source, name, frame_idx, as_pil=as_pil, flow=True)
+        uflows, vflows = utils.read_from_tarfile(source, name, frame_idx, as_pil=as_pil, flow=True, frame_cache=frame_cache)
         return frames, uflows, vflows
 
     elif getattr(cfg.DATA, "READ_FROM_ZIP", None):
 
         source = path_to_video
         name = f"{video_record.untrimmed_video_name}_{video_record._index}"
-        frames = utils.read_from_zip_file(source, name, frame_idx, as_pil=as_pil, flow=False)
+        frames = utils.read_from_zip_file(source, name, frame_idx, as_pil=as_pil, flow=False, frame_cache=frame_cache)
 
         source = path_to_flow
-        uflows, vflows = utils.read_from_zip_file(source, name, frame_idx, as_pil=as_pil, flow=True)
+        uflows, vflows = utils.read_from_zip_file(source, name, frame_idx, as_pil=as_pil, flow=True, frame_cache=frame_cache)
         return frames, uflows, vflows
 
     img_paths = [os.path.join(path_to_video, img_tmpl.format(idx.item())) for idx in frame_idx]
@@ -264,6 +274,58 @@ def pack_frames_to_video_clip(cfg, video_record, target_fps=60,
     #     pass
 
 
+def pack_repeated_views(cfg, video_record, num_views, window_scale=1.5, target_fps=60,
+                        mode="train", cache_manager=None):
+    """
+        decode a temporal window once and draw num_views clips from it for repeated sampling
+
+        Frame pairs are sampled on a grid over a window window_scale times as long as a clip, with the same
+        spacing as a single clip. Each view takes NUM_FRAMES // 2 consecutive pairs of the grid from a distinct
+        start when possible, only the part of the grid covered by the views is loaded.
+
+        Return:
+            frames (tensor): uint8, N x H x W x 3, decoded rgb frames of the window
+            flows (tensor): uint8, N // 2 x H x W x 2, decoded u/v flow images of the window
+            frame_views (tensor): long, num_views x NUM_FRAMES, index of each view's frames in frames
+            flow_views (tensor): long, num_views x NUM_FRAMES // 2, index of each view's flows in flows
+    """
+    fps, sampling_rate, num_samples = video_record.fps, cfg.DATA.SAMPLING_RATE, cfg.DATA.NUM_FRAMES
+    num_pairs = num_samples // 2
+
+    clip_size = num_samples * sampling_rate * fps / target_fps
+    window_size = min(clip_size * window_scale, max(video_record.num_frames, clip_size))
+    num_grid = max(num_pairs, round((num_pairs - 1) * window_size / clip_size) + 1)
+
+    start_idx, end_idx = get_start_end_idx(video_record.num_frames, window_size)
+    start_idx, end_idx = start_idx + 1, end_idx + 1
+    grid = temporal_sampling(video_record.num_frames,
+                             start_idx, end_idx, num_grid * 2,
+                             start_frame = video_record.start_frame,
+                             )
+
+    num_starts = num_grid - num_pairs + 1
+    if num_starts >= num_views:
+        starts = random.sample(range(num_starts), num_views)
+    else:
+        starts = [random.randrange(num_starts) for _ in range(num_views)]
+    first, last = min(starts), max(starts) + num_pairs
+
+    frames, uflows, vflows = pack_frames_to_video_clip(
+        cfg, video_record, target_fps=target_fps, as_pil=True, mode=mode,
+        cache_manager=cache_manager, frame_idx=grid[2 * first: 2 * last],
+    )
+    frames = torch.from_numpy(np.stack([np.asarray(img.convert("RGB")) for img in frames]))
+    flows = torch.from_numpy(np.stack([
+        np.stack([np.asarray(u), np.asarray(v)], axis=-1) for u, v in zip(uflows, vflows)
+    ]))
+
+    starts = torch.as_tensor(starts) - first
+    flow_views = starts[:, None] + torch.arange(num_pairs)
+    frame_views = 2 * starts[:, None] + torch.arange(num_samples)
+
+    return frames, flows, frame_views, flow_views
+
+
 """
 Used Configuration:
 
@@ -277,6 +339,10 @@ DATA.MEAN                       float that represents mean used to normalize dat
 DATA.STD                        float that represents std used to normalize dataset
 DATA.SAMPLING_RATE              int 
 DATA.NUM_FRAMES                 int 
+DATA.REPEATED_SAMPLING          int, number of views drawn from one decoded window, 0 for a single clip
+DATA.REPEATED_SAMPLING_WINDOW   (optional) float, length of the decoded window relative to a clip, default 1.5
+DATA.FRAME_CACHE                (optional) path of the node-local frame cache arena, e.g. /dev/shm/ssvl_frame_cache
+DATA.FRAME_CACHE_GB             (optional) byte budget in GB if the arena is created by the dataset
 
 # train, val, trian+val
 DATA.TRAIN_JITTER_SCALES
@@ -408,10 +474,27 @@ class Epickitchens(torch.utils.data.Dataset):
         #         "Does not support {} mode".format(self.mode)
         #     )
 
+        # seconds spent in the worker are returned in metadata["timing"], see utils.worker_timing
+        start = time.perf_counter()
+        num_views = int(self.cfg.DATA.REPEATED_SAMPLING)
+        if num_views > 0:
+            # decode once, augment all views in one pass
+            frames, flows, frame_views, flow_views = pack_repeated_views(
+                self.cfg, self._video_records[index], num_views,
+                window_scale=getattr(self.cfg.DATA, "REPEATED_SAMPLING_WINDOW", 1.5),
+                target_fps=self.target_fps, mode=self.mode, cache_manager=self.cache_manager,
+            )
+            decoded = time.perf_counter()
+            frames, flows = self.pretrain_transform.repeated(frames, flows, frame_views, flow_views)
+            metadata = self._video_records[index].metadata
+            metadata["timing"] = {"decode": decoded - start, "augment": time.perf_counter() - decoded}
+            return frames, flows, self._video_records[index].label, index, metadata
+
         data = pack_frames_to_video_clip(
             self.cfg, self._video_records[index], 
             as_pil=True, mode=self.mode, cache_manager=self.cache_manager
         )
+        decoded = time.perf_counter()
 
         frames, *flows = data  # list of pil, [list of pil, list of pil]
         frames, flows = self.pretrain_transform((frames, flows)) # frames shape: C*T, H, W
@@ -454,13 +537,7 @@ class Epickitchens(torch.utils.data.Dataset):
         # commented by jiachen, if use slowfast network, then uncomment this line
         # frames = utils.pack_pathway_output(self.cfg, frames)
         metadata = self._video_records[index].metadata
-
-        if self.cfg.DATA.REPEATED_SAMPLING > 0:
-            frames = [frames for i in range(int(self.cfg.DATA.REPEATED_SAMPLING))]
-            flows = [flows for i in range(int(self.cfg.DATA.REPEATED_SAMPLING))]
-
-            frames = torch.stack(frames, dim=0)
-            flows = torch.stack(flows, dim=0)
+        metadata["timing"] = {"decode": decoded - start, "augment": time.perf_counter() - decoded}
 
         # print(frames.shape, mask.shape, flows.shape)
         # is pretrain, then
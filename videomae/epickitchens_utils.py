@@ -22,6 +22,9 @@ import multiprocessing as mlp
 import threading as th
 from collections import defaultdict
 
+from frame_cache import frame_key
+from toolbox.tar_index import TarIndexReader
+
 class CacheManager(object):
 
     def __init__(self, address:tuple, local_world_size:int, log_path="./"):
@@ -451,81 +454,125 @@ def extract_zip(path_to_save, ext="tar", frame_list = [], flow=False, cache_dest
     logger.info(f"Finish processing zipfile {path_to_save}, time taken: {end_time-start_time}")
 
 
-def read_from_tarfile(source, name, frame_idx, as_pil=False, flow=False):
+class ArchiveReader(object):
+    """
+        read members of a tar/zip file through a FrameCache, the archive is only opened on cache misses.
+        tar files are read with os.pread() and their persisted member index (toolbox/tar_index.py)
+    """
+    def __init__(self, path, frame_cache=None):
+        self.path = path
+        self.frame_cache = frame_cache
+        self.archive = None
+
+    def _read_archive(self, members):
+        if self.archive is None:
+            self.archive = zipfile.ZipFile(self.path) if self.path.endswith(".zip") else TarIndexReader(self.path)
+        if isinstance(self.archive, TarIndexReader):
+            return self.archive.read_batch(members)
+
+        outputs = []
+        for member in members:
+            try:
+                outputs.append(self.archive.read(member))
+            except KeyError:
+                outputs.append(None)
+        return outputs
+
+    def read_batch(self, members):
+        """
+            Return:
+                list of bytes in the order of members, None for members that are not in the archive
+        """
+        unique_members = list(dict.fromkeys(members))
+        if self.frame_cache is None:
+            data = dict(zip(unique_members, self._read_archive(unique_members)))
+            return [data[member] for member in members]
+
+        data = {}
+        keys = {member: frame_key(self.path, member) for member in unique_members}
+        for member in unique_members:
+            data[member] = self.frame_cache.get(keys[member])
+
+        misses = [member for member in unique_members if data[member] is None]
+        if len(misses) != 0:
+            for member, member_data in zip(misses, self._read_archive(misses)):
+                if member_data is not None:
+                    self.frame_cache.put(keys[member], member_data)
+                data[member] = member_data
+
+        return [data[member] for member in members]
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_frames_from_archive(path, frame_idx, as_pil=False, flow=False, frame_cache=None):
     frame_list = [] if not flow else [[], []]
-    _debug_shape = []
-    with tarfile.open(os.path.join(source,f"{name}.tar")) as tf:
-        for i in range(0, len(frame_idx), 1 if not flow else 2):
-            idx = frame_idx[i]
-            if flow:
-                idx = idx // 2 + 1
-
-            img_name = "frame_{:010d}.jpg".format(idx)
+    # _debug_shape = []
+    img_names = []
+    for i in range(0, len(frame_idx), 1 if not flow else 2):
+        idx = frame_idx[i]
+        if flow:
+            idx = idx // 2 + 1
+        img_names.append("frame_{:010d}.jpg".format(idx))
+
+    # all frames of the clip are fetched in one pass
+    with ArchiveReader(path, frame_cache) as archive:
+        if flow:
+            members = [f"u/{img_name}" for img_name in img_names] + [f"v/{img_name}" for img_name in img_names]
+        else:
+            members = img_names
+        member_bytes = archive.read_batch(members)
+
+    for i, img_name in enumerate(img_names):
+        if flow:
+            uflow_bytes = member_bytes[i]
+            vflow_bytes = member_bytes[len(img_names) + i]
+            if uflow_bytes is None or vflow_bytes is None:
+                raise KeyError(f"flow image {img_name} not found in {path}")
+            uflow = Image.open(io.BytesIO(uflow_bytes))
+            vflow = Image.open(io.BytesIO(vflow_bytes))
+            if not as_pil:
+                uflow = np.array(uflow)
+                vflow = np.array(vflow)
+
+            frame_list[0].append(uflow)
+            frame_list[1].append(vflow)
 
-            if flow:
-                uflow_bytes = tf.extractfile(f"u/{img_name}").read()
-                vflow_bytes =  tf.extractfile(f"v/{img_name}").read()
-                uflow = Image.open(io.BytesIO(uflow_bytes))
-                vflow = Image.open(io.BytesIO(vflow_bytes))
+        else:
+            try:
+                rgb_bytes = member_bytes[i]
+                if rgb_bytes is None:
+                    raise KeyError(f"filename '{img_name}' not found")
+                rgb = Image.open(io.BytesIO(rgb_bytes))
                 if not as_pil:
-                    uflow = np.array(uflow)
-                    vflow = np.array(vflow)
-
-                frame_list[0].append(uflow)
-                frame_list[1].append(vflow)
- 
-            else:
-                try:
-                    rgb_bytes = tf.extractfile(img_name).read()
-                    rgb = Image.open(io.BytesIO(rgb_bytes))
-                    if not as_pil:
-                        rgb = np.array(rgb)
-                    _debug_shape.append(rgb.size)
-                    frame_list.append(rgb)
-                except Exception as e:
-                    print(source, name, frame_idx, img_name)
-                    print(e)
+                    rgb = np.array(rgb)
+                # _debug_shape.append(rgb.size)
+                frame_list.append(rgb)
+            except Exception as e:
+                print(path, frame_idx, img_name)
+                print(e)
     
     # print(_debug_shape)
     return frame_list
 
-def read_from_zip_file(source, name, frame_idx, as_pil=False, flow=False):
-    frame_list = [] if not flow else [[], []]
-    # _debug_shape = []
-    with zipfile.ZipFile(os.path.join(source,f"{name}.zip")) as zf:
-        for i in range(0, len(frame_idx), 1 if not flow else 2):
-            idx = frame_idx[i]
-            if flow:
-                idx = idx // 2 + 1
 
-            img_name = "frame_{:010d}.jpg".format(idx)
+def read_from_tarfile(source, name, frame_idx, as_pil=False, flow=False, frame_cache=None):
+    return read_frames_from_archive(os.path.join(source, f"{name}.tar"), frame_idx,
+                                    as_pil=as_pil, flow=flow, frame_cache=frame_cache)
 
-            if flow:
-                uflow_bytes = zf.read(f"u/{img_name}")
-                vflow_bytes =  zf.read(f"v/{img_name}")
-                uflow = Image.open(io.BytesIO(uflow_bytes))
-                vflow = Image.open(io.BytesIO(vflow_bytes))
-                if not as_pil:
-                    uflow = np.array(uflow)
-                    vflow = np.array(vflow)
 
-                frame_list[0].append(uflow)
-                frame_list[1].append(vflow)
- 
-            else:
-                try:
-                    rgb_bytes = zf.read(img_name)
-                    rgb = Image.open(io.BytesIO(rgb_bytes))
-                    if not as_pil:
-                        rgb = np.array(rgb)
-                    # _debug_shape.append(rgb.size)
-                    frame_list.append(rgb)
-                except Exception as e:
-                    print(source, name, frame_idx, img_name)
-                    print(e)
-    
-    # print(_debug_shape)
-    return frame_list
+def read_from_zip_file(source, name, frame_idx, as_pil=False, flow=False, frame_cache=None):
+    return read_frames_from_archive(os.path.join(source, f"{name}.zip"), frame_idx,
+                                    as_pil=as_pil, flow=flow, frame_cache=frame_cache)
 
 def retry_load_images(image_paths, retry=10, backend="pytorch", 
             as_pil=False, path_to_compressed="", online_extracting=False,
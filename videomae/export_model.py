@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+import modeling_finetune  # register models
+from fast_init import create_model_from_checkpoint
+
+try:
+    import onnxruntime
+    has_onnxruntime = True
+except ImportError:
+    has_onnxruntime = False
+
+
+EXPORTABLE_MODELS = (
+    modeling_finetune.OSCCModel,
+    modeling_finetune.VisionTransformer,
+    modeling_finetune.FutureHandsPredictionModel,
+    modeling_finetune.LongTermActionAnticipationModel,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Export finetuned models to inference artefacts', add_help=False)
+    parser.add_argument('--model', default='oscc_vit_base_patch16_224', type=str, help='name of the finetuned model')
+    parser.add_argument('--ckpt', required=True, help='finetuned checkpoint')
+    parser.add_argument('--model_key', default='model|module', type=str)
+    parser.add_argument('--output', required=True, help='path of the exported artefact')
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'export', 'onnx'],
+                        help='torchscript (torch.jit.trace + freeze), export (torch.export) or onnx')
+
+    # fixed input shape: batch_size, 3, num_frames, input_size, input_size
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_frames', default=16, type=int)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--tubelet_size', default=2, type=int)
+
+    parser.add_argument('--nb_classes', default=2, type=int)
+    parser.add_argument('--task', default='', type=str, help='oscc or pnr for OSCCModel')
+    parser.add_argument('--head_type', default='', type=str, help='head type of LongTermActionAnticipationModel')
+    parser.add_argument('--use_mean_pooling', action='store_true')
+    parser.set_defaults(use_mean_pooling=True)
+    parser.add_argument('--use_cls', action='store_false', dest='use_mean_pooling')
+
+    parser.add_argument('--device', default='cuda', help='device the artefact runs on')
+    parser.add_argument('--half', action='store_true', help='export in float16 (cuda only)')
+    return parser.parse_args()
+
+
+def load_finetuned_model(args):
+    """
+        build the finetuned model and load its weights only (optimizer, scaler and other training states are dropped)
+    """
+    model_kwargs = {}
+    if args.task:
+        model_kwargs["task"] = args.task
+    if args.head_type:
+        model_kwargs["head_type"] = args.head_type
+
+    model = create_model_from_checkpoint(
+        args.model,
+        args.ckpt,
+        model_key=args.model_key,
+        pretrained=False,
+        num_classes=args.nb_classes,
+        all_frames=args.num_frames,
+        tubelet_size=args.tubelet_size,
+        use_mean_pooling=args.use_mean_pooling,
+        **model_kwargs,
+    )
+    if not isinstance(model, EXPORTABLE_MODELS):
+        raise ValueError(f"Export of {type(model).__name__} is not supported")
+
+    return model.eval()
+
+
+@torch.no_grad()
+def export(model, example_input, path, format="torchscript"):
+    """
+        export model with the fixed input shape of example_input
+
+        Parameters:
+            model: nn.Module in eval mode, on the device of example_input
+            example_input: torch.Tensor, B, C, T, H, W
+            path: str, output path
+            format: str, torchscript, export or onnx
+    """
+    if format == "torchscript":
+        traced = torch.jit.trace(model, example_input, strict=False)
+        traced = torch.jit.freeze(traced)
+        torch.jit.save(traced, path)
+    elif format == "export":
+        program = torch.export.export(model, (example_input,))
+        torch.export.save(program, path)
+    elif format == "onnx":
+        torch.onnx.export(model, example_input, path, input_names=["videos"], opset_version=17)
+    else:
+        raise ValueError(f"Unknown export format:{format}")
+
+
+class ExportedModel(nn.Module):
+    """
+        runner of an exported artefact, inputs smaller than the exported batch size are padded
+    """
+    def __init__(self, module, meta, device):
+        super().__init__()
+        self.meta = meta
+        self.device = torch.device(device)
+        self.dtype = getattr(torch, meta["dtype"])
+        self.input_shape = tuple(meta["input_shape"])
+
+        if meta["format"] == "onnx":
+            self.session = module
+            self.module = None
+        else:
+            self.session = None
+            self.module = module
+
+    def train(self, mode=True):
+        # exported graphs are fixed to inference mode
+        self.training = False
+        return self
+
+    def run(self, x):
+        if self.session is not None:
+            outputs = self.session.run(None, {"videos": x.cpu().numpy()})
+            outputs = [torch.from_numpy(output).to(x.device) for output in outputs]
+            return outputs[0] if len(outputs) == 1 else outputs
+        return self.module(x)
+
+    @torch.no_grad()
+    def forward(self, x):
+        B = x.shape[0]
+        assert tuple(x.shape[1:]) == self.input_shape[1:], \
+            f"Input shape {tuple(x.shape)} does not match the exported shape {self.input_shape}"
+
+        x = x.to(self.device, self.dtype)
+        outputs = []
+        for start in range(0, B, self.input_shape[0]):
+            chunk = x[start: start + self.input_shape[0]]
+            num_pad = self.input_shape[0] - chunk.shape[0]
+            if num_pad > 0:
+                chunk = torch.cat([chunk, chunk.new_zeros(num_pad, *chunk.shape[1:])], dim=0)
+            outputs.append(self.run(chunk))
+
+        if isinstance(outputs[0], torch.Tensor):
+            return torch.cat(outputs, dim=0)[:B]
+        return type(outputs[0])(torch.cat(entries, dim=0)[:B] for entries in zip(*outputs))
+
+
+def load_exported(path, device="cuda"):
+    """
+        load an artefact saved by export_model.py
+
+        Return:
+            ExportedModel
+    """
+    with open(path + ".json", "r") as f:
+        meta = json.load(f)
+
+    if meta["format"] == "torchscript":
+        module = torch.jit.load(path, map_location=device)
+    elif meta["format"] == "export":
+        module = torch.export.load(path).module()
+    elif meta["format"] == "onnx":
+        assert has_onnxruntime, "Please 'pip install onnxruntime' to run onnx artefacts"
+        providers = ["CUDAExecutionProvider"] if torch.device(device).type == "cuda" else []
+        module = onnxruntime.InferenceSession(path, providers=providers + ["CPUExecutionProvider"])
+    else:
+        raise ValueError(f"Unknown export format:{meta['format']}")
+
+    return ExportedModel(module, meta, device)
+
+
+def main(args):
+    device = torch.device(args.device)
+    dtype = torch.float16 if args.half else torch.float32
+    assert not args.half or device.type == "cuda", "float16 export is only supported on cuda"
+    assert args.format != "export" or args.output.endswith(".pt2"), "torch.export artefacts should end with .pt2"
+
+    model = load_finetuned_model(args).to(device, dtype)
+    example_input = torch.randn(args.batch_size, 3, args.num_frames, args.input_size, args.input_size,
+                                device=device, dtype=dtype)
+
+    start = time.time()
+    export(model, example_input, args.output, args.format)
+    meta = {
+        "model": args.model,
+        "format": args.format,
+        "input_shape": list(example_input.shape),
+        "dtype": str(dtype).split(".")[-1],
+        "task": args.task,
+        "head_type": args.head_type,
+    }
+    with open(args.output + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Export {args.model} to {args.output} ({args.format}) in {time.time() - start:.1f}s, "
+          f"size {os.path.getsize(args.output) / 2 ** 20:.1f} MB")
+
+
+if __name__ == '__main__':
+    main(get_args())
@@ -0,0 +1,87 @@
+import inspect
+import contextlib
+
+import torch
+import torch.nn as nn
+from timm.models import create_model
+
+# memory-mapped checkpoints and load_state_dict(assign=True) need torch >= 2.1
+has_mmap_load = "mmap" in inspect.signature(torch.load).parameters
+has_assign_load = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+@contextlib.contextmanager
+def init_empty_weights():
+    """
+        parameters registered in this context are created on the meta device: no memory is allocated
+        and the random initialization (trunc_normal_, xavier_uniform_, ...) is skipped.
+        Other tensors (e.g. sinusoid position tables, drop path rates) are created as usual.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            param_cls = type(module._parameters[name])
+            kwargs = module._parameters[name].__dict__
+            module._parameters[name] = param_cls(module._parameters[name].to("meta"), **kwargs)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def load_checkpoint(path):
+    """
+        load a checkpoint on cpu, memory-mapped when supported so that tensors are only read when used
+    """
+    if has_mmap_load:
+        try:
+            return torch.load(path, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # checkpoints saved with the legacy (non-zip) serialization can not be memory-mapped
+            pass
+    return torch.load(path, map_location="cpu")
+
+
+def get_model_state_dict(checkpoint, model_key="model|module"):
+    for key in model_key.split("|"):
+        if key in checkpoint:
+            print("Load state_dict by model_key = %s" % key)
+            return checkpoint[key]
+    return checkpoint
+
+
+def create_model_from_checkpoint(model_name, path, model_key="model|module", **kwargs):
+    """
+        create a timm registered model and load all of its weights from a checkpoint,
+        parameters are created on the meta device and assigned the (memory-mapped) checkpoint tensors,
+        falls back to regular construction and loading for older torch versions
+
+        Parameters:
+            model_name: str, name of registered model
+            path: str, checkpoint containing all parameters of the model
+            model_key: str, keys of the model state_dict in the checkpoint separated by "|"
+            kwargs: arguments of create_model()
+
+        Return:
+            nn.Module, model on cpu
+    """
+    state_dict = get_model_state_dict(load_checkpoint(path), model_key)
+
+    if not has_assign_load:
+        model = create_model(model_name, **kwargs)
+        model.load_state_dict(state_dict, strict=True)
+        return model
+
+    with init_empty_weights():
+        model = create_model(model_name, **kwargs)
+    model.load_state_dict(state_dict, strict=True, assign=True)
+
+    for name, param in model.named_parameters():
+        if param.is_meta:
+            raise RuntimeError(f"Parameter {name} is not initialized by checkpoint {path}")
+
+    return model
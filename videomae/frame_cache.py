@@ -0,0 +1,340 @@
+"""
+Node-local frame cache shared by all ranks and DataLoader workers of a node.
+
+Compressed frames (the jpeg bytes stored in the tar/zip files) are kept in a memory-mapped arena,
+by default in /dev/shm, of a fixed byte budget:
+
+    header | slot table | data ring
+
+- slot table: hash table with `ways` slots per bucket, a slot holds (seq, length, key, pos, crc, referenced)
+  of one frame. Frames are keyed by the 64-bit hash of "<source>/<name>/<member>".
+- data ring: frames are appended at `head` as [key, slot, record length] + bytes. When the ring is full,
+  records are evicted from `tail`; records read since they were written (referenced) are appended again
+  instead (second chance), which approximates LRU over the byte budget.
+
+Reads are lock-free: a reader copies the frame, then checks that the slot sequence number is unchanged,
+that the ring has not wrapped over the record (`head` is advanced before a record is overwritten) and
+the crc of the bytes. Writes (on a miss) are serialized with flock() on the arena file.
+
+The arena is created by the first process that opens it with a size, or by running this module as a
+daemon that keeps the arena alive across jobs and removes it on exit:
+
+    python frame_cache.py --path /dev/shm/ssvl_frame_cache --size_gb 32
+
+"""
+
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import signal
+import hashlib
+import argparse
+import contextlib
+
+
+MAGIC = b"SSVLFC01"
+# magic, ways, reserved, num_buckets, data_size, head, tail, puts, evictions
+HEADER = struct.Struct("<8sIIQQQQQQ")
+HEAD_OFFSET, TAIL_OFFSET, PUTS_OFFSET, EVICTIONS_OFFSET = 32, 40, 48, 56
+# seq, length, key, pos, crc, referenced
+SLOT = struct.Struct("<IIQQII")
+REFERENCED_OFFSET = 28
+# key, slot index, record length
+PREFIX = struct.Struct("<QII")
+PAD_SLOT = 0xFFFFFFFF
+
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+
+
+def _align(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def frame_key(*parts):
+    """
+        64-bit non-zero key of a frame, e.g. frame_key(source, name, "u/frame_0000000001.jpg")
+    """
+    digest = hashlib.blake2b("/".join(str(p) for p in parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") | 1
+
+
+class FrameCache(object):
+    """
+        client of a node-local shared-memory frame cache, see the module docstring for the layout
+
+        Parameters:
+            path: str, arena file, should be on a node-local tmpfs such as /dev/shm
+            size: int, byte budget of the data ring, the arena is created if it does not exist,
+                  0 to attach to an existing arena
+            ways: int, slots per hash bucket
+            avg_frame_size: int, expected bytes per frame, used to size the slot table
+    """
+    def __init__(self, path, size=0, ways=8, avg_frame_size=32 * 1024):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._pid = None
+        self._mm = None
+        self._fd = None
+
+        if size > 0:
+            self._create(size, ways, avg_frame_size)
+        self._open()
+
+    def _create(self, size, ways, avg_frame_size):
+        data_size = _align(size)
+        num_buckets = max(data_size // avg_frame_size // ways, 1024)
+        slots_size = num_buckets * ways * SLOT.size
+        total_size = HEADER.size + slots_size + data_size
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size >= HEADER.size and os.pread(fd, len(MAGIC), 0) == MAGIC:
+                # created by another process of the node
+                return
+            os.ftruncate(fd, total_size)
+            os.pwrite(fd, HEADER.pack(MAGIC, ways, 0, num_buckets, data_size, 0, 0, 0, 0), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _open(self):
+        """ (re)open the arena, flock() is per open file so every process needs its own descriptor """
+        self.close()
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._mm = mmap.mmap(self._fd, 0)
+        self._pid = os.getpid()
+
+        magic, self.ways, _, self.num_buckets, self.data_size = HEADER.unpack_from(self._mm, 0)[:5]
+        assert magic == MAGIC, f"{self.path} is not a frame cache arena"
+        self.slots_offset = HEADER.size
+        self.data_offset = HEADER.size + self.num_buckets * self.ways * SLOT.size
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            os.close(self._fd)
+        self._mm, self._fd = None, None
+
+    def unlink(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        # DataLoader workers started with spawn re-attach to the arena
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # forked DataLoader worker: the inherited descriptor shares its flock() with the parent
+            self._open()
+            self.hits, self.misses = 0, 0
+
+    @contextlib.contextmanager
+    def _lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot_offset(self, index):
+        return self.slots_offset + index * SLOT.size
+
+    def _bucket(self, key):
+        start = (key % self.num_buckets) * self.ways
+        return range(start, start + self.ways)
+
+    def _read_u64(self, offset):
+        return U64.unpack_from(self._mm, offset)[0]
+
+    def get(self, key):
+        """
+            Return:
+                bytes of the frame, None if it is not cached
+        """
+        self._check_pid()
+        mm = self._mm
+        for index in self._bucket(key):
+            offset = self._slot_offset(index)
+            seq, length, slot_key, pos, crc, _ = SLOT.unpack_from(mm, offset)
+            if slot_key != key or seq & 1:
+                continue
+
+            start = self.data_offset + pos % self.data_size + PREFIX.size
+            data = mm[start: start + length]
+            if U32.unpack_from(mm, offset)[0] != seq or self._read_u64(HEAD_OFFSET) > pos + self.data_size \
+                    or zlib.crc32(data) != crc:
+                # evicted or overwritten while reading
+                break
+
+            U32.pack_into(mm, offset + REFERENCED_OFFSET, 1)
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        """
+            insert a frame, evicting the oldest unreferenced frames when the byte budget is exceeded
+
+            Return:
+                bool, False if the frame is larger than the cache
+        """
+        self._check_pid()
+        if _align(PREFIX.size + len(data)) > self.data_size:
+            return False
+
+        with self._lock():
+            if self._find(key) is not None:
+                return True
+            reinsert = []
+            self._append(key, data, reinsert, referenced=0)
+            while reinsert:
+                key, data = reinsert.pop()
+                if self._find(key) is None:
+                    self._append(key, data, reinsert, referenced=0)
+        return True
+
+    def _find(self, key):
+        for index in self._bucket(key):
+            seq, _, slot_key = SLOT.unpack_from(self._mm, self._slot_offset(index))[:3]
+            if slot_key == key and not seq & 1:
+                return index
+        return None
+
+    def _choose_slot(self, key):
+        """ an empty slot of the bucket, else the slot holding the oldest frame """
+        oldest, oldest_pos = None, None
+        for index in self._bucket(key):
+            _, _, slot_key, pos = SLOT.unpack_from(self._mm, self._slot_offset(index))[:4]
+            if slot_key == 0:
+                return index
+            if oldest is None or pos < oldest_pos:
+                oldest, oldest_pos = index, pos
+        return oldest
+
+    def _invalidate(self, index):
+        seq = U32.unpack_from(self._mm, self._slot_offset(index))[0]
+        SLOT.pack_into(self._mm, self._slot_offset(index), (seq | 1) + 1, 0, 0, 0, 0, 0)
+
+    def _evict(self, tail, reinsert):
+        """ evict the record at tail, return the position of the next record """
+        offset = tail % self.data_size
+        if self.data_size - offset < PREFIX.size:
+            return tail + self.data_size - offset
+
+        key, index, record_size = PREFIX.unpack_from(self._mm, self.data_offset + offset)
+        if index != PAD_SLOT:
+            seq, length, slot_key, pos, _, referenced = SLOT.unpack_from(self._mm, self._slot_offset(index))
+            if slot_key == key and pos == tail and not seq & 1:
+                if referenced:
+                    start = self.data_offset + offset + PREFIX.size
+                    reinsert.append((key, self._mm[start: start + length]))
+                self._invalidate(index)
+                U64.pack_into(self._mm, EVICTIONS_OFFSET, self._read_u64(EVICTIONS_OFFSET) + 1)
+        return tail + record_size
+
+    def _reserve(self, size, reinsert):
+        head, tail = self._read_u64(HEAD_OFFSET), self._read_u64(TAIL_OFFSET)
+        while head + size - tail > self.data_size:
+            tail = self._evict(tail, reinsert)
+        U64.pack_into(self._mm, TAIL_OFFSET, tail)
+        return head
+
+    def _append(self, key, data, reinsert, referenced=0):
+        record_size = _align(PREFIX.size + len(data))
+
+        # records do not wrap around the end of the ring
+        head = self._read_u64(HEAD_OFFSET)
+        pad = self.data_size - head % self.data_size
+        if pad < record_size:
+            head = self._reserve(pad, reinsert)
+            if pad >= PREFIX.size:
+                PREFIX.pack_into(self._mm, self.data_offset + head % self.data_size, 0, PAD_SLOT, pad)
+            U64.pack_into(self._mm, HEAD_OFFSET, head + pad)
+
+        head = self._reserve(record_size, reinsert)
+        index = self._choose_slot(key)
+        self._invalidate(index)
+        seq = U32.unpack_from(self._mm, self._slot_offset(index))[0]
+        U32.pack_into(self._mm, self._slot_offset(index), seq + 1)
+
+        # advance head before writing so that readers of overwritten records fail the check in get()
+        U64.pack_into(self._mm, HEAD_OFFSET, head + record_size)
+        start = self.data_offset + head % self.data_size
+        PREFIX.pack_into(self._mm, start, key, index, record_size)
+        self._mm[start + PREFIX.size: start + PREFIX.size + len(data)] = data
+
+        SLOT.pack_into(self._mm, self._slot_offset(index), seq + 1, len(data), key, head,
+                       zlib.crc32(data), referenced)
+        U32.pack_into(self._mm, self._slot_offset(index), seq + 2)
+        U64.pack_into(self._mm, PUTS_OFFSET, self._read_u64(PUTS_OFFSET) + 1)
+
+    def stats(self):
+        self._check_pid()
+        head, tail = self._read_u64(HEAD_OFFSET), self._read_u64(TAIL_OFFSET)
+        return {
+            "used_bytes": head - tail,
+            "data_size": self.data_size,
+            "puts": self._read_u64(PUTS_OFFSET),
+            "evictions": self._read_u64(EVICTIONS_OFFSET),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_frame_caches = {}
+
+
+def get_frame_cache(path, size=0):
+    """
+        FrameCache of the current process, opened once per process and path
+    """
+    key = (os.getpid(), path)
+    if key not in _frame_caches:
+        _frame_caches[key] = FrameCache(path, size=size)
+    return _frame_caches[key]
+
+
+def main():
+    parser = argparse.ArgumentParser("node-local frame cache daemon")
+    parser.add_argument("--path", default="/dev/shm/ssvl_frame_cache", type=str)
+    parser.add_argument("--size_gb", default=16, type=float, help="byte budget of cached frames")
+    parser.add_argument("--log_interval", default=60, type=int, help="seconds between two stats lines, 0 to disable")
+    args = parser.parse_args()
+
+    cache = FrameCache(args.path, size=int(args.size_gb * 2 ** 30))
+    print(f"Frame cache at {args.path}: {cache.data_size / 2 ** 30:.1f} GB, "
+          f"{cache.num_buckets * cache.ways} slots")
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            time.sleep(args.log_interval or 3600)
+            if args.log_interval:
+                stats = cache.stats()
+                print(f"used {stats['used_bytes'] / 2 ** 30:.2f} GB, puts {stats['puts']}, "
+                      f"evictions {stats['evictions']}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cache.unlink()
+        print(f"Removed frame cache {args.path}")
+
+
+if __name__ == "__main__":
+    main()
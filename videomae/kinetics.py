@@ -1,8 +1,7 @@
 import os
+from collections import OrderedDict
 import numpy as np
-from numpy.lib.function_base import disp
 import torch
-import decord
 from PIL import Image
 from torchvision import transforms
 from random_erasing import RandomErasing
@@ -12,6 +11,110 @@ from torch.utils.data import Dataset
 import video_transforms as video_transforms 
 import volume_transforms as volume_transforms
 
+
+class VideoReaderPool(object):
+    """
+        LRU pool of open decord readers of the current process
+
+        Opening a VideoReader parses the container and creates the decoder, which used to be paid for every
+        sample (and for every temporal/spatial view of a video at test time). Readers are keyed by
+        (path, width, height) and the least recently used one is closed once max_readers are open. Readers
+        opened in the parent process are dropped in forked DataLoader workers.
+
+        Parameters:
+            max_readers: int, maximum number of open readers
+    """
+    def __init__(self, max_readers=8):
+        self.max_readers = max_readers
+        self.readers = OrderedDict()
+        self.pid = os.getpid()
+
+    def get(self, fname, width=-1, height=-1):
+        if self.pid != os.getpid():
+            self.readers = OrderedDict()
+            self.pid = os.getpid()
+
+        key = (fname, width, height)
+        if key in self.readers:
+            self.readers.move_to_end(key)
+            return self.readers[key]
+
+        vr = VideoReader(fname, width=width, height=height, num_threads=1, ctx=cpu(0))
+        self.readers[key] = vr
+        if len(self.readers) > self.max_readers:
+            self.readers.popitem(last=False)
+        return vr
+
+    def __len__(self):
+        return len(self.readers)
+
+
+_reader_pool = VideoReaderPool()
+
+
+def get_video_reader(fname, width=-1, height=-1):
+    """
+        open decord reader of fname from the pool of the current process
+    """
+    return _reader_pool.get(fname, width=width, height=height)
+
+
+def plan_decode_order(indices):
+    """
+        order frame indices for decoding
+
+        decord decodes forward from the current position and only seeks (to the keyframe before the target)
+        when a frame is behind the current position or in a later GOP. Visiting every needed frame once in
+        ascending order therefore enters each GOP at most once, whatever the order of indices is.
+
+        Parameters:
+            indices: list or array of frame indices, possibly unsorted and with duplicates
+
+        Return:
+            order: list of unique frame indices in ascending order, to pass to get_batch()
+            inverse: array, frames[inverse] puts decoded frames back in the order of indices
+    """
+    order, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+    return order.tolist(), inverse
+
+
+def get_frames(vr, indices):
+    """
+        fetch frames of indices with a single get_batch() call
+
+        Return:
+            buffer: uint8 array, len(indices) x H x W x C
+    """
+    order, inverse = plan_decode_order(indices)
+    buffer = vr.get_batch(order).asnumpy()
+    # the decoder thread keeps decoding ahead after get_batch(), which is wasted work for a pooled reader
+    # that is used for a random clip next time. Seeking back to the first frame stops it.
+    vr.seek(0)
+    return buffer[inverse]
+
+
+def plan_test_segments(num_frames, clip_len, frame_sample_rate, test_num_segment):
+    """
+        frame indices of every temporal view of a video at test time
+
+        Views are clip_len consecutive frames of the video subsampled by frame_sample_rate, with starts
+        evenly spread over the subsampled video.
+
+        Return:
+            segments: list of test_num_segment lists of clip_len frame indices
+    """
+    all_index = [x for x in range(0, num_frames, frame_sample_rate)]
+    while len(all_index) < clip_len:
+        all_index.append(all_index[-1])
+
+    temporal_step = max(1.0 * (len(all_index) - clip_len) / max(test_num_segment - 1, 1), 0)
+    segments = []
+    for chunk_nb in range(test_num_segment):
+        temporal_start = int(chunk_nb * temporal_step)
+        segments.append(all_index[temporal_start:temporal_start + clip_len])
+    return segments
+
+
 class VideoClsDataset(Dataset):
     """Load your own video classification dataset."""
 
@@ -80,13 +183,16 @@ class VideoClsDataset(Dataset):
             self.test_seg = []
             self.test_dataset = []
             self.test_label_array = []
-            for ck in range(self.test_num_segment):
-                for cp in range(self.test_num_crop):
-                    for idx in range(len(self.label_array)):
+            # views of a video are kept consecutive, so that they are served from one decoded buffer
+            for idx in range(len(self.label_array)):
+                for ck in range(self.test_num_segment):
+                    for cp in range(self.test_num_crop):
                         sample_label = self.label_array[idx]
                         self.test_label_array.append(sample_label)
                         self.test_dataset.append(self.dataset_samples[idx])
                         self.test_seg.append((ck, cp))
+            # (video path, frames of every temporal view) of the last video decoded in this worker
+            self._test_views = (None, None)
 
     def __getitem__(self, index):
         if self.mode == 'train':
@@ -135,7 +241,7 @@ class VideoClsDataset(Dataset):
         elif self.mode == 'test':
             sample = self.test_dataset[index]
             chunk_nb, split_nb = self.test_seg[index]
-            buffer = self.loadvideo_decord(sample)
+            buffer = self.loadvideo_decord(sample, chunk_nb=chunk_nb)
 
             while len(buffer) == 0:
                 warnings.warn("video {}, temporal {}, spatial {} not found during testing".format(\
@@ -143,24 +249,20 @@ class VideoClsDataset(Dataset):
                 index = np.random.randint(self.__len__())
                 sample = self.test_dataset[index]
                 chunk_nb, split_nb = self.test_seg[index]
-                buffer = self.loadvideo_decord(sample)
+                buffer = self.loadvideo_decord(sample, chunk_nb=chunk_nb)
 
             buffer = self.data_resize(buffer)
             if isinstance(buffer, list):
                 buffer = np.stack(buffer, 0)
 
+            # buffer is already the temporal view chunk_nb, see plan_test_segments()
             spatial_step = 1.0 * (max(buffer.shape[1], buffer.shape[2]) - self.short_side_size) \
                                  / (self.test_num_crop - 1)
-            temporal_step = max(1.0 * (buffer.shape[0] - self.clip_len) \
-                                / (self.test_num_segment - 1), 0)
-            temporal_start = int(chunk_nb * temporal_step)
             spatial_start = int(split_nb * spatial_step)
             if buffer.shape[1] >= buffer.shape[2]:
-                buffer = buffer[temporal_start:temporal_start + self.clip_len, \
-                       spatial_start:spatial_start + self.short_side_size, :, :]
+                buffer = buffer[:, spatial_start:spatial_start + self.short_side_size, :, :]
             else:
-                buffer = buffer[temporal_start:temporal_start + self.clip_len, \
-                       :, spatial_start:spatial_start + self.short_side_size, :]
+                buffer = buffer[:, :, spatial_start:spatial_start + self.short_side_size, :]
 
             buffer = self.data_transform(buffer)
 
@@ -232,10 +334,13 @@ class VideoClsDataset(Dataset):
         return buffer
 
 
-    def loadvideo_decord(self, sample, sample_rate_scale=1):
-        """Load video content using Decord"""
+    def loadvideo_decord(self, sample, sample_rate_scale=1, chunk_nb=0):
+        """Load video content using Decord, in test mode only the temporal view chunk_nb is returned"""
         fname = sample
 
+        if self.mode == 'test' and self._test_views[0] == fname:
+            return self._test_views[1][chunk_nb]
+
         if not (os.path.exists(fname)):
             return []
 
@@ -245,21 +350,20 @@ class VideoClsDataset(Dataset):
             return []
         try:
             if self.keep_aspect_ratio:
-                vr = VideoReader(fname, num_threads=1, ctx=cpu(0))
+                vr = get_video_reader(fname)
             else:
-                vr = VideoReader(fname, width=self.new_width, height=self.new_height,
-                                 num_threads=1, ctx=cpu(0))
+                vr = get_video_reader(fname, width=self.new_width, height=self.new_height)
         except:
             print("video cannot be loaded by decord: ", fname)
             return []
 
         if self.mode == 'test':
-            all_index = [x for x in range(0, len(vr), self.frame_sample_rate)]
-            while len(all_index) < self.clip_len:
-                all_index.append(all_index[-1])
-            vr.seek(0)
-            buffer = vr.get_batch(all_index).asnumpy()
-            return buffer
+            # frames of all temporal views are decoded by one get_batch() and kept for the other views
+            segments = plan_test_segments(len(vr), self.clip_len, self.frame_sample_rate, self.test_num_segment)
+            frames = get_frames(vr, np.concatenate(segments))
+            views = np.split(frames, np.cumsum([len(seg) for seg in segments])[:-1])
+            self._test_views = (fname, views)
+            return views[chunk_nb]
 
         # handle temporal segments
         converted_len = int(self.clip_len * self.frame_sample_rate)
@@ -280,8 +384,7 @@ class VideoClsDataset(Dataset):
             all_index.extend(list(index))
 
         all_index = all_index[::int(sample_rate_scale)]
-        vr.seek(0)
-        buffer = vr.get_batch(all_index).asnumpy()
+        buffer = get_frames(vr, all_index)
         return buffer
 
     def __len__(self):
@@ -497,7 +600,7 @@ class VideoMAE(torch.utils.data.Dataset):
             # So we need to provide extension (i.e., .mp4) to complete the file name.
             video_name = '{}.{}'.format(directory, self.video_ext)
 
-        decord_vr = decord.VideoReader(video_name, num_threads=1)
+        decord_vr = get_video_reader(video_name)
         duration = len(decord_vr)
 
         segment_indices, skip_offsets = self._sample_train_indices(duration)
@@ -571,7 +674,7 @@ class VideoMAE(torch.utils.data.Dataset):
                 if offset + self.new_step < duration:
                     offset += self.new_step
         try:
-            video_data = video_reader.get_batch(frame_id_list).asnumpy()
+            video_data = get_frames(video_reader, frame_id_list)
             sampled_list = [Image.fromarray(video_data[vid, :, :, :]).convert('RGB') for vid, _ in enumerate(frame_id_list)]
         except:
             raise RuntimeError('Error occured in reading frames {} from video {} of duration {}.'.format(frame_id_list, directory, duration))
@@ -46,12 +46,29 @@ class TubeMaskingGenerator:
 
         return batch_mask
 
+    def packed(self, frames_lst):
+        """
+            tube masks of samples with different numbers of frames, each sample masks the same
+            ratio of patches per frame
+
+            Args:
+                frames_lst: list[int], number of frames (tubelets) of each sample
+
+            Return:
+                mask: numpy.ndarray, concatenated masks of all samples, sum(frames_lst) * height * width
+        """
+        batch_mask = self(len(frames_lst))
+        return np.concatenate([
+            np.tile(mask[:self.num_patches_per_frame], frames) for mask, frames in zip(batch_mask, frames_lst)
+        ])
+
 
 class AgnosticMaskingGenerator:
     def __init__(self, input_size, mask_ratio):
         self.frames, self.height, self.width = input_size
         self.num_patches_per_frame =  self.height * self.width
         self.total_patches = self.frames * self.num_patches_per_frame 
+        self.mask_ratio = mask_ratio
         self.total_masks = int(mask_ratio * self.total_patches)
 
     def __repr__(self):
@@ -83,6 +100,27 @@ class AgnosticMaskingGenerator:
 
         return batch_mask
 
+    def packed(self, frames_lst):
+        """
+            agnostic masks of samples with different numbers of frames, each sample masks
+            int(mask_ratio * its number of patches) patches
+
+            Args:
+                frames_lst: list[int], number of frames (tubelets) of each sample
+
+            Return:
+                mask: numpy.ndarray, concatenated masks of all samples, sum(frames_lst) * height * width
+        """
+        batch_mask = []
+        for frames in frames_lst:
+            total_patches = frames * self.num_patches_per_frame
+            total_masks = int(self.mask_ratio * total_patches)
+            mask = np.hstack([np.zeros(total_patches - total_masks), np.ones(total_masks)])
+            np.random.shuffle(mask)
+            batch_mask.append(mask)
+
+        return np.concatenate(batch_mask)
+
 class MultiModalMaskingGenerator:
     """
         Masking generator for rgb and flow input where visible tokens of each modality is predetermined
@@ -167,6 +205,24 @@ class MaskGenerator:
 
         return mask_lst
 
+    def packed(self, frames_lst):
+        """
+            masks of samples with different numbers of frames packed along the token dimension,
+            only supported by tube and agnostic masks
+
+            Args:
+                frames_lst: list[int], number of frames (tubelets) of each sample
+
+            Return:
+                mask_lst: list[numpy.ndarray], one concatenated mask of all samples per mask type
+        """
+        for mask_type, gen in zip(self.mask_type_lst, self.generators):
+            assert hasattr(gen, "packed"), f"{mask_type} mask does not support packed samples"
+
+        mask_lst = [ gen.packed(frames_lst) for gen in self.generators]
+
+        return mask_lst
+
     def __repr__(self):
         _repr = ""
         for gen in self.generators:
@@ -26,6 +26,11 @@ import torch
 import random
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+# fused attention kernels (flash / memory efficient) with a custom scale need torch >= 2.1
+has_sdpa = hasattr(F, "scaled_dot_product_attention") and \
+    tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
 
 
 def window_partition(x, window_size):
@@ -73,6 +78,22 @@ def window_unpartition(windows, window_size, pad_hw, hw):
     return x
 
 
+def window_valid_mask(hw, window_size, device):
+    """
+    Mask of the non-padded tokens of window_partition() outputs.
+    Args:
+        hw (Tuple): original height and width (H, W) before padding.
+        window_size (int): window size.
+    Returns:
+        mask: [num_windows, window_size, window_size, 1], None if no padding is needed.
+    """
+    H, W = hw
+    if H % window_size == 0 and W % window_size == 0:
+        return None
+    mask, _ = window_partition(torch.ones(1, H, W, 1, device=device), window_size)
+    return mask
+
+
 # sin-cos position encoding
 # https://github.com/jadore801120/attention-is-all-you-need-pytorch/blob/master/transformer/Models.py#L31
 def get_sinusoid_encoding_table(n_position, d_hid): 
@@ -241,6 +262,9 @@ class Attention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        # use F.scaled_dot_product_attention instead of the explicit softmax(q @ k^T) @ v
+        self.fused = has_sdpa
+
     def forward(self, x):
         B, H, W, C = x.shape
         N = H*W
@@ -253,14 +277,18 @@ class Attention(nn.Module):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
+        if self.fused:
+            x = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+        else:
+            q = q * self.scale
+            attn = (q @ k.transpose(-2, -1))
 
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         x = x.reshape(B, H, W, -1)
@@ -322,20 +350,41 @@ class Block(nn.Module):
         if self.window_size > 0:
             x = window_unpartition(x, self.window_size, pad_hw, (H, W))
 
-        # print(x.shape)
-        # print(shortcut.shape)
+        x = self.forward_mlp(shortcut, x)
+
+        if self.use_residual_block:
+            x = self.forward_residual(x)
+
+        return x
+
+    def forward_windows(self, x, valid=None):
+        """
+        Attention and mlp on tokens that are already partitioned into windows, so that consecutive
+        window blocks partition and unpartition only once. The residual block is not applied.
+        Args:
+            x (tensor): windows [B * num_windows, window_size, window_size, C].
+            valid (tensor): mask of non-padded tokens [B * num_windows, window_size, window_size, 1],
+                padded tokens are zeroed after norm1 as window_partition() does in forward().
+        """
+        shortcut = x
+        x = self.norm1(x)
+        if valid is not None:
+            x = x * valid
+        x = self.attn(x)
+        return self.forward_mlp(shortcut, x)
+
+    def forward_mlp(self, shortcut, x):
         if self.gamma_1 is not None:
             x = shortcut + self.drop_path(self.gamma_1 * x)
             x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
         else:
             x = shortcut + self.drop_path(x)
             x = x + self.drop_path(self.mlp(self.norm2(x)))
-        
-        if self.use_residual_block:
-            x = self.residual(x.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)
-
         return x
 
+    def forward_residual(self, x):
+        return self.residual(x.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)
+
 
 class VitDet(Backbone):
     """
@@ -363,6 +412,7 @@ class VitDet(Backbone):
         window_block_indexes=(),
         residual_block_indexes=(),
         use_act_checkpoint=False,
+        fused_window_attention=True,
         pretrain_img_size=224,
         pretrain_use_cls_token=True,
         out_feature="last_feat",
@@ -387,12 +437,16 @@ class VitDet(Backbone):
             window_block_indexes (list): Indexes for blocks using window attention.
             residual_block_indexes (list): Indexes for blocks using conv propagation.
             use_act_checkpoint (bool): If True, use activation checkpointing.
+            fused_window_attention (bool): If True, use fused attention kernels and keep tokens in window
+                order across consecutive window attention blocks.
             pretrain_img_size (int): input image size for pretraining models.
             pretrain_use_cls_token (bool): If True, pretrainig models use class token.
             out_feature (str): name of the feature from the last block.
         """
         super().__init__()
         self.pretrain_use_cls_token = pretrain_use_cls_token
+        self.use_act_checkpoint = use_act_checkpoint
+        self.window_size = window_size
 
         self.patch_embed = PatchEmbed(
             img_size = img_size,
@@ -435,6 +489,31 @@ class VitDet(Backbone):
 
         self.apply(self._init_weights)
 
+        # position table / padding mask per (input size, device, dtype)
+        self._input_cache = {}
+        self.set_fused_window_attention(fused_window_attention)
+
+    def set_fused_window_attention(self, enabled=True):
+        self.fused_window_attention = enabled
+        for blk in self.blocks:
+            blk.attn.fused = enabled and has_sdpa
+
+    def _get_input_tables(self, H, W, x):
+        """
+        position table cast to the device and dtype of x, and the window padding mask, built once per input size
+        """
+        key = (H, W, x.device, x.dtype)
+        if key not in self._input_cache:
+            pos_embed = self.pos_embed.detach().to(x.device, x.dtype).reshape(1, H, W, -1)
+            valid = window_valid_mask((H, W), self.window_size, x.device) if self.window_size > 0 else None
+            self._input_cache[key] = (pos_embed, None if valid is None else valid.to(x.dtype))
+        return self._input_cache[key]
+
+    def _run_block(self, func, *args):
+        if self.use_act_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(func, *args, use_reentrant=False)
+        return func(*args)
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=0.02)
@@ -450,12 +529,38 @@ class VitDet(Backbone):
         x = self.patch_embed(x) # B, H, W, C
         B, H, W, C = x.shape
         # print(x.shape)
-        if self.pos_embed is not None:
-            x = x.reshape(B, -1, C)
-            x = x + self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
-            x = x.reshape(B, H, W, C)
-        for blk in self.blocks:
-            x = blk(x)
+        if not self.fused_window_attention:
+            if self.pos_embed is not None:
+                x = x.reshape(B, -1, C)
+                x = x + self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
+                x = x.reshape(B, H, W, C)
+            for blk in self.blocks:
+                x = self._run_block(blk, x)
+        else:
+            pos_embed, valid = self._get_input_tables(H, W, x)
+            x = x + pos_embed
+            if valid is not None:
+                valid = valid.repeat(B, 1, 1, 1)
+
+            pad_hw = None
+            for blk in self.blocks:
+                if blk.window_size > 0:
+                    # partition once for consecutive window blocks
+                    if pad_hw is None:
+                        x, pad_hw = window_partition(x, self.window_size)
+                    x = self._run_block(blk.forward_windows, x, valid)
+                    if not blk.use_residual_block:
+                        continue
+                    x = window_unpartition(x, self.window_size, pad_hw, (H, W))
+                    pad_hw = None
+                    x = self._run_block(blk.forward_residual, x)
+                else:
+                    if pad_hw is not None:
+                        x = window_unpartition(x, self.window_size, pad_hw, (H, W))
+                        pad_hw = None
+                    x = self._run_block(blk, x)
+            if pad_hw is not None:
+                x = window_unpartition(x, self.window_size, pad_hw, (H, W))
 
         outputs = {self._out_features[0]: x.permute(0, 3, 1, 2)}
         return outputs
@@ -1,16 +1,20 @@
-from functools import partial
-import numpy as np
+from functools import partial, lru_cache
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from timm.models.layers import drop_path, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
+from torch.utils.checkpoint import checkpoint
 
 from tokenizer_network import SimpleCNN, Tokenizer
+from token_merging import forward_blocks_with_merging
 
 import math
+import inspect
 import einops
 
+_has_non_reentrant_checkpoint = "use_reentrant" in inspect.signature(checkpoint).parameters
+
 def _cfg(url='', **kwargs):
     return {
         'url': url,
@@ -109,23 +113,36 @@ class Attention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, layout=None, seqlens=None):
+        """
+            layout:  (n_rgb, num_bottleneck) if x is laid out as [rgb, bottleneck, flow] tokens and
+                     should use block-sparse bottleneck attention, None for full attention
+            seqlens: list of int, lengths of independent sequences packed along the token dimension of x,
+                     tokens only attend to tokens of the same sequence
+        """
         B, N, C = x.shape
-        qkv_bias = None
         if self.q_bias is not None:
             qkv_bias = torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
-        # qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+            qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+        else:
+            # qkv may be a quantized linear layer, see quantization.fold_qkv_bias()
+            qkv = self.qkv(x)
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if layout is not None:
+            x = bottleneck_attention(q, k, v, layout[0], layout[1], self.attn_drop)
+        elif seqlens is not None:
+            x = packed_attention(q, k, v, seqlens, self.attn_drop)
+        else:
+            attn = (q @ k.transpose(-2, -1))
+
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = x.transpose(1, 2).reshape(B, N, -1)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -133,6 +150,73 @@ class Attention(nn.Module):
         return x
 
 
+def bottleneck_attention(q, k, v, n_rgb, num_bottleneck, attn_drop):
+    """
+        block-sparse attention over tokens laid out as [rgb, bottleneck, flow]:
+        rgb tokens attend to rgb and bottleneck tokens, flow tokens attend to bottleneck and flow tokens,
+        bottleneck tokens attend to all tokens. Only these three (contiguous) blocks are computed,
+        the rgb-flow pairs are never materialized and no dense mask is built.
+
+        Parameters:
+            q, k, v: torch.Tensor, B, num_heads, N, head_dim (q already scaled)
+            n_rgb: int, number of rgb tokens
+            num_bottleneck: int, number of bottleneck tokens
+            attn_drop: nn.Module, dropout applied to attention probabilities
+
+        Return:
+            torch.Tensor, B, num_heads, N, head_dim
+    """
+    n_fuse = n_rgb + num_bottleneck
+    blocks = (
+        (slice(0, n_rgb), slice(0, n_fuse)),         # rgb -> rgb, bottleneck
+        (slice(n_rgb, n_fuse), slice(0, None)),      # bottleneck -> all
+        (slice(n_fuse, None), slice(n_rgb, None)),   # flow -> bottleneck, flow
+    )
+
+    out = []
+    for q_index, kv_index in blocks:
+        attn = (q[:, :, q_index] @ k[:, :, kv_index].transpose(-2, -1))
+        attn = attn.softmax(dim=-1)
+        attn = attn_drop(attn)
+        out.append(attn @ v[:, :, kv_index])
+
+    return torch.cat(out, dim=2)
+
+
+def packed_attention(q, k, v, seqlens, attn_drop):
+    """
+        attention over several independent sequences packed along the token dimension,
+        consecutive sequences of the same length are stacked and attended in one batched matmul
+
+        Parameters:
+            q, k, v: torch.Tensor, B, num_heads, sum(seqlens), head_dim (q already scaled)
+            seqlens: list of int, length of each packed sequence
+            attn_drop: nn.Module, dropout applied to attention probabilities
+
+        Return:
+            torch.Tensor, B, num_heads, sum(seqlens), head_dim
+    """
+    B, H, _, D = q.shape
+
+    out = []
+    start, i = 0, 0
+    while i < len(seqlens):
+        n, j = seqlens[i], i
+        while j < len(seqlens) and seqlens[j] == n:
+            j += 1
+        end = start + n * (j - i)
+
+        q_, k_, v_ = [t[:, :, start:end].reshape(B, H, j - i, n, D) for t in (q, k, v)]
+        attn = (q_ @ k_.transpose(-2, -1))
+        attn = attn.softmax(dim=-1)
+        attn = attn_drop(attn)
+        out.append((attn @ v_).reshape(B, H, end - start, D))
+
+        start, i = end, j
+
+    return torch.cat(out, dim=2)
+
+
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
@@ -155,16 +239,65 @@ class Block(nn.Module):
         else:
             self.gamma_1, self.gamma_2 = None, None
 
-    def forward(self, x):
+    def forward(self, x, layout=None, seqlens=None):
         if self.gamma_1 is None:
-            x = x + self.drop_path(self.attn(self.norm1(x)))
+            x = x + self.drop_path(self.attn(self.norm1(x), layout, seqlens))
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         else:
-            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x)))
+            x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x), layout, seqlens))
             x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
         return x
 
 
+def _checkpointed_forward(block, *args, **kwargs):
+    forward = partial(type(block).forward, block)
+    if not (block.training and torch.is_grad_enabled()):
+        return forward(*args, **kwargs)
+
+    if _has_non_reentrant_checkpoint:
+        def run(*args, **kwargs):
+            # blocks such as MultiModalBlock update their token_dict input in place,
+            # recomputation in backward has to see the original inputs
+            args = [dict(arg) if isinstance(arg, dict) else arg for arg in args]
+            return forward(*args, **kwargs)
+        return checkpoint(run, *args, use_reentrant=False, **kwargs)
+    if not kwargs and all(torch.is_tensor(arg) for arg in args):
+        # reentrant checkpoint only supports positional tensor inputs
+        return checkpoint(forward, *args)
+    return forward(*args, **kwargs)
+
+
+def set_grad_checkpointing(model, ratio=1.):
+    """
+        enable activation checkpointing for the first ceil(depth * ratio) blocks of
+        every block list (blocks, cross_blocks, regressor_blocks, ...) in model,
+        activations of those blocks are recomputed in backward instead of being stored
+
+        Parameters:
+            model: nn.Module
+            ratio: float, fraction of blocks to checkpoint in each block list, 0 disables checkpointing
+
+        Return:
+            int, number of checkpointed blocks
+    """
+    assert 0 <= ratio <= 1, f"checkpoint ratio should be in [0, 1], got {ratio}"
+
+    num_checkpointed = 0
+    for name, module in model.named_modules():
+        if not (isinstance(module, nn.ModuleList) and name.split(".")[-1].endswith("blocks")):
+            continue
+
+        num_blocks = math.ceil(len(module) * ratio)
+        for i, block in enumerate(module):
+            # override forward of the instance only, parameters and state_dict are untouched
+            block.__dict__.pop("forward", None)
+            if i < num_blocks:
+                block.forward = partial(_checkpointed_forward, block)
+                num_checkpointed += 1
+
+    return num_checkpointed
+
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -197,17 +330,22 @@ class PatchEmbed(nn.Module):
     
 # sin-cos position encoding
 # https://github.com/jadore801120/attention-is-all-you-need-pytorch/blob/master/transformer/Models.py#L31
-def get_sinusoid_encoding_table(n_position, d_hid): 
-    ''' Sinusoid position encoding table ''' 
-    # TODO: make it with torch instead of numpy 
-    def get_position_angle_vec(position): 
-        return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)] 
+@lru_cache(maxsize=None)
+def _sinusoid_encoding_table(n_position, d_hid):
+    # built on cpu in float64 as the previous numpy implementation, also under a meta device context
+    position = torch.arange(n_position, dtype=torch.float64, device="cpu")[:, None]
+    exponent = 2 * (torch.arange(d_hid, dtype=torch.float64, device="cpu") // 2) / d_hid
+    sinusoid_table = position / torch.pow(10000, exponent)
+    sinusoid_table[:, 0::2] = torch.sin(sinusoid_table[:, 0::2]) # dim 2i
+    sinusoid_table[:, 1::2] = torch.cos(sinusoid_table[:, 1::2]) # dim 2i+1
+
+    return sinusoid_table.float().unsqueeze(0)
 
-    sinusoid_table = np.array([get_position_angle_vec(pos_i) for pos_i in range(n_position)]) 
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2]) # dim 2i 
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2]) # dim 2i+1 
 
-    return torch.FloatTensor(sinusoid_table).unsqueeze(0) 
+def get_sinusoid_encoding_table(n_position, d_hid):
+    ''' Sinusoid position encoding table '''
+    # tables are cached per shape, return a copy as some callers modify the table in place
+    return _sinusoid_encoding_table(n_position, d_hid).clone()
 
 
 class VisionTransformer(nn.Module):
@@ -261,6 +399,7 @@ class VisionTransformer(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
                 init_values=init_values)
             for i in range(depth)])
+        self.token_merging = None # set by token_merging.set_token_merging(), only used in eval mode
         self.norm = nn.Identity() if use_mean_pooling else norm_layer(embed_dim)
         self.fc_norm = norm_layer(embed_dim) if use_mean_pooling else None
         self.temporal_norm = norm_layer(embed_dim) if keep_dim else None
@@ -309,8 +448,11 @@ class VisionTransformer(nn.Module):
             x = x + self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
         x = self.pos_drop(x)
 
-        for blk in self.blocks:
-            x = blk(x)
+        if self.token_merging is not None and not self.training:
+            x = forward_blocks_with_merging(self.blocks, x, **self.token_merging)
+        else:
+            for blk in self.blocks:
+                x = blk(x)
 
         if self.keep_dim:
             num_patches = (H//self.patch_embed.patch_size[0]) * (W//self.patch_embed.patch_size[1])
@@ -389,6 +531,7 @@ class OSCCModel(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
                 init_values=init_values)
             for i in range(depth)])
+        self.token_merging = None # set by token_merging.set_token_merging(), only used in eval mode
 
         self.norm = nn.Identity() if use_mean_pooling else norm_layer(embed_dim)
         self.fc_norm = norm_layer(embed_dim) if use_mean_pooling else None
@@ -446,8 +589,11 @@ class OSCCModel(nn.Module):
             x = x + self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
         x = self.pos_drop(x) # dropout
         # encoder
-        for blk in self.blocks:
-            x = blk(x) 
+        if self.token_merging is not None and not self.training:
+            x = forward_blocks_with_merging(self.blocks, x, **self.token_merging)
+        else:
+            for blk in self.blocks:
+                x = blk(x)
 
         return x
 
@@ -501,6 +647,7 @@ class FintuneBottleneck(nn.Module):
                 modality="rgb", # [rgb, flow, rgbflow]
                 num_bottleneck = 8,
                 use_bottleneck = True,
+                bottleneck_attn = False, # restrict rgb/flow tokens to attend through the bottleneck only
 
                 img_size=224, 
                 patch_size=16, 
@@ -558,6 +705,8 @@ class FintuneBottleneck(nn.Module):
             self.bottleneck = nn.Parameter(torch.zeros(1, num_bottleneck, embed_dim))
             trunc_normal_(self.bottleneck, std=.02)
         self.use_bottleneck = (num_bottleneck != 0)
+        # block-sparse attention only makes sense when both modalities are fused through bottleneck tokens
+        self.bottleneck_attn = bottleneck_attn and self.use_bottleneck and "rgb" in modality and "flow" in modality
 
         self.pos_drop = nn.Dropout(p=drop_rate)
 
@@ -620,6 +769,8 @@ class FintuneBottleneck(nn.Module):
         x = x + self.rgb_pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
         x = self.pos_drop(x) # dropout
 
+        layout = (x.shape[1], self.num_bottleneck) if self.bottleneck_attn else None
+
         if self.use_bottleneck:
             expand_bottleneck = self.bottleneck.expand(B, -1, -1).type_as(x).to(x.device)
             x = torch.cat((x, expand_bottleneck), dim=1)
@@ -632,7 +783,7 @@ class FintuneBottleneck(nn.Module):
 
         # encoder
         for blk in self.blocks:
-            x = blk(x) 
+            x = blk(x, layout) 
 
         return x
 
@@ -2162,6 +2313,7 @@ class LongTermActionAnticipationModel(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
                 init_values=init_values)
             for i in range(depth)])
+        self.token_merging = None # set by token_merging.set_token_merging(), only used in eval mode
 
         if use_learnable_pos_emb:
             trunc_normal_(self.pos_embed, std=.02)
@@ -2229,8 +2381,11 @@ class LongTermActionAnticipationModel(nn.Module):
             x = x + self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
         x = self.pos_drop(x)
 
-        for blk in self.blocks:
-            x = blk(x)
+        if self.token_merging is not None and not self.training:
+            x = forward_blocks_with_merging(self.blocks, x, **self.token_merging)
+        else:
+            for blk in self.blocks:
+                x = blk(x)
 
         return x
 
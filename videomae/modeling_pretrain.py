@@ -11,7 +11,7 @@ import random
 from functools import partial
 
 from modeling_finetune import Block, _cfg, PatchEmbed, get_sinusoid_encoding_table
-from modeling_finetune import Attention, Mlp, DropPath, CrossAttention
+from modeling_finetune import Attention, Mlp, DropPath, CrossAttention, bottleneck_attention
 
 
 from timm.models.registry import register_model
@@ -67,7 +67,12 @@ class MaskAttention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x, mask):
+    def forward(self, x, mask=None, layout=None):
+        """
+            mask:   torch.Tensor, N x N, dense 0/1 mask multiplied to attention logits
+            layout: (n_rgb, num_bottleneck), use block-sparse bottleneck attention over [rgb, bottleneck, flow] tokens
+                    instead of a dense mask
+        """
         B, N, C = x.shape
         qkv_bias = None
         if self.q_bias is not None:
@@ -78,13 +83,17 @@ class MaskAttention(nn.Module):
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-        masked_attn = attn * mask
+        if layout is not None:
+            x = bottleneck_attention(q, k, v, layout[0], layout[1], self.attn_drop)
+        else:
+            attn = (q @ k.transpose(-2, -1))
+            masked_attn = attn * mask
 
-        masked_attn = masked_attn.softmax(dim=-1)
-        masked_attn = self.attn_drop(masked_attn)
+            masked_attn = masked_attn.softmax(dim=-1)
+            masked_attn = self.attn_drop(masked_attn)
+            x = masked_attn @ v
 
-        x = (masked_attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = x.transpose(1, 2).reshape(B, N, -1)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -190,6 +199,28 @@ class PretrainVisionTransformerEncoder(nn.Module):
         else:
             return x_vis
 
+    def forward_packed(self, x, mask, seqlens):
+        """
+            encode samples of different lengths packed along the temporal dimension, see PretrainVisionTransformer.forward_packed()
+
+            Return:
+                x_vis: torch.Tensor, 1, N_vis, C, visible tokens of all samples in packed order
+                vis_seqlens: list of int, number of visible tokens of each sample
+        """
+        x = self.patch_embed(x)
+        x = x + packed_pos_embed(self.pos_embed, seqlens).type_as(x).to(x.device).detach()
+
+        B, _, C = x.shape
+        vis_seqlens = (~mask).reshape(-1).split(seqlens)
+        vis_seqlens = torch.stack([m.sum() for m in vis_seqlens]).tolist()
+        x_vis = x[~mask].reshape(B, -1, C)
+        for blk in self.blocks:
+            x_vis = blk(x_vis, seqlens=vis_seqlens)
+
+        x_vis = self.head(self.norm(x_vis))
+
+        return x_vis, vis_seqlens
+
     def forward(self, x, mask, stat=None):
         if stat is not None and isinstance(stat, bool):
             # elif isinstance(stat, bool):
@@ -253,17 +284,43 @@ class PretrainVisionTransformerDecoder(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward(self, x, return_token_num):
+    def forward(self, x, return_token_num, seqlens=None, return_mask=None):
+        """
+            seqlens: list of int, lengths of packed samples, tokens only attend to tokens of the same sample
+            return_mask: torch.Tensor(bool), B, N, tokens to return instead of the last return_token_num tokens
+        """
         for blk in self.blocks:
-            x = blk(x)
+            x = blk(x, seqlens=seqlens)
 
-        if return_token_num > 0:
+        if return_mask is not None:
+            B, _, C = x.shape
+            x = self.head(self.norm(x[return_mask].reshape(B, -1, C)))
+        elif return_token_num > 0:
             x = self.head(self.norm(x[:, -return_token_num:])) # only return the mask tokens predict pixels
         else:
             x = self.head(self.norm(x))
 
         return x
 
+
+def packed_pos_embed(pos_embed, seqlens):
+    """
+        positional embeddings of samples packed along the token dimension, the i-th sample gets the
+        first seqlens[i] positions of pos_embed. Tokens are ordered frame by frame, so a sample of fewer
+        tubelets gets exactly the embeddings of the first frames of a full length clip
+
+        Parameters:
+            pos_embed: torch.Tensor, 1, N, C
+            seqlens: list of int, number of tokens of each sample, each at most N
+
+        Return:
+            torch.Tensor, 1, sum(seqlens), C
+    """
+    assert max(seqlens) <= pos_embed.shape[1], \
+        f"sample of {max(seqlens)} tokens is longer than the {pos_embed.shape[1]} positional embeddings"
+    return torch.cat([pos_embed[:, :n] for n in seqlens], dim=1)
+
+
 class PretrainVisionTransformer(nn.Module):
     """ Vision Transformer with support for patch or hybrid CNN input stage
     """
@@ -359,7 +416,14 @@ class PretrainVisionTransformer(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token', 'mask_token'}
 
-    def forward(self, x, mask, all_token=False):
+    def forward(self, x, mask, all_token=False, decode_mask=None, seqlens=None):
+        """
+            decode_mask: torch.Tensor(bool), B, N, subset of masked tokens to reconstruct, None to reconstruct all masked tokens
+            seqlens: list of int, x holds clips of different lengths packed into one sequence, see forward_packed()
+        """
+        if seqlens is not None:
+            return self.forward_packed(x, mask, seqlens, decode_mask=decode_mask)
+
         _, _, T, _, _ = x.shape
         x_vis = self.encoder(x, mask) # [B, N_vis, C_e]
         x_vis = self.encoder_to_decoder(x_vis) # [B, N_vis, C_d]
@@ -368,12 +432,51 @@ class PretrainVisionTransformer(nn.Module):
         # but shuffle the pos embedding accorddingly.
         expand_pos_embed = self.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
         pos_emd_vis = expand_pos_embed[~mask].reshape(B, -1, C)
-        pos_emd_mask = expand_pos_embed[mask].reshape(B, -1, C)
+        pos_emd_mask = expand_pos_embed[mask if decode_mask is None else decode_mask].reshape(B, -1, C)
         x_full = torch.cat([x_vis + pos_emd_vis, self.mask_token + pos_emd_mask], dim=1) # [B, N, C_d]
         x = self.decoder(x_full, pos_emd_mask.shape[1] if not all_token else 0) # [B, N_mask, 3 * 16 * 16]
 
         return x
 
+    def forward_packed(self, x, mask, seqlens, decode_mask=None):
+        """
+            forward samples of different clip lengths packed into one sequence. Clips are concatenated
+            along the temporal dimension, each clip having a multiple of tubelet_size frames, so that
+            the patch embedding of the packed video is the concatenation of the tokens of every clip.
+            Attention is block-diagonal, tokens of a sample never attend to tokens of another sample.
+            Drop path is applied to the packed sequence as a whole.
+
+            Parameters:
+                x: torch.Tensor, 1, C, sum(T_i), H, W
+                mask: torch.Tensor(bool), 1, sum(seqlens), True for masked tokens
+                seqlens: list of int, number of tokens of each sample, T_i // tubelet_size * H//patch_size * W//patch_size
+                decode_mask: torch.Tensor(bool), 1, sum(seqlens), subset of masked tokens to reconstruct,
+                             None to reconstruct all masked tokens
+
+            Return:
+                torch.Tensor, 1, N_decode, decoder_num_classes, predictions of (decoded) masked tokens
+                of all samples, in the token order of x[mask] (as built by build_rgb_target)
+        """
+        x_vis, vis_seqlens = self.encoder.forward_packed(x, mask, seqlens) # [1, N_vis, C_e]
+        x_vis = self.encoder_to_decoder(x_vis) # [1, N_vis, C_d]
+        B, _, C = x_vis.shape
+
+        decode_mask = mask if decode_mask is None else decode_mask
+        pos_embed = packed_pos_embed(self.pos_embed, seqlens).type_as(x_vis).to(x_vis.device).detach()
+
+        # tokens are kept in the order of the input so that every sample stays contiguous,
+        # tokens that are neither visible nor decoded are dropped
+        x_full = self.mask_token.type_as(x_vis).expand(B, mask.shape[1], C).clone()
+        x_full[~mask] = x_vis.reshape(-1, C)
+        x_full = x_full + pos_embed
+
+        keep = ~mask | decode_mask
+        dec_seqlens = torch.stack([m.sum() for m in keep.reshape(-1).split(seqlens)]).tolist()
+        x_full = x_full[keep].reshape(B, -1, C)
+        x = self.decoder(x_full, 0, seqlens=dec_seqlens, return_mask=decode_mask[keep].reshape(B, -1))
+
+        return x
+
 ############# Shared encoder training scheme #############
 
 class MultiModalBlock(nn.Module):
@@ -427,27 +530,20 @@ class MultiModalBlock(nn.Module):
         x1, x2 = token_dict["tokens"]
         N1 = token_dict["split_point"]
 
-        if N1 > 0:
-            # two modalities
-            x1_rgb, x1_flow = x1[:, :N1, :], x1[:, N1:, :]
-            # process RGB
-            # print("x1_rgb shape:", x1_rgb.shape)
-            x1_rgb = x1_rgb + self.drop_path( self.attn(self.norm1(x1_rgb)) )
-            x1_rgb = x1_rgb + self.drop_path( self.mlp(self.norm2(x1_rgb)) )
-            # process Flow
-            # print("norm1 flow:",self.norm1(x1_flow))
-            x1_flow = x1_flow + self.drop_path( self.attn(self.norm1(x1_flow)) )
-            x1_flow = x1_flow + self.drop_path( self.mlp(self.norm2(x1_flow)) )
-
-            x1 = torch.cat([x1_rgb, x1_flow], dim=1)
-        else:
-            # only one modality: rgb or flow
-            x1 = x1 + self.drop_path( self.attn(self.norm1(x1)) )
-            x1 = x1 + self.drop_path( self.mlp(self.norm2(x1)) )
-
+        # rgb, flow (within-modality) and cross-modality sequences share the same weights,
+        # pack them along the token dimension and run norm/attention/mlp once.
+        # attention is restricted to tokens of the same sequence
+        seqlens = [N1, x1.shape[1] - N1] if N1 > 0 else [x1.shape[1]]
+        x = x1
         if x2 is not None:
-            x2 = x2 + self.drop_path( self.attn(self.norm1(x2)) )
-            x2 = x2 + self.drop_path( self.mlp(self.norm2(x2)) )
+            seqlens.append(x2.shape[1])
+            x = torch.cat([x1, x2], dim=1)
+
+        x = x + self.drop_path( self.attn(self.norm1(x), seqlens=seqlens) )
+        x = x + self.drop_path( self.mlp(self.norm2(x)) )
+
+        N = x1.shape[1]
+        x1, x2 = x[:, :N], (x[:, N:] if x2 is not None else None)
 
         token_dict["tokens"] = [x1, x2]
 
@@ -618,7 +714,8 @@ class PretrainMultiModalEncoder(nn.Module):
             x_flow_vis = x_flow[~flow_mask].reshape(B, -1, C) # ~mask means visible
 
         # print(x_flow_vis)
-        expand_global_embed1 = self.global_embed1.expand(B, -1, -1).cuda()
+        device = x_rgb.device if "rgb" in self.modality else x_flow.device
+        expand_global_embed1 = self.global_embed1.expand(B, -1, -1).to(device)
         # print("rgb_vis shape:", x_rgb_vis.shape, "flow_vis shape:", x_flow_vis.shape)
         if self.modality == "rgbflow":
             expand_global_embed2 = self.global_embed2.expand(B, -1, -1).type_as(x_rgb).to(x_rgb.device)
@@ -1067,7 +1164,11 @@ class PretrainMultiModalTransformer(nn.Module):
         "global_embed1", "global_embed2",
         }
 
-    def forward(self, rgb, flow, rgb_mask, flow_mask, all_token=False):
+    def forward(self, rgb, flow, rgb_mask, flow_mask, all_token=False, rgb_decode_mask=None, flow_decode_mask=None):
+        """
+            rgb_decode_mask, flow_decode_mask: torch.Tensor(bool), B, N, subset of masked tokens to reconstruct,
+                                               None to reconstruct all masked tokens
+        """
 
         token_dict = self.encoder(rgb, flow, rgb_mask, flow_mask) 
 
@@ -1099,14 +1200,14 @@ class PretrainMultiModalTransformer(nn.Module):
              # prepare sinusoidal(unlearnable) position embedding
             expand_pos_embed = self.rgb_pos_embed.expand(B, -1, -1).type_as(x1).to(x1.device).clone().detach()
             rgb_pos_emd_vis = expand_pos_embed[~rgb_mask].reshape(B, -1, C)
-            rgb_pos_emd_mask = expand_pos_embed[rgb_mask].reshape(B, -1, C)
+            rgb_pos_emd_mask = expand_pos_embed[rgb_mask if rgb_decode_mask is None else rgb_decode_mask].reshape(B, -1, C)
             intra_rgb_full = torch.cat([intra_rgb_vis + rgb_pos_emd_vis, self.rgb_mask_token + rgb_pos_emd_mask], dim=1)    # [2*B, N, C_d]
             _, N_rgb_mask, _ = rgb_pos_emd_mask.shape
 
         if "flow" in self.modality:
             expand_pos_embed = self.flow_pos_embed.expand(B, -1, -1).type_as(x1).to(x1.device).clone().detach()
             flow_pos_emd_vis = expand_pos_embed[~flow_mask].reshape(B, -1, C)
-            flow_pos_emd_mask = expand_pos_embed[flow_mask].reshape(B, -1, C)
+            flow_pos_emd_mask = expand_pos_embed[flow_mask if flow_decode_mask is None else flow_decode_mask].reshape(B, -1, C)
             intra_flow_full = torch.cat([intra_flow_vis + flow_pos_emd_vis, self.flow_mask_token + flow_pos_emd_mask], dim=1) # [2*B, N, C_d]
             _, N_flow_mask, _ = flow_pos_emd_mask.shape
 
@@ -1118,15 +1219,22 @@ class PretrainMultiModalTransformer(nn.Module):
             cross_flow_vis += self.flow_type_embed.expand(B, -1, -1).type_as(x1).to(x1.device)
             cross_full = torch.cat([cross_rgb_vis + rgb_pos_emd_vis, cross_flow_vis + flow_pos_emd_vis], dim=1)
 
-            cross_rgb_hat = self.rgb_decoder(intra_flow_full, cross_full, N_rgb_mask if not all_token else 0) # [2*B, N_mask, 2 * 16 * 16]
-            cross_flow_hat = self.flow_decoder(intra_rgb_full, cross_full, N_flow_mask if not all_token else 0) # [2*B, N_mask, 3 * 16 * 16]
+            if intra_rgb_full.shape == intra_flow_full.shape:
+                # intra and cross inputs of each decoder have the same shape,
+                # stack them along the batch dimension and run each decoder once
+                cross_full = torch.cat([cross_full, cross_full], dim=0)
+                rgb_hat = self.rgb_decoder(torch.cat([intra_rgb_full, intra_flow_full], dim=0), cross_full, N_rgb_mask if not all_token else 0) # [2*B, N_mask, 3 * 16 * 16]
+                flow_hat = self.flow_decoder(torch.cat([intra_flow_full, intra_rgb_full], dim=0), cross_full, N_flow_mask if not all_token else 0) # [2*B, N_mask, 2 * 16 * 16]
+            else:
+                cross_rgb_hat = self.rgb_decoder(intra_flow_full, cross_full, N_rgb_mask if not all_token else 0) # [B, N_mask, 3 * 16 * 16]
+                cross_flow_hat = self.flow_decoder(intra_rgb_full, cross_full, N_flow_mask if not all_token else 0) # [B, N_mask, 2 * 16 * 16]
 
-            intra_rgb_hat = self.rgb_decoder(intra_rgb_full, cross_full,  N_rgb_mask if not all_token else 0) # [2*B, N_mask, 3 * 16 * 16]
-            intra_flow_hat = self.flow_decoder(intra_flow_full, cross_full, N_flow_mask if not all_token else 0) # [2*B, N_mask, 2 * 16 * 16]
+                intra_rgb_hat = self.rgb_decoder(intra_rgb_full, cross_full,  N_rgb_mask if not all_token else 0) # [B, N_mask, 3 * 16 * 16]
+                intra_flow_hat = self.flow_decoder(intra_flow_full, cross_full, N_flow_mask if not all_token else 0) # [B, N_mask, 2 * 16 * 16]
 
-            rgb_hat = torch.cat([intra_rgb_hat, cross_rgb_hat], dim=0)
-            # rgb_hat = intra_rgb_hat
-            flow_hat = torch.cat([intra_flow_hat, cross_flow_hat], dim=0)
+                rgb_hat = torch.cat([intra_rgb_hat, cross_rgb_hat], dim=0)
+                # rgb_hat = intra_rgb_hat
+                flow_hat = torch.cat([intra_flow_hat, cross_flow_hat], dim=0)
 
             # version 2: attention on partial cross-modality tokens
 
@@ -1194,9 +1302,9 @@ class BottleneckBlock(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, mask):
+    def forward(self, x, mask=None, layout=None):
 
-        x = x + self.drop_path( self.attn(self.norm1(x), mask) )
+        x = x + self.drop_path( self.attn(self.norm1(x), mask, layout) )
         x = x + self.drop_path( self.mlp(self.norm2(x)) )
 
         return x
@@ -1330,16 +1438,12 @@ class PretrainBottleneckEncoder(nn.Module):
 
         expand_bottleneck = self.bottleneck.expand(B, -1, -1).type_as(x_rgb).to(x_rgb.device)
         x = torch.cat((x_rgb_vis, expand_bottleneck, x_flow_vis), dim=1)
-        # prepare mask
+        # rgb and flow tokens only exchange information through the bottleneck tokens
         n_rgb = x_rgb_vis.shape[1]
-        n_flow = x_flow_vis.shape[1]
-        up_mask = torch.cat((torch.ones(n_rgb,n_rgb), torch.zeros(n_rgb, self.num_bottleneck+n_flow)), dim=1)
-        mid_mask = torch.ones(self.num_bottleneck, n_rgb + self.num_bottleneck + n_flow)
-        down_mask = torch.cat((torch.zeros(n_flow,n_rgb), torch.ones(n_flow, n_flow+self.num_bottleneck)), dim=1)
-        attn_mask = torch.cat((up_mask, mid_mask, down_mask), dim=0).to(x_rgb.device)
+        layout = (n_rgb, self.num_bottleneck)
 
         for blk in self.blocks:
-            x = blk(x, attn_mask)
+            x = blk(x, layout=layout)
 
         return x[:, :n_rgb], x[:, n_rgb:n_rgb+self.num_bottleneck], x[:, n_rgb+self.num_bottleneck: ]
 
@@ -1539,7 +1643,11 @@ class PretrainBottleneckTransformer(nn.Module):
         "bottleneck",
         }
 
-    def forward(self, rgb, flow, rgb_mask, flow_mask, all_token=False):
+    def forward(self, rgb, flow, rgb_mask, flow_mask, all_token=False, rgb_decode_mask=None, flow_decode_mask=None):
+        """
+            rgb_decode_mask, flow_decode_mask: torch.Tensor(bool), B, N, subset of masked tokens to reconstruct,
+                                               None to reconstruct all masked tokens
+        """
 
         x = self.encoder(rgb, flow, rgb_mask, flow_mask) 
         x1, bottleneck, x2 = x # [B, 2*N_vis, C_e]
@@ -1554,13 +1662,13 @@ class PretrainBottleneckTransformer(nn.Module):
         expand_pos_embed = self.rgb_pos_embed.expand(B, -1, -1).type_as(x1).to(x1.device).clone().detach()
         rgb_pos_emd_vis = expand_pos_embed[~rgb_mask].reshape(B, -1, C)
         # print(rgb_pos_emd_vis.shape)
-        rgb_pos_emd_mask = expand_pos_embed[rgb_mask].reshape(B, -1, C)
+        rgb_pos_emd_mask = expand_pos_embed[rgb_mask if rgb_decode_mask is None else rgb_decode_mask].reshape(B, -1, C)
         rgb_full = torch.cat([x1 + rgb_pos_emd_vis, self.rgb_mask_token + rgb_pos_emd_mask], dim=1)    # [2*B, N, C_d]
         _, N_rgb_mask, _ = rgb_pos_emd_mask.shape
 
         expand_pos_embed = self.flow_pos_embed.expand(B, -1, -1).type_as(x1).to(x1.device).clone().detach()
         flow_pos_emd_vis = expand_pos_embed[~flow_mask].reshape(B, -1, C)
-        flow_pos_emd_mask = expand_pos_embed[flow_mask].reshape(B, -1, C)
+        flow_pos_emd_mask = expand_pos_embed[flow_mask if flow_decode_mask is None else flow_decode_mask].reshape(B, -1, C)
         flow_full = torch.cat([x2 + flow_pos_emd_vis, self.flow_mask_token + flow_pos_emd_mask], dim=1) # [2*B, N, C_d]
         _, N_flow_mask, _ = flow_pos_emd_mask.shape
 
@@ -1,3 +1,5 @@
+import inspect
+
 import torch
 from torch import optim as optim
 
@@ -21,6 +23,12 @@ try:
 except ImportError:
     has_apex = False
 
+try:
+    from torch.utils._foreach_utils import _get_fused_kernels_supported_devices
+except ImportError:
+    # older torch only has fused kernels for cuda
+    _get_fused_kernels_supported_devices = lambda: ["cuda"]
+
 
 def get_num_layer_for_vit(var_name, num_max_layer):
     if var_name in ("cls_token", "mask_token", "pos_embed"):
@@ -90,7 +98,14 @@ class CustomLayerDecayValueAssigner(object):
             return num_max_layer - 1
 
 
-def get_parameter_groups(model, weight_decay=1e-5, skip_list=(), get_num_layer=None, get_layer_scale=None, ignore_param={}):
+def get_parameter_groups(model, weight_decay=1e-5, skip_list=(), get_num_layer=None, get_layer_scale=None, ignore_param={},
+                         flatten=False):
+    """
+        Args:
+            flatten: bool, group parameters by (weight decay, lr scale, dtype, device) instead of by layer,
+                     layers with the same lr scale share a group and every group can be updated by one
+                     multi-tensor (foreach or fused) kernel
+    """
     parameter_group_names = {}
     parameter_group_vars = {}
 
@@ -113,11 +128,15 @@ def get_parameter_groups(model, weight_decay=1e-5, skip_list=(), get_num_layer=N
         else:
             layer_id = None
 
+        if get_layer_scale is not None:
+            scale = get_layer_scale(layer_id)
+        else:
+            scale = 1.
+        if flatten:
+            group_name = "scale_%s_%s_%s_%s" % (scale, "decay" if this_weight_decay else "no_decay",
+                                                str(param.dtype).split(".")[-1], param.device)
+
         if group_name not in parameter_group_names:
-            if get_layer_scale is not None:
-                scale = get_layer_scale(layer_id)
-            else:
-                scale = 1.
 
             parameter_group_names[group_name] = {
                 "weight_decay": this_weight_decay,
@@ -136,21 +155,53 @@ def get_parameter_groups(model, weight_decay=1e-5, skip_list=(), get_num_layer=N
     return list(parameter_group_vars.values())
 
 
+def multi_tensor_args(opt_cls, parameters, opt_impl="auto"):
+    """
+        keyword arguments selecting the implementation of a torch optimizer
+
+        Args:
+            opt_cls: torch.optim.Optimizer subclass
+            parameters: list of parameters or of parameter groups
+            opt_impl: str, one of
+                auto: fused kernels if the optimizer has them for every parameter, foreach otherwise
+                fused, foreach: the given implementation, foreach if fused is not available
+                for_loop: per-parameter loop
+
+        Returns:
+            dict, {"fused": True}, {"foreach": True} or {"foreach": False}
+    """
+    assert opt_impl in ("auto", "fused", "foreach", "for_loop"), f"Invalid optimizer implementation: {opt_impl}"
+    if opt_impl == "for_loop":
+        return dict(foreach=False)
+
+    params = [p for group in parameters for p in (group["params"] if isinstance(group, dict) else [group])]
+    fused_devices = _get_fused_kernels_supported_devices()
+    has_fused = "fused" in inspect.signature(opt_cls).parameters
+    if opt_impl != "foreach" and has_fused and \
+            all(p.device.type in fused_devices and torch.is_floating_point(p) for p in params):
+        return dict(fused=True)
+    return dict(foreach=True)
+
+
 def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filter_bias_and_bn=True, skip_list=None, 
                         ignore_param={}, lr=None,
                     ):
     opt_lower = args.opt.lower()
     weight_decay = args.weight_decay
+    # implementation of torch optimizers, see multi_tensor_args
+    opt_impl = getattr(args, "opt_impl", "auto")
     if weight_decay and filter_bias_and_bn:
         skip = {}
         if skip_list is not None:
             skip = skip_list
         elif hasattr(model, 'no_weight_decay'):
             skip = model.no_weight_decay()
-        parameters = get_parameter_groups(model, weight_decay, skip, get_num_layer, get_layer_scale, ignore_param=ignore_param)
+        # for_loop keeps the per-layer groups of the per-parameter implementation
+        parameters = get_parameter_groups(model, weight_decay, skip, get_num_layer, get_layer_scale, ignore_param=ignore_param,
+                                          flatten=opt_impl != "for_loop")
         weight_decay = 0.
     else:
-        parameters = model.parameters()
+        parameters = list(model.parameters())
 
     if 'fused' in opt_lower:
         assert has_apex and torch.cuda.is_available(), 'APEX and CUDA required for fused optimizers'
@@ -165,20 +216,22 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
     if hasattr(args, 'opt_betas') and args.opt_betas is not None:
         opt_args['betas'] = args.opt_betas
 
-    print("optimizer settings:", opt_args)
+    print("optimizer settings:", opt_args, "implementation:", opt_impl)
 
     opt_split = opt_lower.split('_')
     opt_lower = opt_split[-1]
     if opt_lower == 'sgd' or opt_lower == 'nesterov':
         opt_args.pop('eps', None)
-        optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=True, **opt_args)
+        optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=True, **opt_args,
+                              **multi_tensor_args(optim.SGD, parameters, opt_impl))
     elif opt_lower == 'momentum':
         opt_args.pop('eps', None)
-        optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=False, **opt_args)
+        optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=False, **opt_args,
+                              **multi_tensor_args(optim.SGD, parameters, opt_impl))
     elif opt_lower == 'adam':
-        optimizer = optim.Adam(parameters, **opt_args)
+        optimizer = optim.Adam(parameters, **opt_args, **multi_tensor_args(optim.Adam, parameters, opt_impl))
     elif opt_lower == 'adamw':
-        optimizer = optim.AdamW(parameters, **opt_args)
+        optimizer = optim.AdamW(parameters, **opt_args, **multi_tensor_args(optim.AdamW, parameters, opt_impl))
     elif opt_lower == 'nadam':
         optimizer = Nadam(parameters, **opt_args)
     elif opt_lower == 'radam':
@@ -188,7 +241,7 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
     elif opt_lower == 'sgdp':
         optimizer = SGDP(parameters, momentum=args.momentum, nesterov=True, **opt_args)
     elif opt_lower == 'adadelta':
-        optimizer = optim.Adadelta(parameters, **opt_args)
+        optimizer = optim.Adadelta(parameters, **opt_args, **multi_tensor_args(optim.Adadelta, parameters, opt_impl))
     elif opt_lower == 'adafactor':
         if not args.lr:
             opt_args['lr'] = None
@@ -196,7 +249,8 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
     elif opt_lower == 'adahessian':
         optimizer = Adahessian(parameters, **opt_args)
     elif opt_lower == 'rmsprop':
-        optimizer = optim.RMSprop(parameters, alpha=0.9, momentum=args.momentum, **opt_args)
+        optimizer = optim.RMSprop(parameters, alpha=0.9, momentum=args.momentum, **opt_args,
+                                  **multi_tensor_args(optim.RMSprop, parameters, opt_impl))
     elif opt_lower == 'rmsproptf':
         optimizer = RMSpropTF(parameters, alpha=0.9, momentum=args.momentum, **opt_args)
     elif opt_lower == 'novograd':
@@ -0,0 +1,114 @@
+import torch
+import torch.nn as nn
+
+try:
+    from torch.ao import quantization as tq
+except ImportError:
+    # torch < 1.10
+    from torch import quantization as tq
+
+from modeling_finetune import Block, PatchEmbed
+
+
+def fold_qkv_bias(model):
+    """
+        fold the separate q/v biases of Attention into its qkv linear layer, so that qkv can be
+        replaced by a quantized linear layer (Attention then calls qkv as a module)
+    """
+    for module in model.modules():
+        if getattr(module, "q_bias", None) is None or not isinstance(module.qkv, nn.Linear):
+            continue
+
+        qkv = module.qkv
+        folded = nn.Linear(qkv.in_features, qkv.out_features, bias=True).to(qkv.weight.device)
+        with torch.no_grad():
+            folded.weight.copy_(qkv.weight)
+            folded.bias.copy_(torch.cat((module.q_bias, torch.zeros_like(module.v_bias), module.v_bias)))
+
+        module.qkv = folded
+        module.q_bias, module.v_bias = None, None
+
+    return model
+
+
+def quantize_dynamic_blocks(model):
+    """
+        dynamic int8 quantization of the linear layers (qkv, proj, fc1, fc2) in the transformer blocks,
+        weights are quantized ahead of time and activations on the fly, no calibration is needed
+    """
+    fold_qkv_bias(model)
+
+    qconfig_spec = {}
+    for name, module in model.named_modules():
+        if isinstance(module, Block):
+            for sub_name, sub_module in module.named_modules():
+                if isinstance(sub_module, nn.Linear):
+                    qconfig_spec[f"{name}.{sub_name}"] = tq.default_dynamic_qconfig
+
+    return tq.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def prepare_static_patch_embed(model, backend="fbgemm"):
+    """
+        insert observers around the Conv3d of every PatchEmbed for static int8 quantization,
+        run calibration batches through model before calling convert_static_patch_embed()
+    """
+    torch.backends.quantized.engine = backend
+    for module in model.modules():
+        if isinstance(module, PatchEmbed) and not isinstance(module.proj, tq.QuantWrapper):
+            module.proj = tq.QuantWrapper(module.proj)
+            module.proj.qconfig = tq.get_default_qconfig(backend)
+            tq.prepare(module.proj, inplace=True)
+
+    return model
+
+
+def convert_static_patch_embed(model):
+    for module in model.modules():
+        if isinstance(module, PatchEmbed) and isinstance(module.proj, tq.QuantWrapper):
+            tq.convert(module.proj, inplace=True)
+
+    return model
+
+
+@torch.no_grad()
+def calibrate(model, data_loader, num_batches):
+    """
+        run num_batches of data_loader (videos at batch[0]) through model to collect activation statistics
+    """
+    model.eval()
+    for i, batch in enumerate(data_loader):
+        if i >= num_batches:
+            break
+        model(batch[0])
+
+    return model
+
+
+def quantize_model(model, mode="dynamic", data_loader=None, num_calib_batches=8, backend="fbgemm"):
+    """
+        post-training int8 quantization for CPU inference
+
+        Parameters:
+            model: nn.Module, fp32 model on cpu in eval mode
+            mode: str, "dynamic": dynamic quantization of linear layers in transformer blocks,
+                       "static": additionally quantize the PatchEmbed Conv3d with calibrated activation ranges
+            data_loader: calibration data for "static", None if the calibrated state_dict is loaded afterwards
+            num_calib_batches: int, number of calibration batches
+            backend: str, quantized engine, "fbgemm"/"x86" for x86 cpus, "qnnpack" for arm cpus
+
+        Return:
+            quantized model
+    """
+    if mode not in ["dynamic", "static"]:
+        raise ValueError(f"Unknown quantization mode:{mode}")
+
+    model.eval()
+    torch.backends.quantized.engine = backend
+    if mode == "static":
+        prepare_static_patch_embed(model, backend)
+        if data_loader is not None:
+            calibrate(model, data_loader, num_calib_batches)
+        convert_static_patch_embed(model)
+
+    return quantize_dynamic_blocks(model)
@@ -0,0 +1,148 @@
+import torch
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+
+
+@torch.no_grad()
+def gather_masked_tubelets(x, mask, patch_size=16, tubelet_size=2):
+    """
+        gather the tubelets of masked tokens without patchifying the whole video
+
+        Parameters:
+            x: torch.Tensor, B, C, T, H, W
+            mask: torch.Tensor(bool), B, N, True for masked tokens, N = T//tubelet_size * H//patch_size * W//patch_size
+                  each sample should have the same number of masked tokens
+            patch_size: int
+            tubelet_size: int
+
+        Return:
+            torch.Tensor, B, N_mask, tubelet_size*patch_size*patch_size, C
+            tubelets are ordered as in x[mask] (token order within each sample)
+
+        Clips of different lengths packed along the temporal dimension (B = 1, each clip of a multiple of
+        tubelet_size frames) give the tubelets of every clip in packed order, see PretrainVisionTransformer.forward_packed()
+    """
+    B, C, T, H, W = x.shape
+    t, h, w = T // tubelet_size, H // patch_size, W // patch_size
+    assert mask.shape[1] == t * h * w, f"mask of {mask.shape[1]} tokens does not match input of {t}x{h}x{w} tokens"
+
+    # view as B, t, h, w, p0, p1, p2, C without copying
+    x = x.reshape(B, C, t, tubelet_size, h, patch_size, w, patch_size).permute(0, 2, 4, 6, 3, 5, 7, 1)
+    b_idx, n_idx = mask.to(x.device).nonzero(as_tuple=True)
+    t_idx, h_idx, w_idx = n_idx // (h * w), n_idx // w % h, n_idx % w
+
+    # only the masked tubelets are copied: K, p0, p1, p2, C
+    tubelets = x[b_idx, t_idx, h_idx, w_idx]
+    tubelets = tubelets.reshape(B, -1, tubelet_size * patch_size * patch_size, C)
+
+    return tubelets
+
+
+@torch.no_grad()
+def build_target(x, mask, patch_size=16, tubelet_size=2, mean=None, std=None, normalize=False):
+    """
+        build reconstruction targets of masked tokens: gather masked tubelets first,
+        then un-normalize and (optionally) normalize only those tubelets
+
+        Parameters:
+            x: torch.Tensor, B, C, T, H, W
+            mask: torch.Tensor(bool), B, N, True for masked tokens
+            patch_size: int
+            tubelet_size: int
+            mean, std: per-channel mean/std used to un-normalize x, None if x is used as it is
+            normalize: bool, normalize each tubelet channel by its own mean and standard deviation
+
+        Return:
+            torch.Tensor, B, N_mask, tubelet_size*patch_size*patch_size*C, channels last
+    """
+    tubelets = gather_masked_tubelets(x, mask, patch_size, tubelet_size)
+    B, N, P, C = tubelets.shape
+
+    if mean is not None:
+        mean = torch.as_tensor(mean, dtype=tubelets.dtype, device=tubelets.device)
+        std = torch.as_tensor(std, dtype=tubelets.dtype, device=tubelets.device)
+        tubelets = torch.addcmul(mean, tubelets, std)   # in [0, 1]
+
+    if normalize:
+        var, mu = torch.var_mean(tubelets, dim=-2, unbiased=True, keepdim=True)
+        tubelets = (tubelets - mu) / (var.sqrt() + 1e-6)
+
+    return tubelets.reshape(B, N, P * C)
+
+
+def build_rgb_target(videos, mask, patch_size=16, normalize=True, tubelet_size=2):
+    """
+        reconstruction target of masked rgb tokens, videos are normalized with imagenet mean/std
+
+        Parameters:
+            videos: torch.Tensor, B, 3, T, H, W
+            mask: torch.Tensor(bool), B, N
+    """
+    return build_target(videos, mask, patch_size, tubelet_size,
+                        mean=IMAGENET_DEFAULT_MEAN, std=IMAGENET_DEFAULT_STD, normalize=normalize)
+
+
+def build_flow_target(flows, mask, patch_size=16, tubelet_size=1):
+    """
+        reconstruction target of masked flow tokens, flow images are used as they are
+
+        Parameters:
+            flows: torch.Tensor, B, 2, T, H, W
+            mask: torch.Tensor(bool), B, N
+    """
+    return build_target(flows, mask, patch_size, tubelet_size)
+
+
+@torch.no_grad()
+def sample_decode_mask(mask, decode_ratio, noise=None, seqlens=None):
+    """
+        sample a random subset of masked tokens to be decoded and reconstructed
+
+        Parameters:
+            mask: torch.Tensor(bool), B, N, True for masked tokens, each sample has the same number of masked tokens
+            decode_ratio: float, ratio of masked tokens to keep
+            noise: torch.Tensor, B, N, optional random scores (lower is kept first), share it between
+                   masks (e.g., rgb and flow) to select the same positions where they are masked alike
+            seqlens: list of int, lengths of samples packed along the token dimension of mask (B = 1),
+                     the ratio is then applied to the masked tokens of each sample
+
+        Return:
+            torch.Tensor(bool), B, N, True for masked tokens that are decoded
+    """
+    if decode_ratio >= 1:
+        return mask
+    if seqlens is not None:
+        return _sample_packed_decode_mask(mask, decode_ratio, seqlens, noise)
+
+    B, N = mask.shape
+    num_mask = int(mask[0].sum())
+    num_decode = max(1, int(round(num_mask * decode_ratio)))
+
+    if noise is None:
+        noise = torch.rand(B, N, device=mask.device)
+    # visible tokens are never selected
+    noise = noise.masked_fill(~mask, 2.)
+    index = noise.argsort(dim=1)[:, :num_decode]
+
+    return torch.zeros_like(mask).scatter_(1, index, True)
+
+
+def _sample_packed_decode_mask(mask, decode_ratio, seqlens, noise=None):
+    N = mask.shape[1]
+    seqlens = torch.as_tensor(seqlens, device=mask.device)
+    # index of the sample of every token
+    sample = torch.repeat_interleave(torch.arange(len(seqlens), device=mask.device), seqlens)
+    num_mask = torch.zeros(len(seqlens), dtype=torch.long, device=mask.device).index_add_(0, sample, mask[0].long())
+    num_decode = torch.minimum((num_mask * decode_ratio).round().long().clamp_(min=1), num_mask)
+
+    if noise is None:
+        noise = torch.rand(1, N, device=mask.device)
+    # sort by sample first, then by noise with visible tokens last within each sample
+    noise = noise.masked_fill(~mask, 2.)[0] + 4. * sample
+    order = noise.argsort()
+    offsets = torch.cumsum(seqlens, 0) - seqlens
+    rank = torch.arange(N, device=mask.device) - offsets[sample]
+
+    decode_mask = torch.zeros_like(mask)
+    decode_mask[0, order] = rank < num_decode[sample]
+
+    return decode_mask
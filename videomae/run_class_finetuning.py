@@ -23,6 +23,8 @@ import multiprocessing as mp
 from multiprocessing.managers import SyncManager
 
 import modeling_finetune
+from token_merging import set_token_merging
+from fast_init import load_checkpoint
 
 import utils
 from utils import NativeScalerWithGradNormCount as NativeScaler
@@ -60,6 +62,8 @@ def get_args():
                         help='Attention dropout rate (default: 0.)')
     parser.add_argument('--drop_path', type=float, default=0.1, metavar='PCT',
                         help='Drop path rate (default: 0.1)')
+    parser.add_argument('--checkpoint_ratio', type=float, default=0.,
+                        help='fraction of blocks using activation checkpointing (default: 0, disabled)')
 
     parser.add_argument('--disable_eval_during_finetuning', action='store_true', default=False)
 
@@ -70,6 +74,8 @@ def get_args():
                         help='Optimizer Epsilon (default: 1e-8)')
     parser.add_argument('--opt_betas', default=None, type=float, nargs='+', metavar='BETA',
                         help='Optimizer Betas (default: None, use opt default)')
+    parser.add_argument('--opt_impl', default='auto', type=str, choices=['auto', 'fused', 'foreach', 'for_loop'],
+                        help='implementation of torch optimizers, fused or foreach multi-tensor kernels or a per-parameter loop (default: auto, fused if available)')
     parser.add_argument('--clip_grad', type=float, default=None, metavar='NORM',
                         help='Clip gradient norm (default: None, no clipping)')
     parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
@@ -145,6 +151,16 @@ def get_args():
     parser.set_defaults(use_mean_pooling=True)
     parser.add_argument('--use_cls', action='store_false', dest='use_mean_pooling')
 
+    # Token merging at inference
+    parser.add_argument('--merge_r', type=int, default=0,
+                        help='number of tokens merged per block at inference (default: 0, disabled)')
+    parser.add_argument('--merge_schedule', type=str, default="constant", choices=["constant", "decreasing"],
+                        help='reduction schedule of token merging over blocks')
+    parser.add_argument('--merge_prop_attn', action='store_true',
+                        help='use proportional attention for merged tokens')
+    parser.add_argument('--no_merge_prop_attn', action='store_false', dest='merge_prop_attn')
+    parser.set_defaults(merge_prop_attn=True)
+
     # Finetuning on ego4d
     # parser.add_argument('--clip_len', type=int, default=8, help="time duration of clip, default is 8s")
 
@@ -360,6 +376,7 @@ def main(args, ds_init):
     if "bottleneck" in args.model:
         num_bottleneck = getattr(args, "num_bottleneck", 8)
         _model_params["num_bottleneck"] = num_bottleneck
+        _model_params["bottleneck_attn"] = getattr(args, "bottleneck_attn", False)
         print("Using 8 bottlenecks for finetuning")
 
     model = create_model(
@@ -379,6 +396,12 @@ def main(args, ds_init):
         **_model_params,
         **_task_specific_params,
     )
+    if args.checkpoint_ratio > 0:
+        num_checkpointed = modeling_finetune.set_grad_checkpointing(model, args.checkpoint_ratio)
+        print("Activation checkpointing for %d blocks" % num_checkpointed)
+    if args.merge_r > 0:
+        merge_schedule = set_token_merging(model, args.merge_r, args.merge_schedule, args.merge_prop_attn)
+        print("Token merging at inference, merged tokens per block: %s" % str(merge_schedule))
     try:
         patch_size = model.patch_embed.patch_size
     except:
@@ -393,7 +416,7 @@ def main(args, ds_init):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.finetune, map_location='cpu', check_hash=True)
         else:
-            checkpoint = torch.load(args.finetune, map_location='cpu')
+            checkpoint = load_checkpoint(args.finetune)
 
         print("Load ckpt from %s" % args.finetune)
         checkpoint_model = None
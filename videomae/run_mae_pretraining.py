@@ -23,12 +23,15 @@ from engine_for_pretraining import (
         train_tsvit_one_epoch, 
         train_multimodal_one_epoch, 
         train_multicae_one_epoch,
-        train_bottleneck_one_epoch
+        train_bottleneck_one_epoch,
+        train_packed_one_epoch,
     )
 
 from utils import NativeScalerWithGradNormCount as NativeScaler
 import utils
 import modeling_pretrain
+from modeling_finetune import set_grad_checkpointing
+from fast_init import load_checkpoint
 import wandb
 
 import logging
@@ -39,6 +42,7 @@ def get_args():
     parser = argparse.ArgumentParser('VideoMAE pre-training script', add_help=False)
     parser.add_argument('--batch_size', default=64, type=int)
     parser.add_argument('--epochs', default=800, type=int)
+    parser.add_argument('--update_freq', default=1, type=int)
     parser.add_argument('--save_ckpt_freq', default=50, type=int)
 
     # Model parameters
@@ -59,9 +63,13 @@ def get_args():
 
     parser.add_argument('--drop_path', type=float, default=0.0, metavar='PCT',
                         help='Drop path rate (default: 0.1)')
+    parser.add_argument('--checkpoint_ratio', type=float, default=0.,
+                        help='fraction of blocks using activation checkpointing (default: 0, disabled)')
                         
     parser.add_argument('--normlize_target', default=True, type=bool,
                         help='normalized the target patch pixels')
+    parser.add_argument('--decode_ratio', default=1., type=float,
+                        help='ratio of masked tokens that are decoded and reconstructed (default: 1, all masked tokens)')
 
     # Optimizer parameters
     parser.add_argument('--opt', default='adamw', type=str, metavar='OPTIMIZER',
@@ -70,6 +78,8 @@ def get_args():
                         help='Optimizer Epsilon (default: 1e-8)')
     parser.add_argument('--opt_betas', default=None, type=float, nargs='+', metavar='BETA',
                         help='Optimizer Betas (default: None, use opt default)')
+    parser.add_argument('--opt_impl', default='auto', type=str, choices=['auto', 'fused', 'foreach', 'for_loop'],
+                        help='implementation of torch optimizers, fused or foreach multi-tensor kernels or a per-parameter loop (default: auto, fused if available)')
     parser.add_argument('--clip_grad', type=float, default=None, metavar='NORM',
                         help='Clip gradient norm (default: None, no clipping)')
     parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
@@ -208,6 +218,10 @@ def get_model(args):
     else:
         raise ValueError(f"Unsupported pretraining scheme:{args.pretrain}")
 
+    if args.checkpoint_ratio > 0:
+        num_checkpointed = set_grad_checkpointing(model, args.checkpoint_ratio)
+        print("Activation checkpointing for %d blocks" % num_checkpointed)
+
     return model
 
 
@@ -268,7 +282,7 @@ def main(args):
     # Load weight for RGB cross-modality Encoder
     ckpt = getattr(args, "ckpt", "")
     if ckpt != "":
-        raw_checkpoints = torch.load(ckpt, map_location="cpu")
+        raw_checkpoints = load_checkpoint(ckpt)
         rgb_encoder_checkpoints = load_weight_for_rgb_encoder(raw_checkpoints, pretrain=args.pretrain)
         missing_keys_lst, unexpected_keys_lst = model.load_state_dict(rgb_encoder_checkpoints, strict=False)
         # Check if rgb cross-modality encoder weights are loaded successfully
@@ -293,7 +307,15 @@ def main(args):
     #     # window size for masking
     #     args.window_size = (args.num_frames // 2, args.input_size // patch_size[0], args.input_size // patch_size[1])
     #     args.patch_size = patch_size
-    if args.pretrain == "multimodal":
+    # packed-sequence pretraining on clips of different lengths, see Egoclip.clip_num_frames()
+    packed = getattr(args.cfg, "PACKED", False)
+    if args.pretrain == "mae" and packed:
+        patch_size = model.encoder.patch_embed.patch_size
+        # masks are generated per clip, input_size only gives the spatial size
+        input_size = (args.num_frames // 2, args.input_size // patch_size[0], args.input_size // patch_size[1])
+        mask_generator = MaskGenerator([args.mask_type], [input_size], [args.mask_ratio])
+
+    elif args.pretrain == "multimodal":
         patch_size = model.encoder.rgb_patch_embed.patch_size
         input_size = (args.num_frames // 2, args.input_size // patch_size[0], args.input_size // patch_size[1])
         num_tokens =(args.num_frames // 2) * (args.input_size // patch_size[0]) * (args.input_size // patch_size[1])
@@ -363,7 +385,7 @@ def main(args):
     num_tasks = utils.get_world_size()
     global_rank = utils.get_rank()
     sampler_rank = global_rank
-    num_training_steps_per_epoch = len(dataset_train) // args.batch_size // num_tasks
+    num_training_steps_per_epoch = len(dataset_train) // args.batch_size // num_tasks // args.update_freq
 
     sampler_train = torch.utils.data.DistributedSampler(
         dataset_train, num_replicas=num_tasks, rank=sampler_rank, shuffle=True
@@ -388,6 +410,7 @@ def main(args):
         pin_memory=args.pin_mem,
         drop_last=True,
         prefetch_factor = 2,
+        collate_fn=utils.packed_samples_collate if packed else None,
         # multiprocessing_context="spawn" if args.flow_mode == "online" else None,
         worker_init_fn=utils.seed_worker
     )
@@ -399,7 +422,7 @@ def main(args):
     print("Model = %s" % str(model_without_ddp))
     print('number of params: {} M'.format(n_parameters / 1e6))
 
-    total_batch_size = args.batch_size * utils.get_world_size()
+    total_batch_size = args.batch_size * args.update_freq * utils.get_world_size()
 
     args.lr = args.lr * total_batch_size / 256
     args.min_lr = args.min_lr * total_batch_size / 256
@@ -407,6 +430,7 @@ def main(args):
 
     print("LR = %.8f" % args.lr)
     print("Batch size = %d" % total_batch_size)
+    print("Update frequent = %d" % args.update_freq)
     print("Number of training steps = %d" % num_training_steps_per_epoch)
     print("Number of training examples per epoch = %d" % (total_batch_size * num_training_steps_per_epoch))
 
@@ -471,7 +495,7 @@ def main(args):
         if args.distributed:
             data_loader_train.sampler.set_epoch(epoch)
         if log_writer is not None:
-            log_writer.set_step(epoch * num_training_steps_per_epoch)
+            log_writer.set_step(epoch * num_training_steps_per_epoch * args.update_freq)
 
         # if args.pretrain == "mae":
         #     train_stats = train_one_epoch(
@@ -507,7 +531,24 @@ def main(args):
         #         lamb = args.lamb,
         #     ) 
 
-        if args.pretrain == "multimodal":
+        if args.pretrain == "mae" and packed:
+            train_stats = train_packed_one_epoch(
+                model, data_loader_train,
+                optimizer, device, epoch, loss_scaler,
+                args.clip_grad, log_writer=log_writer,
+                start_steps=epoch * num_training_steps_per_epoch,
+                lr_schedule_values=lr_schedule_values,
+                wd_schedule_values=wd_schedule_values,
+
+                patch_size=patch_size[0],
+                normlize_target=args.normlize_target,
+                mask_generator = mask_generator,
+                tubelet_size = model_without_ddp.encoder.patch_embed.tubelet_size,
+                train_wo_amp = args.train_wo_amp,
+                decode_ratio = args.decode_ratio,
+                update_freq = args.update_freq,
+            )
+        elif args.pretrain == "multimodal":
 
             train_stats = train_multimodal_one_epoch(
                 model, data_loader_train,
@@ -522,6 +563,8 @@ def main(args):
                 num_tokens = num_tokens,
                 mask_generator = mask_generator,
                 lamb = args.lamb,
+                decode_ratio = args.decode_ratio,
+                update_freq = args.update_freq,
 
             )
         elif args.pretrain == "bottleneck":
@@ -539,6 +582,8 @@ def main(args):
                 num_tokens = num_tokens,
                 mask_generator = mask_generator,
                 lamb = args.lamb,
+                decode_ratio = args.decode_ratio,
+                update_freq = args.update_freq,
 
             )
         elif args.pretrain == "multicae":
@@ -555,6 +600,7 @@ def main(args):
                 normlize_target=args.normlize_target,
                 mask_generator = mask_generator,
                 lamb = args.lamb,
+                update_freq = args.update_freq,
             )
         else:
             raise ValueError(f"Unsupported pretraining scheme:{args.pretrain}")
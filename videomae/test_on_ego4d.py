@@ -13,11 +13,14 @@ from pathlib import Path
 from collections import OrderedDict
 
 from tqdm import tqdm
-from timm.models import create_model
 from datasets import build_dataset
 import utils
 from utils import samples_collate_ego4d_test
 import modeling_finetune
+from token_merging import set_token_merging
+from quantization import quantize_model
+from export_model import load_exported
+from fast_init import create_model_from_checkpoint
 from config_utils import parse_yml, combine
 
 from multiprocessing.managers import SyncManager
@@ -58,6 +61,25 @@ def get_args():
     parser.set_defaults(use_mean_pooling=True)
     parser.add_argument('--use_cls', action='store_false', dest='use_mean_pooling')
 
+    # Token merging at inference
+    parser.add_argument('--merge_r', type=int, default=0,
+                        help='number of tokens merged per block at inference (default: 0, disabled)')
+    parser.add_argument('--merge_schedule', type=str, default="constant", choices=["constant", "decreasing"],
+                        help='reduction schedule of token merging over blocks')
+    parser.add_argument('--merge_prop_attn', action='store_true',
+                        help='use proportional attention for merged tokens')
+    parser.add_argument('--no_merge_prop_attn', action='store_false', dest='merge_prop_attn')
+    parser.set_defaults(merge_prop_attn=True)
+
+    # Int8 quantization for CPU inference
+    parser.add_argument('--quantize', type=str, default="", choices=["", "dynamic", "static"],
+                        help='post-training int8 quantization, requires --device cpu (default: disabled)')
+    parser.add_argument('--quantized_ckpt', type=str, default="",
+                        help='calibrated state_dict saved by benchmarks/quantize_int8.py, required by static quantization')
+    parser.add_argument('--quant_backend', type=str, default="fbgemm", help='quantized engine (fbgemm, x86 or qnnpack)')
+    parser.add_argument('--exported', type=str, default="",
+                        help='artefact saved by export_model.py, used instead of building the model from --ckpt')
+
     # Finetuning on ego4d
     # parser.add_argument('--clip_len', type=int, default=8, help="time duration of clip, default is 8s")
 
@@ -156,44 +178,36 @@ def main(args):
         collate_fn = samples_collate_ego4d_test,
     )
 
-    model = create_model(
-        args.model,
-        pretrained=False,
-        num_classes=args.nb_classes, # when equals to 1, perform ego4d state classification and localization tasks at the same time
-        all_frames = args.cfg.DATA.CLIP_LEN_SEC * args.cfg.DATA.SAMPLING_FPS,
-        tubelet_size=args.tubelet_size,
-        # drop_rate=args.drop,
-        # drop_path_rate=args.drop_path,
-        # attn_drop_rate=args.attn_drop_rate,
-        # drop_block_rate=None,
-        use_mean_pooling=args.use_mean_pooling,
-        # init_scale=args.init_scale,
-
-        # if is ego4d and state change localization task, then the output dimension of feature 
-        # keep_dim = True if (args.nb_classes == args.num_frames+1) and ("ego4d" in args.data_set.lower()) else False
-    )
-
-    # patch_size = model.patch_embed.patch_size
-    # print("Patch size = %s" % str(patch_size))
-    # args.window_size = (args.num_frames // 2, args.input_size // patch_size[0], args.input_size // patch_size[1])
-    # args.patch_size = patch_size
-
-    checkpoint = torch.load(args.ckpt, map_location='cpu')
-    print("Load ckpt from %s" % args.ckpt)
-    checkpoint_model = None
-    for model_key in args.model_key.split('|'):
-        if model_key in checkpoint:
-            checkpoint_model = checkpoint[model_key]
-            print("Load state_dict by model_key = %s" % model_key)
-            break
-    
-    if checkpoint_model is None:
-        checkpoint_model = checkpoint
-
-    model.load_state_dict(checkpoint_model, strict=True)
-    model.to(device)
-    if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
+    if args.exported:
+        # compiled artefact saved by export_model.py, runs on a single process without DDP
+        model = load_exported(args.exported, device)
+        print("Load exported model from %s" % args.exported)
+    else:
+        # parameters are created on the meta device and assigned from the memory-mapped checkpoint
+        print("Load ckpt from %s" % args.ckpt)
+        model = create_model_from_checkpoint(
+            args.model,
+            args.ckpt,
+            model_key=args.model_key,
+            pretrained=False,
+            num_classes=args.nb_classes, # when equals to 1, perform ego4d state classification and localization tasks at the same time
+            all_frames = args.cfg.DATA.CLIP_LEN_SEC * args.cfg.DATA.SAMPLING_FPS,
+            tubelet_size=args.tubelet_size,
+            use_mean_pooling=args.use_mean_pooling,
+        )
+        if args.merge_r > 0:
+            merge_schedule = set_token_merging(model, args.merge_r, args.merge_schedule, args.merge_prop_attn)
+            print("Token merging at inference, merged tokens per block: %s" % str(merge_schedule))
+        if args.quantize:
+            assert device.type == "cpu", "Quantized models only run on cpu"
+            model = quantize_model(model, args.quantize, backend=args.quant_backend)
+            if args.quantize == "static":
+                assert args.quantized_ckpt, "Static quantization needs the calibrated state_dict (--quantized_ckpt)"
+                model.load_state_dict(torch.load(args.quantized_ckpt, map_location="cpu"))
+                print("Load calibrated int8 state_dict from %s" % args.quantized_ckpt)
+        model.to(device)
+        if args.distributed:
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
 
     print(f"Start Testing on Ego4d")
     start_time = time.time()
@@ -201,7 +215,8 @@ def main(args):
     preds_file = os.path.join(args.output_dir, str(global_rank) + '.txt')
     test_on_ego4d(data_loader_test, model, device, preds_file)
 
-    torch.distributed.barrier()
+    if args.distributed:
+        torch.distributed.barrier()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -230,7 +245,7 @@ def test_on_ego4d(data_loader, model, device, file, task=""):
         batch_size = videos.shape[0]
         videos = videos.to(device, non_blocking=True)
         # compute output
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(enabled=torch.device(device).type == "cuda"):
             if flows is not None:
                 flows = flows.to(device, non_blocking=True)
                 output = model(videos, flows)
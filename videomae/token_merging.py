@@ -0,0 +1,189 @@
+import torch
+import torch.nn.functional as F
+
+
+def bipartite_soft_matching(metric, r):
+    """
+        bipartite soft matching of Token Merging (ToMe): tokens are split into two alternating sets,
+        each token of the first set is matched to its most similar token of the second set and
+        the r most similar pairs are merged
+
+        Parameters:
+            metric: torch.Tensor, B, N, C, features used to measure token similarity (e.g. attention keys)
+            r: int, number of tokens to remove, at most N // 2
+
+        Return:
+            merge: function merging a tensor of shape B, N, C into B, N - r, C by summation
+            position: torch.Tensor(long), B, N, index of each token after merging
+    """
+    B, N, _ = metric.shape
+    r = min(r, N // 2)
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        unm_idx = edge_idx[:, r:]  # unmerged tokens of the first set
+        src_idx = edge_idx[:, :r]  # merged tokens of the first set
+        dst_idx = node_idx.gather(dim=1, index=src_idx)
+
+        # merged tokens are laid out as [unmerged tokens of a, tokens of b]
+        num_unm = a.shape[1] - r
+        position = torch.empty(B, N, dtype=torch.long, device=metric.device)
+        position_a = torch.empty_like(node_idx)
+        position_a.scatter_(1, unm_idx, torch.arange(num_unm, device=metric.device).expand(B, -1))
+        position_a.scatter_(1, src_idx, dst_idx + num_unm)
+        position[:, ::2] = position_a
+        position[:, 1::2] = torch.arange(b.shape[1], device=metric.device) + num_unm
+
+    def merge(x):
+        src, dst = x[:, ::2], x[:, 1::2]
+        C = x.shape[-1]
+        unm = src.gather(dim=1, index=unm_idx[..., None].expand(-1, -1, C))
+        src = src.gather(dim=1, index=src_idx[..., None].expand(-1, -1, C))
+        dst = dst.scatter_add(1, dst_idx[..., None].expand(-1, -1, C), src)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge, position
+
+
+def merge_wavg(merge, x, size):
+    """
+        merge tokens by their average weighted by the number of original tokens they represent
+
+        Parameters:
+            merge: function returned by bipartite_soft_matching
+            x: torch.Tensor, B, N, C
+            size: torch.Tensor, B, N, 1, number of original tokens represented by each token
+
+        Return:
+            merged x and size
+    """
+    dtype = x.dtype
+    x = merge(x * size)
+    size = merge(size)
+    return (x / size).to(dtype), size
+
+
+def merge_schedule(num_tokens, depth, r, schedule="constant"):
+    """
+        number of tokens merged in each block
+
+        Parameters:
+            num_tokens: int, number of input tokens
+            depth: int, number of blocks
+            r: int, number of tokens merged per block (average over blocks for "decreasing")
+            schedule: str, "constant" merges r tokens in every block,
+                      "decreasing" merges linearly less tokens from 2r in the first block to 0 in the last block
+
+        Return:
+            list of int
+    """
+    if schedule == "constant":
+        rs = [r] * depth
+    elif schedule == "decreasing":
+        rs = [int(round(2 * r * (1 - i / max(depth - 1, 1)))) for i in range(depth)]
+    else:
+        raise ValueError(f"Unknown token merging schedule:{schedule}")
+
+    # keep at least half of the tokens in every block
+    for i in range(depth):
+        rs[i] = min(rs[i], num_tokens // 2)
+        num_tokens -= rs[i]
+
+    return rs
+
+
+def _attention_with_size(attn, x, size=None):
+    """
+        modeling_finetune.Attention with proportional attention: keys are weighted by the
+        number of original tokens they represent, also return the mean key of heads as the merging metric
+    """
+    B, N, C = x.shape
+    if attn.q_bias is not None:
+        qkv_bias = torch.cat((attn.q_bias, torch.zeros_like(attn.v_bias, requires_grad=False), attn.v_bias))
+        qkv = F.linear(input=x, weight=attn.qkv.weight, bias=qkv_bias)
+    else:
+        qkv = attn.qkv(x)
+    qkv = qkv.reshape(B, N, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+
+    q = q * attn.scale
+    logits = (q @ k.transpose(-2, -1))
+    if size is not None:
+        logits = logits + size.log()[:, None, None, :, 0].to(logits.dtype)
+
+    logits = logits.softmax(dim=-1)
+    logits = attn.attn_drop(logits)
+    x = (logits @ v).transpose(1, 2).reshape(B, N, -1)
+
+    x = attn.proj(x)
+    x = attn.proj_drop(x)
+
+    return x, k.mean(1)
+
+
+def forward_blocks_with_merging(blocks, x, schedule, prop_attn=True):
+    """
+        run modeling_finetune.Block modules with token merging between attention and mlp of each block,
+        merged tokens are copied back to the positions of their original tokens at the end,
+        so that the output can be pooled or reshaped as the output of the blocks without merging
+
+        Parameters:
+            blocks: nn.ModuleList of Block
+            x: torch.Tensor, B, N, C
+            schedule: list of int, number of tokens merged in each block
+            prop_attn: bool, use proportional attention
+
+        Return:
+            torch.Tensor, B, N, C
+    """
+    B, N, C = x.shape
+    size = torch.ones(B, N, 1, dtype=x.dtype, device=x.device)
+    index = torch.arange(N, device=x.device).expand(B, -1)  # index of merged token of each original token
+
+    for blk, r in zip(blocks, schedule):
+        out, metric = _attention_with_size(blk.attn, blk.norm1(x), size if prop_attn else None)
+        x = x + blk.drop_path(out if blk.gamma_1 is None else blk.gamma_1 * out)
+
+        if r > 0:
+            merge, position = bipartite_soft_matching(metric, r)
+            x, size = merge_wavg(merge, x, size)
+            index = position.gather(dim=1, index=index)
+
+        if blk.gamma_2 is None:
+            x = x + blk.drop_path(blk.mlp(blk.norm2(x)))
+        else:
+            x = x + blk.drop_path(blk.gamma_2 * blk.mlp(blk.norm2(x)))
+
+    return x.gather(dim=1, index=index[..., None].expand(-1, -1, C))
+
+
+def set_token_merging(model, r, schedule="constant", prop_attn=True):
+    """
+        enable token merging at inference (model.eval()) for VisionTransformer, OSCCModel and
+        LongTermActionAnticipationModel, r <= 0 disables it
+
+        Parameters:
+            model: nn.Module
+            r: int, number of tokens merged per block
+            schedule: str, see merge_schedule()
+            prop_attn: bool, use proportional attention
+
+        Return:
+            list of int, number of tokens merged in each block
+    """
+    if not hasattr(model, "token_merging"):
+        raise ValueError(f"Token merging is not supported by {type(model).__name__}")
+
+    if r <= 0:
+        model.token_merging = None
+        return []
+
+    rs = merge_schedule(model.patch_embed.num_patches, len(model.blocks), r, schedule)
+    model.token_merging = {"schedule": rs, "prop_attn": prop_attn}
+
+    return rs
@@ -0,0 +1,279 @@
+"""
+persistent job queue shared by the preprocessing scripts
+
+Jobs (one per video or per clip) are stored in a SQLite database together with an estimated cost.
+Worker processes claim the most expensive pending job first, so very long videos are started early
+instead of being left at the tail of a static chunk. Running jobs send heartbeats; a job whose worker
+stopped sending heartbeats is put back to the queue and retried up to `max_retries` times.
+The database doubles as the progress log, re-running a script skips jobs that have finished.
+
+Usage:
+
+    queue = JobQueue("extract_flow.db")
+    queue.add([(key, cost, payload), ...])
+    run_jobs("extract_flow.db", func, nprocess=8)
+
+`func(**payload)` is called in a worker process and should return "success" or "exist", optionally
+followed by comma separated details (e.g., "success,frames:100"). Any other returned string or raised
+exception is recorded as an error.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import multiprocessing as mlp
+from tqdm import tqdm
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _to_builtin(obj):
+    # numpy scalars coming from pandas/numpy annotations
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+class JobQueue(object):
+
+    def __init__(self, db_path, heartbeat_timeout=600):
+        self.db_path = db_path
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "key TEXT PRIMARY KEY, cost REAL, payload TEXT, state TEXT, attempts INTEGER DEFAULT 0, "
+            "worker TEXT, heartbeat REAL, started REAL, finished REAL, message TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_cost ON jobs (state, cost)")
+
+    def add(self, jobs):
+        """
+            add jobs to the queue, jobs that already exist (in any state) are kept as they are
+
+            Parameters:
+                jobs: iterable of (key, cost, payload), payload is a json serialisable dict
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (key, cost, payload, state) VALUES (?, ?, ?, ?)",
+                [(key, float(cost), json.dumps(payload, default=_to_builtin), PENDING) for key, cost, payload in jobs],
+            )
+
+    def reset_failed(self):
+        """ put failed jobs back to the queue """
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET state=?, attempts=0 WHERE state=?", (PENDING, FAILED))
+
+    def claim(self, worker):
+        """
+            atomically take the pending job with the largest cost
+
+            Return:
+                (key, payload) or None if no job is pending
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT key, payload FROM jobs WHERE state=? ORDER BY cost DESC LIMIT 1", (PENDING,)
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+
+            now = time.time()
+            self.conn.execute(
+                "UPDATE jobs SET state=?, worker=?, heartbeat=?, started=?, attempts=attempts+1 WHERE key=?",
+                (RUNNING, worker, now, now, row[0]),
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, key, worker):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET heartbeat=? WHERE key=? AND worker=? AND state=?", (time.time(), key, worker, RUNNING)
+            )
+
+    def finish(self, key, worker, message, max_retries):
+        """
+            record the result of a job, failed jobs are re-queued until they used up `max_retries` attempts
+        """
+        with self.conn:
+            if message.split(",")[0] in ("success", "exist"):
+                self.conn.execute(
+                    "UPDATE jobs SET state=?, finished=?, message=? WHERE key=? AND worker=?",
+                    (DONE, time.time(), message, key, worker),
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE jobs SET state=CASE WHEN attempts>=? THEN ? ELSE ? END, finished=?, message=? "
+                    "WHERE key=? AND worker=?",
+                    (max_retries, FAILED, PENDING, time.time(), message, key, worker),
+                )
+
+    def requeue_stale(self, max_retries):
+        """
+            re-queue running jobs whose worker stopped sending heartbeats (e.g., crashed or was killed)
+
+            Return:
+                number of re-queued jobs
+        """
+        deadline = time.time() - self.heartbeat_timeout
+        with self.conn:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state=CASE WHEN attempts>=? THEN ? ELSE ? END, message=? "
+                "WHERE state=? AND heartbeat<?",
+                (max_retries, FAILED, PENDING, "heartbeat lost", RUNNING, deadline),
+            )
+        return cursor.rowcount
+
+    def summary(self):
+        """
+            Return:
+                states: dict, number of jobs in each state
+                done_cost: float, total cost of finished jobs
+                total_cost: float, total cost of all jobs
+        """
+        states = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for state, num in self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            states[state] = num
+        done_cost, total_cost = self.conn.execute(
+            "SELECT COALESCE(SUM(CASE WHEN state=? THEN cost ELSE 0 END), 0), COALESCE(SUM(cost), 0) FROM jobs", (DONE,)
+        ).fetchone()
+        return states, done_cost, total_cost
+
+    def close(self):
+        self.conn.close()
+
+
+def _heartbeat_worker(db_path, key, worker, interval, stop_event):
+    queue = JobQueue(db_path)
+    while not stop_event.wait(interval):
+        queue.heartbeat(key, worker)
+    queue.close()
+
+
+def worker_loop(db_path, func, max_retries, heartbeat_interval):
+    """
+        keep pulling jobs from the queue until it is empty
+    """
+    worker = f"{os.uname()[1]}:{os.getpid()}"
+    queue = JobQueue(db_path)
+
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            break
+        key, payload = job
+
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(
+            target=_heartbeat_worker, args=(db_path, key, worker, heartbeat_interval, stop_event), daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            message = func(**payload)
+        except Exception as e:
+            message = str(e)
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+        queue.finish(key, worker, message, max_retries)
+
+    queue.close()
+
+
+def run_jobs(db_path, func, nprocess, max_retries=3, heartbeat_interval=30, report_interval=10):
+    """
+        start `nprocess` worker processes that pull jobs until the queue is empty,
+        report progress/throughput and re-queue jobs of crashed workers meanwhile
+
+        Parameters:
+            db_path: str, path of the job database
+            func: module-level function, called as func(**payload) in worker processes
+            nprocess: int, number of worker processes
+            max_retries: int, number of attempts before a job is marked as failed
+            heartbeat_interval: float, seconds between two heartbeats of a running job
+            report_interval: float, seconds between two progress reports
+
+        Return:
+            states: dict, number of jobs in each state when all workers have exited
+    """
+
+    queue = JobQueue(db_path, heartbeat_timeout=max(10 * heartbeat_interval, 60))
+    # jobs left running by a previous (killed) run
+    queue.requeue_stale(max_retries)
+
+    process_pool = []
+    for i in range(nprocess):
+        process = mlp.Process(
+            target=worker_loop, args=(db_path, func, max_retries, heartbeat_interval), name=f"Process-{i}"
+        )
+        process.start()
+        process_pool.append(process)
+
+    states, last_cost, total_cost = queue.summary()
+    progress_bar = tqdm(total=sum(states.values()), initial=states[DONE])
+    start_time = time.time()
+    start_cost = last_cost
+
+    while True:
+        time.sleep(report_interval)
+
+        requeued = queue.requeue_stale(max_retries)
+        if requeued:
+            tqdm.write(f"re-queued {requeued} jobs without heartbeat")
+
+        states, done_cost, total_cost = queue.summary()
+        progress_bar.update(states[DONE] - progress_bar.n)
+        throughput = (done_cost - start_cost) / (time.time() - start_time)
+        progress_bar.set_postfix_str(
+            f"running:{states[RUNNING]}, failed:{states[FAILED]}, "
+            f"cost:{done_cost:.0f}/[{total_cost:.0f}], throughput:{throughput:.1f} cost/s"
+        )
+
+        alive = [process.is_alive() for process in process_pool]
+        if not any(alive) and states[PENDING] == 0 and states[RUNNING] == 0:
+            break
+
+        # restart workers that exited (crashed, or ran out of jobs before others were re-queued)
+        if states[PENDING] > 0:
+            for i, process in enumerate(process_pool):
+                if not alive[i]:
+                    if process.exitcode != 0:
+                        tqdm.write(f"{process.name} exited with code {process.exitcode}, restarting")
+                    process_pool[i] = mlp.Process(
+                        target=worker_loop, args=(db_path, func, max_retries, heartbeat_interval), name=process.name
+                    )
+                    process_pool[i].start()
+
+    for process in process_pool:
+        process.join()
+
+    states, done_cost, total_cost = queue.summary()
+    progress_bar.update(states[DONE] - progress_bar.n)
+    progress_bar.close()
+    elapsed = time.time() - start_time
+    tqdm.write(
+        f"done: {states[DONE]}, failed: {states[FAILED]}, pending: {states[PENDING]}, "
+        f"elapsed: {elapsed:.0f}s, throughput: {(done_cost - start_cost) / max(elapsed, 1e-6):.1f} cost/s"
+    )
+    queue.close()
+
+    return states
@@ -5,12 +5,9 @@ split processed video to clip
 
 import io
 import os
-import shutil
 import csv
 import argparse
 from tqdm import tqdm
-import threading
-import multiprocessing as mlp
 
 import pandas as pd
 from datetime import timedelta
@@ -18,11 +15,10 @@ import time
 
 import signal
 
-import tarfile
 import zipfile
 
-import wandb
-wandb.init(project="preprocess_egoclip")
+from job_scheduler import JobQueue, run_jobs
+from tar_index import TarIndexReader
 
 
 class VideoRecord(object):
@@ -129,10 +125,13 @@ def parse_terminal_args():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--logfile", type=str, default="clip2zip.data", help="Path to log file")
+    parser.add_argument("--logfile", type=str, default="clip2zip.data", help="Path to progress journal, one line per clip")
+
+    parser.add_argument("--jobfile", type=str, default="clip2zip.db", help="Path to job database")
 
     parser.add_argument("--nprocess", type=int, default=1, help="Total number of processes used")
-    parser.add_argument("--max_num_threads", type=int, default=1, help="Number of threads used by each process")
+    parser.add_argument("--max_retries", type=int, default=3, help="Number of attempts for each video")
+    parser.add_argument("--retry_failed", action="store_true", help="Re-queue videos that failed in previous runs")
 
     return parser.parse_args()
 
@@ -183,263 +182,151 @@ def read_epic_csv(anno_path):
     return data_dict
 
 
-def split_data(data_dict, chunk_num=10):
+def read_journal(journal_path):
+    """
+        read processed clips from the progress journal
+
+        Return:
+            done_clips: set, names of clips that have been successfully repacked
+    """
+
+    done_clips = set()
+    if not os.path.exists(journal_path):
+        return done_clips
+
+    with open(journal_path, "r") as fp:
+        for line in fp.readlines():
+            meta = line.strip("\n").split(",")
+            if len(meta) < 2:
+                continue
+            if meta[1] == "success":
+                done_clips.add(meta[0])
+
+    return done_clips
+
 
+def convert_journal(journal_path, data_dict):
     """
-        split data dictionary for each process
+        rewrite a journal of the former per-video format, whose lines are "video_name,state",
+        into one line per clip of the video with the same state
 
         Parameters:
-            data_dict: dict, whose key is video uid and value is a list of all frame indexes of the video 
-            chunk_num: int, number that data_dict will be separated into
+            journal_path: str, path of the progress journal
+            data_dict: dict, whose key is video name and value is a list of clips of the video
 
         Return:
+            converted: int, number of video lines that have been converted
+    """
 
-            chunked_data_dict: list, a list that contains {chunk} numbers of data_dict
+    with open(journal_path, "r") as fp:
+        lines = [line.strip("\n") for line in fp.readlines()]
 
-    """
+    converted = 0
+    new_lines = []
+    for line in lines:
+        meta = line.split(",")
+        if len(meta) >= 2 and meta[0] in data_dict:
+            new_lines.extend(f"{clip['name']},{meta[1]}" for clip in data_dict[meta[0]])
+            converted += 1
+        elif line != "":
+            new_lines.append(line)
 
-    chunked_data_dict = []
-    idx_lst = [i for i in range(len(data_dict.keys()))]
-    chunk_size = len(idx_lst) // chunk_num
+    if converted != 0:
+        with open(journal_path + ".part", "w") as fp:
+            fp.writelines(line + "\n" for line in new_lines)
+        os.replace(journal_path + ".part", journal_path)
 
-    chunk_size_lst =  [i * chunk_size for i in range(chunk_num)]
+    return converted
 
-    chunk_size_lst.append(len(idx_lst))
-    print(f"Chunksize: {chunk_size_lst}")
 
-    data_keys = list(data_dict.keys())
-    for i in range(chunk_num):
-        chunked_data_dict.append([ [*data_dict[key] ] for key in data_keys[chunk_size_lst[i]:chunk_size_lst[i+1]] ])
+def repack_video(path, clip_packs, journal):
+    """
+        job function of the scheduler: repack frames of one video from whole-video rgb/flow tar files
+        into per-clip zip files
 
-    return chunked_data_dict
+        Member offsets of both tar files are read from their index sidecars (built in one sequential
+        pass if missing, see tar_index.py), then the frames of each clip are read with os.pread() in
+        one pass sorted by offset and written into the destination zip files. Each clip is written to
+        a ".part" file that is renamed once complete, so no temporary directory is needed and a
+        partially written clip never looks finished.
 
+        Parameters:
+            path: str, root directory of rgb/flow frames
+            clip_packs: list[dict], clips of one video returned by read_epic_csv()
+            journal: str, path of the progress journal, the state of each clip is appended to it
 
-def thread_worker(path, clip_packs, tmp_dir, queue):
+        Return:
+            state: str, "success" if all clips of the video have been repacked, otherwise error message
+    """
 
     video = clip_packs[0]["video"]
     person = clip_packs[0]["person"]
-    print(video)
-    print( len(clip_packs) )
 
-    # read video tar file from remote server
+    # clips finished by a previous attempt of this job are skipped
+    done_clips = read_journal(journal)
+    clip_packs = [pack for pack in clip_packs if pack["name"] not in done_clips]
+    failed_clips = []
+
+    def report(clip_name, state):
+        if state != "success":
+            failed_clips.append(clip_name)
+        # a single short write in append mode, safe with concurrent writers
+        with open(journal, "a") as fp:
+            fp.write(f"{clip_name},{state}\n")
+
     rgb_frame_path = os.path.join(path, "rgb", "train", person, video)
     flow_frame_path = os.path.join(path, "flow", "train", person, video)
 
-    # exist_rgb_tar_files = [file.split(".")[0] for file in os.listdir(rgb_frame_path) if file.endswith(".tar")]
-    # exist_flow_tar_files = [file.split(".")[0] for file in os.listdir(flow_frame_path) if file.endswith(".tar")]
-    # exist_rgb_zip_files = [file.split(".")[0] for file in os.listdir(rgb_frame_path) if file.endswith(".zip")]
-    # exist_flow_zip_files = [file.split(".")[0] for file in os.listdir(flow_frame_path) if file.endswith(".zip")]
+    try:
+        rgb_reader = TarIndexReader(rgb_frame_path+".tar")
+        flow_reader = TarIndexReader(flow_frame_path+".tar")
+    except Exception as e:
+        return str(e)
 
-    rgb_video_tf = tarfile.open(rgb_frame_path+".tar", "r")
-    flow_video_tf = tarfile.open(flow_frame_path+".tar", "r")
-
-    frame_idx_list = []
-    frame_idx_to_clip = {} # dict[k:list]
-    clip_to_frame_num = {}
-    to_transfer_clip = [] # clip that is not transferred
-    for pack in clip_packs:
+    # visit clips in the order of their first frame so that reads move forward through the tar files
+    for pack in sorted(clip_packs, key=lambda p: p["st_f"]):
 
         name = pack["name"]
         st_f = pack["st_f"]
         end_f = pack["end_f"]
-        person = pack["person"]
-        video = pack["video"]
-
-        rgb_dest = os.path.join(path, "rgb", "train", person, video, name+".zip")
-        flow_dest = os.path.join(path, "flow", "train", person, video, name+".zip")
-
-        if os.path.exists(rgb_dest) and os.path.exists(flow_dest):
-            # if exist, check if we could skip this clip
-            try:
-                # zip file might be corrupted
-                rgb_zf_handle = zipfile.ZipFile(rgb_dest, "r")
-                flow_zf_handle = zipfile.ZipFile(flow_dest, "r")
-                
-                # or has been processed, skip this clip
-                if len(rgb_zf_handle.namelist()) == end_f - st_f + 1:
-                    # check if the flow zip is corrupted
-                    # but did not check the number of flows in it
-                    flow_name_lst = flow_zf_handle.namelist()
-                    print(f"{name} has been processed")
-                    continue
-            except:
-                pass
-
-            finally:
-                rgb_zf_handle.close()
-                flow_zf_handle.close()
-
-
-        for i in range(st_f, end_f+1):
-            if i not in frame_idx_to_clip.keys():
-                frame_idx_to_clip[i] = []
-
-            frame_idx_to_clip[i].append(name)
-
-        # collect all frames in the video that are used for training
-        frame_idx_list.extend(list(range(st_f, end_f+1)))
-        # collect total frame number of each clip
-        clip_to_frame_num[name] = end_f - st_f + 1
-        to_transfer_clip.append(name)
-
-    # deduplicate and sort the frame index list
-    frame_idx_list = sorted(list(set(frame_idx_list)))
-
-    os.makedirs(os.path.join(tmp_dir, "rgb"), exist_ok=True)
-    os.makedirs(os.path.join(tmp_dir, "flow"), exist_ok=True)
-
-    for frame_idx in frame_idx_list:
-        rgb_idx = frame_idx
-        frame_name = "frame_{:010d}.jpg".format(rgb_idx)
-        frame_bytes = rgb_video_tf.extractfile("./" + frame_name).read()
-
-        clip_list = frame_idx_to_clip[frame_idx]
-
-        for clip_name in clip_list:
-            
-            # targeted clip tar file
-            with zipfile.ZipFile(os.path.join(tmp_dir, "rgb", clip_name+".zip"), "a") as zf_handle:
-                # io_buf = io.BytesIO(frame_bytes)       
-                zf_handle.writestr(frame_name, frame_bytes)
-                current_frame_num = len(zf_handle.namelist())
-            # rgb_tf = tarfile.open(os.path.join(tmp_dir, "rgb", clip_name+".tar"), "a" )
-
-            # rgb_tf.addfile(tarfile.TarInfo(frame_name), frame_bytes)
-            # current_frame_num += 1
-            # rgb_tf.close()
-
-            if rgb_idx % 2 == 1:
-
-                flow_idx = (rgb_idx // 2 + 1)
-                flow_name = "frame_{:010d}.jpg".format(flow_idx)
-
-                uflow_bytes = flow_video_tf.extractfile("./u/"+flow_name).read()
-                vflow_bytes = flow_video_tf.extractfile("./v/"+flow_name).read()
-                # print(type(uflow_bytes))
-                with zipfile.ZipFile(os.path.join(tmp_dir, "flow", clip_name+".zip"), "a") as zf_handle:
-                    # u_io_buf = io.BytesIO(uflow_bytes)
-                    # v_io_buf = io.BytesIO(vflow_bytes)
-
-                    zf_handle.writestr("u/"+flow_name, uflow_bytes)
-                    zf_handle.writestr("v/"+flow_name, vflow_bytes)
-
-                # flow_tf = tarfile.open(os.path.join(tmp_dir, "flow", clip_name+".tar"), "a")
-                # flow_tf.addfile(tarfile.TarInfo("u/"+flow_name), uflow_bytes)
-                # flow_tf.addfile(tarfile.TarInfo("v/"+flow_name), vflow_bytes)
-                # flow_tf.close()
-
-            if clip_to_frame_num[clip_name] == current_frame_num:
-                print(f"transferring {clip_name}")
-                rgb_dest = os.path.join(path, "rgb", "train", person, video, clip_name+".zip")
-                flow_dest = os.path.join(path, "flow", "train", person, video, clip_name+".zip")
-
-                shutil.move(os.path.join(tmp_dir, "rgb", clip_name+".zip"), rgb_dest)
-                shutil.move(os.path.join(tmp_dir, "flow", clip_name+".zip"), flow_dest)
-                to_transfer_clip.remove(clip_name)
-
-    # move remaining clips
-    print("to_transfer_clip", len(to_transfer_clip))
-    assert len(to_transfer_clip) == 0
-    # for clip_name in to_transfer_clip:
-    #     rgb_dest = os.path.join(path, "rgb", "train", person, video, clip_name+".zip")
-    #     flow_dest = os.path.join(path, "flow", "train", person, video, clip_name+".zip")
-
-    #     shutil.move(os.path.join(tmp_dir, "rgb", clip_name+".zip"), rgb_dest)
-    #     shutil.move(os.path.join(tmp_dir, "flow", clip_name+".zip"), flow_dest)
-
-    # for pack in clip_packs:
-    #     clip_name = pack["name"]
-    #     rgb_dest = os.path.join(path, "rgb", "train", person, video)
-    #     flow_dest = os.path.join(path, "flow", "train", person, video)
-
-    #     # if clip_name in exist_rgb_tar_files:
-    #     #     os.remove(os.path.join(rgb_dest, clip_name+".tar"))
-    #     # if clip_name in exist_rgb_zip_files:
-    #     #     os.remove(os.path.join(rgb_dest, clip_name+".zip"))
-    #     shutil.move(os.path.join(tmp_dir, "rgb", clip_name+".tar"), rgb_dest)
-
-    #     # if clip_name in exist_flow_tar_files:
-    #     #     os.remove(os.path.join(flow_dest, clip_name+".tar"))
-    #     # if clip_name in exist_flow_zip_files:
-    #     #     os.remove(os.path.join(flow_dest, clip_name+".zip"))
-    #     shutil.move(os.path.join(tmp_dir, "flow", clip_name+".tar"), flow_dest)
-
-    queue.put({
-        "video_name": video,
-        "process_name": mlp.current_process().name,
-        "state": "success",
-    })
-
-
-
-def process_worker(data_list, source, max_num_threads, queue):
-
-    def comm_with_main_proces(pack, queue):
-        pack.update({
-            "process_end": False,
-            "process_name": mlp.current_process().name,
-        })
-        queue.put(pack)
- 
-    active_thread_num = 0
-    thread_pool = {}
-    process_name = mlp.current_process().name
-    thread_queue = mlp.Queue(2*max_num_threads)
-    i = 0
-    # print("data_list", len(data_list))
-
-    while i < len(data_list):
-        # print("i", i)
-        if active_thread_num < max_num_threads:
-            thread_name = f"Thread-{i}"
-            tmp_dir = "./" + process_name + "./"+thread_name
-            os.makedirs(tmp_dir, exist_ok=True)
-
-            thread = threading.Thread(target=thread_worker, args=(source, data_list[i], tmp_dir, thread_queue), name=thread_name)
-            thread.start()
-
-            thread_pool[thread_name] = thread
-            active_thread_num += 1
-            i += 1
-
-        else:
-            pack = thread_queue.get()
-            comm_with_main_proces(pack, queue)
-            thread_name = pack["thread_name"]
-            thread_pool[thread_name].join()
-            active_thread_num -= 1
-
-    # print("waiting for all processes to end...")
-    # for k, thread in thread_pool.items():
-    #     thread.join()
-
-    done_thread_num = 0
-    print("emptying thread queue...")
-    while done_thread_num < active_thread_num or not thread_queue.empty():
-        pack = thread_queue.get()
-        comm_with_main_proces(pack, queue)
-
-        done_thread_num += 1
-        thread_name = pack["thread_name"]
-        thread_pool[thread_name].join()
-
-    # inform main process that this process ended
-    queue.put({
-        "process_end": True,
-        "process_name": mlp.current_process().name,
-
-        "video_name": "",
-        "state": "",
-    })
-
-    return 0
-
-
-def write2log(pack, logger):
-    video_name = pack["video_name"]
-    state = pack["state"]
-
-    logger.write(f"{video_name},{state}\n")
+
+        rgb_dest = os.path.join(rgb_frame_path, name+".zip")
+        flow_dest = os.path.join(flow_frame_path, name+".zip")
+
+        message = "success"
+        try:
+            rgb_names = ["frame_{:010d}.jpg".format(rgb_idx) for rgb_idx in range(st_f, end_f+1)]
+            flow_names = []
+            for rgb_idx in range(st_f, end_f+1):
+                if rgb_idx % 2 == 1:
+                    flow_name = "frame_{:010d}.jpg".format(rgb_idx // 2 + 1)
+                    flow_names.extend(["u/"+flow_name, "v/"+flow_name])
+
+            # frames are already jpeg-compressed, store them as they are
+            with zipfile.ZipFile(rgb_dest+".part", "w") as rgb_zf, zipfile.ZipFile(flow_dest+".part", "w") as flow_zf:
+                for names, reader, zf in [(rgb_names, rgb_reader, rgb_zf), (flow_names, flow_reader, flow_zf)]:
+                    for member_name, data in zip(names, reader.read_batch(names)):
+                        if data is None:
+                            raise KeyError(f"{member_name} not found in {reader.tar_path}")
+                        zf.writestr(member_name, data)
+
+            os.replace(rgb_dest+".part", rgb_dest)
+            os.replace(flow_dest+".part", flow_dest)
+
+        except Exception as e:
+            message = str(e)
+            for part in (rgb_dest+".part", flow_dest+".part"):
+                if os.path.exists(part):
+                    os.remove(part)
+
+        report(name, message)
+
+    rgb_reader.close()
+    flow_reader.close()
+
+    if len(failed_clips) != 0:
+        return f"failed clips:{' '.join(failed_clips)}"
+    return "success"
 
 
 def main(args):
@@ -459,103 +346,45 @@ def main(args):
 
     source = os.path.join(root, "frames_rgb_flow")
 
-    # do not process videos that have already been transformed into clips
-    exclude_videos = []
-    with open(logfile, "r") as log_fp:
-        for line in log_fp.readlines():
-            line = line.strip("\n")
-            if line == "":
-                continue
-            meta = line.split(",")
-            exclude_videos.append(meta[0])
+    # journals of the former per-video format record video names, which would match no clip
+    converted = convert_journal(logfile, data_dict)
+    if converted != 0:
+        print(f"Converted {converted} per-video lines of {logfile} into per-clip lines")
 
-    # deduplicate
-    exclude_videos = list(set(exclude_videos))
+    # do not process clips that have already been recorded in the journal
+    done_clips = read_journal(logfile)
 
     filtered_data_dict = {}
     filtered_num = 0
-    total_clip_num = 0
-    print("Skipping processed/excluded videos...")
-
-    # exclude by video
-    # print(data_dict.keys())
-    # print(exclude_videos)
+    print("Skipping processed clips...")
     for k, v in data_dict.items():
-        if k in exclude_videos:
-            filtered_num += 1
-        else:
-            filtered_data_dict[k] = v
-        # for clip in v:
-        #     if clip["name"] in exclude_videos:
-        #         filtered_num += 1
-        #         continue
-        #     filtered_data_dict[k].append(clip)
+        clips = [clip for clip in v if clip["name"] not in done_clips]
+        filtered_num += len(v) - len(clips)
+        if len(clips) != 0:
+            filtered_data_dict[k] = clips
 
     total_clips = 0
     for k,v in filtered_data_dict.items():
         total_clips += len(v)
     print(f"Clips to be processed:{total_clips}")
-    print(f"{filtered_num}/[{len(exclude_videos)}] videos have been ignored.")
-    # return
-
-    nprocess = args.nprocess
-    # max_num_threads = args.max_num_threads
-    # chunked_data_dict = split_data(filtered_data_dict, nprocess) # list[ list[str, dict, dict, ...], list[], ... ]
-
-    process_pool = {}
-    queue = mlp.Queue(nprocess*2)
-    # for i in range(nprocess):
-    #     process_name = f"Process-{i}"
-    #     process = mlp.Process(target=process_worker, args=(chunked_data_dict[i], source, max_num_threads, queue), name=process_name)
-    #     process.start()
-    #     process_pool[process_name] = process
-
-    idx = 0
-    active_process_num = 0
-    video_names = list(filtered_data_dict.keys())
-    progress_bar = tqdm(total=len(filtered_data_dict))
-
-    logger = open(logfile, "a+")
-    logger.write("\n")
+    print(f"{filtered_num}/[{len(done_clips)}] clips have been ignored.")
+
+    # one job per video, videos with the most frames to repack first
+    queue = JobQueue(args.jobfile)
+    queue.add([
+        (
+            video,
+            sum(clip["end_f"] - clip["st_f"] + 1 for clip in clips),
+            {"path": source, "clip_packs": clips, "journal": logfile},
+        )
+        for video, clips in filtered_data_dict.items()
+    ])
+    if args.retry_failed:
+        queue.reset_failed()
+    queue.close()
 
     tqdm.write(f"recording logs to file: {logfile}")
-    while idx < len(video_names):
-
-        if active_process_num < nprocess:
-            # start a process
-            video_name = video_names[idx]
-            process_name = f"Process-{idx}"
-            tmp_dir = "./" + process_name
-            os.makedirs(tmp_dir, exist_ok=True)
-            process = mlp.Process(target=thread_worker, args=(source, filtered_data_dict[video_name], tmp_dir, queue), name=process_name)
-            process.start()
-            process_pool[process_name] = process
-
-            active_process_num += 1
-            idx +=1 
-        else:
-            pack = queue.get()
-            process_name = pack["process_name"]
-            process_pool[process_name].join()
-
-            active_process_num -= 1
-
-            write2log(pack, logger)
-            progress_bar.update(1)
-
-            wandb.log({"video": idx})
-
-    for name, process in process_pool.items():
-        process.join()
-
-    print("emptying main process queue...")
-    while not queue.empty():
-        pack = queue.get()
-        process_name = pack["process_name"]
-        process_pool[process_name].join()
-
-        write2log(pack, logger)
-        progress_bar.update(1)
+    run_jobs(args.jobfile, repack_video, args.nprocess, max_retries=args.max_retries)
     print("done")
     
 
@@ -564,4 +393,3 @@ if __name__ == "__main__":
     args = parse_terminal_args()
 
     main(args)
-
@@ -1,29 +1,28 @@
 import os
 import csv
 import cv2
-import shutil
+import numpy as np
 import zipfile
 import argparse
 from tqdm import tqdm
 
 import time
-import wandb
-wandb.init(project="preprocess_egoclip")
 
-import threading
-import multiprocessing as mlp
+from job_scheduler import JobQueue, run_jobs
 
 def parse_terminal_args():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--logfile", type=str, default="extract_flow.data", help="Path to log file")
+    parser.add_argument("--jobfile", type=str, default="extract_flow.db", help="Path to job database that records progress")
     parser.add_argument("--anno_path", type=str, default="/data/shared/ssvl/ego4d/v1/annotations/egoclip.csv", help="Path to egoclip annotation file")
 
     parser.add_argument("--source", type=str, default="/data/shared/ssvl/ego4d/v1/egoclip/", help="Path to source videos")
-    parser.add_argument("--gpus", type=str, nargs="+", help="Available gpus")
+    parser.add_argument("--flow_algorithm", type=str, default="tvl1", choices=["tvl1", "dis", "farneback"], help="OpenCV optical flow algorithm")
+    parser.add_argument("--bound", type=float, default=8, help="Maximum optical flow for clipping")
     parser.add_argument("--nprocess", type=int, default=1, help="Total number of processes used")
-    parser.add_argument("--max_num_threads", type=int, default=1, help="Number of threads used by each process")
+    parser.add_argument("--max_retries", type=int, default=3, help="Number of attempts for each clip")
+    parser.add_argument("--retry_failed", action="store_true", help="Re-queue clips that failed in previous runs")
 
     return parser.parse_args()
 
@@ -86,37 +85,6 @@ def read_egoclip_csv(anno_path):
     return data_dict
 
 
-def split_data(data_dict, chunk_num=10):
-
-    """
-        split data dictionary for each process
-
-        Parameters:
-            data_dict: dict, whose key is video uid and value is a list of all frame indexes of the video 
-            chunk_num: int, number that data_dict will be separated into
-
-        Return:
-
-            chunked_data_dict: list, a list that contains {chunk} numbers of data_dict
-
-    """
-
-    chunked_data_dict = []
-    idx_lst = [i for i in range(len(data_dict.keys()))]
-    chunk_size = len(idx_lst) // chunk_num
-
-    chunk_size_lst =  [i * chunk_size for i in range(chunk_num)]
-
-    chunk_size_lst.append(len(idx_lst))
-    print(f"Chunksize: {chunk_size_lst}")
-
-    data_keys = list(data_dict.keys())
-    for i in range(chunk_num):
-        chunked_data_dict.append([[ key, *data_dict[key] ] for key in data_keys[chunk_size_lst[i]:chunk_size_lst[i+1]] ])
-
-    return chunked_data_dict
-
-
 def exec_with_tolerance(func, retry, **kwargs):
     i = 0
     while i < retry:
@@ -273,331 +241,174 @@ def exec_with_tolerance(func, retry, **kwargs):
 #     return 0
 
 
-def clip_thread_worker(video_meta, source, thread_tmp_dir, gpu_id, thread_queue):
-    # print(video_meta)
-    uid, clip_metas = video_meta[0], video_meta[1:]
-
-    for c_meta in clip_metas:
-
-        uid = c_meta["video_uid"]
-        clip_name = c_meta["clip_name"]
-        video_frame_name_to_clip_frame_name = {} # dict{ "frame_%010d": "frame_%010d_%010d" }
-        tmp_dir = thread_tmp_dir + "/" + clip_name
-        os.makedirs(tmp_dir, exist_ok=True)
-
-        if not os.path.exists(os.path.join(source, uid, clip_name, "frames.zip")):
-            thread_queue.put({
-                "thread_name": threading.current_thread().name,
-                "clip_name": clip_name,
-                "thread_end": False,
-                "state": "cannot find frames.zip",
-            })
-            print(f"{clip_name}: cannot find frames.zip")
-            continue
-
-        if os.path.exists(os.path.join(source, uid, clip_name, "flows.zip")):
-            # flows.zip already exists
-            try:
-                with zipfile.ZipFile(os.path.join(source, uid, clip_name, "flows.zip")) as zf:
-                    flow_lst = zf.namelist()
-
-                thread_queue.put({
-                    "thread_name": threading.current_thread().name,
-                    "clip_name": clip_name,
-                    "thread_end": False,
-                    "state": "exist",
-                    })
-                continue
-
-            except:
-                # flow zip corrupted
-                # do nothing and start re-extracting flow
-                pass
-
-        with zipfile.ZipFile(os.path.join(source, uid, clip_name, "frames.zip")) as zf:
-            try:
-                # extract all frames
-                frame_lst = zf.namelist() #  list[str], e.g., frame_0000000758_0000002606.jpg
-                zf.extractall(path=tmp_dir)
-                for i, clip_frame_name in enumerate(frame_lst): # clip_frame_name: looks like frame_0000000758_0000002606.jpg
-
-                    # video_frame_idx = int(clip_frame_name.split("_")[1]) + 1       # let index start from 1
-                    video_frame_idx = i + 1
-                    video_frame_name = "frame_{:010d}".format(video_frame_idx) # global index of the frame, of format: frame_%010d
-
-                    # load with tolerance
-                    ret = exec_with_tolerance(
-                        func = os.rename,
-                        retry=5, 
-                        src = f"{tmp_dir}/{clip_frame_name}", 
-                        dst = f"{tmp_dir}/{video_frame_name}.jpg"
-                    )
-
-                    if i == len(frame_lst) - 1:
-                        # skip last frame, since the corresponding 
-                        # flow does not belong to this clip
-                        continue
-
-                    video_frame_name_to_clip_frame_name[video_frame_name] = clip_frame_name.split(".")[0]
-
-            except Exception as e:
-                thread_queue.put({
-                    "thread_name": threading.current_thread().name,
-                    "thread_end": False,
-                    "clip_name": clip_name,
-                    "state": str(e),
-                    # "error": str(e),
-                })
-
-                print(f"{clip_name}: {str(e)}, {os.listdir(tmp_dir)}")
-                continue
-
-            # start extract optical flow
-            # generated flows will be saved in tmp_dir/u and tmp_dir/v with image's index starts from 1 in format frame_%010d.jpg
-            # use CPU
-            ret_value = os.system(f"bash ./compute_flow_wrapper.sh  0 {tmp_dir} {tmp_dir} frame_%010d.jpg -b 8")
-
-            message = "success"
-            # prepare and transfer flows.zip
-            try:
-                with zipfile.ZipFile(f"{tmp_dir}/{clip_name}.zip", "a") as zf:
-                    for video_frame_name, clip_frame_name in video_frame_name_to_clip_frame_name.items():
-
-                        # print(video_frame_name, clip_name, clip_frame_name)
-                        u_bytes = exec_with_tolerance(
-                                cv2.imencode,
-                                retry = 5,
-                                ext=".jpg", 
-                                img=cv2.imread(f"{tmp_dir}/u/{video_frame_name}.jpg"),
-                            )[1].tobytes()
-
-                        v_bytes = exec_with_tolerance(
-                                cv2.imencode,
-                                retry = 5,
-                                ext=".jpg", 
-                                img=cv2.imread(f"{tmp_dir}/v/{video_frame_name}.jpg") 
-                            )[1].tobytes()
-
-                        zf.writestr(f"u/{clip_frame_name}.jpg", u_bytes)
-                        zf.writestr(f"v/{clip_frame_name}.jpg", v_bytes)
-            except Exception as e:
-                # if error occurred
-                message = str(e)
-            else:
-                # if successfully executed
-                ret = exec_with_tolerance(
-                    shutil.move,
-                    retry = 5,
-                    src=f"{tmp_dir}/{clip_name}.zip", 
-                    dst=os.path.join(source, uid, clip_name, "flows.zip")
-                )
-
-            finally:
-                # finally, send log information
-                thread_queue.put({
-                        "thread_name": threading.current_thread().name,
-                        "thread_end": False,
-                        "clip_name": clip_name,
-                        "state": message, # extract flows for the clip no matter whether missing file exists
-                })   
-                # DELETE frames/flows of current clip
-                # os.system(f"rm -rf {tmp_dir}/*")
-                os.system(f"rm -rf {tmp_dir}")
-
-
-    thread_queue.put({
-        "thread_name": threading.current_thread().name,
-        "thread_end": True,
-        "clip_name": "",
-        "state": "",
-    })
-
-    # delete everything
-    os.system(f"rm -rf {thread_tmp_dir}")
-
-    return 0
-
-def process_worker(data_list, source, max_num_threads, gpu_id, queue):
-
-    def comm_with_main_proces(pack, queue):
-        pack.update({
-            "process_end": False,
-            "process_name": mlp.current_process().name,
-        })
-        queue.put(pack)
- 
+def create_flow_algorithm(name):
+    """
+        create a dense optical flow estimator with OpenCV python bindings
 
-    active_thread_num = 0
-    thread_pool = {}
-    process_name = mlp.current_process().name
-    thread_queue = mlp.Queue(2*max_num_threads)
-    i = 0
-    # print("data_list", len(data_list))
+        Parameters:
+            name: str, one of "tvl1", "dis" and "farneback"
+                "tvl1" uses the same parameters as compute_flow_cpu and requires opencv-contrib-python
 
-    while i < len(data_list):
-        # print("i", i)
-        if active_thread_num < max_num_threads:
-            thread_name = f"Thread-{i}"
-            tmp_dir = "./" + process_name + "./"+thread_name
-            os.makedirs(tmp_dir, exist_ok=True)
+        Return:
+            calc: callable, takes two grayscale float32 frames in [0, 1] and returns a (H, W, 2) float32 flow
+    """
 
-            thread = threading.Thread(target=clip_thread_worker, args=(data_list[i], source, tmp_dir, gpu_id, thread_queue), name=thread_name)
-            thread.start()
+    if name == "tvl1":
+        alg = cv2.optflow.DualTVL1OpticalFlow_create(
+            tau=0.25, lambda_=0.15, theta=0.3, nscales=5, warps=5, epsilon=0.01, innnerIterations=30, outerIterations=10
+        )
+        return lambda prev, nxt: alg.calc(prev, nxt, None)
 
-            thread_pool[thread_name] = thread
-            active_thread_num += 1
-            i += 1
+    elif name == "dis":
+        alg = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        # DIS only accepts 8-bit frames
+        return lambda prev, nxt: alg.calc(
+            (prev * 255).astype(np.uint8), (nxt * 255).astype(np.uint8), None
+        )
 
-        else:
-            pack = thread_queue.get()
+    elif name == "farneback":
+        return lambda prev, nxt: cv2.calcOpticalFlowFarneback(
+            prev, nxt, None, pyr_scale=0.5, levels=3, winsize=15, iterations=3, poly_n=5, poly_sigma=1.2, flags=0
+        )
 
-            thread_name = pack["thread_name"]
-            if pack["thread_end"]:
-                thread_pool[thread_name].join()
-                active_thread_num -= 1
-                continue
+    raise ValueError(f"unknown optical flow algorithm: {name}")
 
-            comm_with_main_proces(pack, queue)
 
-    # print("waiting for all processes to end...")
-    # for k, thread in thread_pool.items():
-    #     thread.join()
+def convert_flow_to_image(flow, bound):
+    """
+        quantise one flow channel to uint8, same as convertFlowToImage in compute_flow_cpu.cpp
+    """
+    return np.rint(255 * (np.clip(flow, -bound, bound) + bound) / (2 * bound)).astype(np.uint8)
 
-    done_thread_num = 0
-    print("emptying thread queue...")
-    while done_thread_num < active_thread_num or not thread_queue.empty():
-        pack = thread_queue.get()
-        if pack["thread_end"]:
-            done_thread_num += 1
-            continue
-        comm_with_main_proces(pack, queue)
 
-    # inform main process that this process ended
-    queue.put({
-        "process_end": True,
-        "process_name": mlp.current_process().name,
+def decode_frame(frame_bytes, min_size=256):
+    """
+        decode a jpeg frame and convert it to grayscale float32,
+        resized in the same way as compute_flow_cpu
+    """
 
-        "clip_name": "",
-        "state": "",
-    })
+    frame = cv2.imdecode(np.frombuffer(frame_bytes, np.uint8), cv2.IMREAD_COLOR)
+    rows, cols = frame.shape[:2]
 
-    return 0
+    # as compute_flow_cpu (float MIN_SZ), the shorter side is scaled to min_size
+    factor = max(min_size / cols, min_size / rows)
+    width = int(cols * factor)
+    width -= width % 2
+    height = int(rows * factor)
+    height -= height % 2
 
+    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_CUBIC)
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame.astype(np.float32) / 255.0
 
-def write2log(pack, log_table):
-    clip_name = pack["clip_name"]
-    state = pack["state"]
 
-    if "clip_name" not in log_table.keys():
-        log_table["clip_name"] = []
-    if "state" not in log_table.keys():
-        log_table["state"] = []
+def compute_clip_flow(frame_zip_path, flow_zip_path, calc, bound=8):
+    """
+        compute optical flows of a clip in memory
 
-    # print(clip_name, state)
-    log_table["clip_name"].append(clip_name)
-    log_table["state"].append(state)
+        Frames are read straight from frames.zip, flows between consecutive frames are computed,
+        quantised and jpeg-encoded once, and then written to the flow archive. Flow of the i-th
+        frame is stored as u/{name of i-th frame} and v/{name of i-th frame}, the last frame has no flow.
 
-    wandb.log({
-        "video": len(log_table["clip_name"]),
-    })
-    # print(wdb_tbl)
+        Parameters:
+            frame_zip_path: str, path of frames.zip of the clip
+            flow_zip_path: str, path of flows.zip to be written
+            calc: callable returned by create_flow_algorithm()
+            bound: float, maximum optical flow for clipping
+    """
 
-def main(args):
+    with zipfile.ZipFile(frame_zip_path, "r") as zf:
+        frame_lst = zf.namelist() #  list[str], e.g., frame_0000000758_0000002606.jpg
+        # write to a partial file first, so that an interrupted run never leaves a valid-looking flows.zip
+        with zipfile.ZipFile(flow_zip_path + ".part", "w") as flow_zf:
+            prev = decode_frame(zf.read(frame_lst[0]))
+            for clip_frame_name, next_frame_name in zip(frame_lst[:-1], frame_lst[1:]):
+                nxt = decode_frame(zf.read(next_frame_name))
+                flow = calc(prev, nxt)
 
-    tqdm.write("reading egoclip annotation file")
-    data_dict = read_egoclip_csv(args.anno_path)
+                u_bytes = cv2.imencode(".jpg", convert_flow_to_image(flow[..., 0], bound))[1].tobytes()
+                v_bytes = cv2.imencode(".jpg", convert_flow_to_image(flow[..., 1], bound))[1].tobytes()
 
-    open(args.logfile, "a+").close()
-
-    checked_clips = []
-    with open(args.logfile, "r") as logger:
-        for line in logger.readlines():
-            if line == "\n" or line == "":
-                continue
-            line = line.strip("\n")
-            meta = line.split(",")
-            # format of line: clip_uid,state
-            if meta[1] == "success" or meta[1] == "exist":
-                checked_clips.append(meta[0])
-
-    tqdm.write("filtering data dict")
-    total_video_num = 0
-    total_clip_num = 0
-    skip_clip_num = 0
-    for video_uid, clip_metas in tqdm(data_dict.items()):
-        new_clip_metas = []
-        for c_meta in clip_metas:
-            if c_meta["clip_name"] in checked_clips:
-                skip_clip_num += 1
-                continue
-            new_clip_metas.append(c_meta)
-
-        if len(new_clip_metas) != 0:
-            total_video_num += 1
-        total_clip_num += len(new_clip_metas)
-        data_dict[video_uid] = new_clip_metas
-
-    tqdm.write(f"skipped {skip_clip_num} clips")
-
-    avail_gpus = args.gpus
-    source = args.source
-    nprocess = args.nprocess
-    max_num_threads = args.max_num_threads
-
-    chunked_data_dict = split_data(data_dict, nprocess) # list[ list[str, dict, dict, ...], list[], ... ]
-
-    # for debugging
-    # chunked_data_dict = [
-    #     [
-    #         ["ff8897f5-55e6-430b-8ea0-336d654a09e9", *data_dict["ff8897f5-55e6-430b-8ea0-336d654a09e9"]]
-
-    #     ]
-    # ]
-
-    process_pool = {}
-    queue = mlp.Queue(nprocess*max_num_threads*2)
-    for i in range(nprocess):
-        process_name = f"Process-{i}"
-        gpu_id = avail_gpus[i % len(avail_gpus)]
-        process = mlp.Process(target=process_worker, args=(chunked_data_dict[i], source, max_num_threads, gpu_id, queue), name=process_name)
-        process.start()
-        process_pool[process_name] = process
-
-    iter = 0
-    done_process = 0
-    progress_bar = tqdm(total=total_clip_num)
-    log_table = {}
-
-    tqdm.write(f"recording logs to file: {args.logfile}")
-    while iter < total_clip_num and done_process < nprocess :
-
-        pack = queue.get()
-
-        if not pack["process_end"]:
-            # if process not end
-
-            write2log(pack, log_table)
-            iter += 1
-            progress_bar.update(1)
-            progress_bar.set_postfix_str(f"current process number:{nprocess-done_process}")
+                flow_zf.writestr(f"u/{clip_frame_name}", u_bytes)
+                flow_zf.writestr(f"v/{clip_frame_name}", v_bytes)
+                prev = nxt
 
-        else:
-            print(f"Process: {pack['process_name']} finished")
-            done_process += 1
+    os.replace(flow_zip_path + ".part", flow_zip_path)
+
+
+# optical flow estimators created in each worker process, keyed by algorithm name
+_FLOW_ALGORITHMS = {}
+
+
+def extract_clip_flow(source, uid, clip_name, flow_algorithm, bound):
+    """
+        job function of the scheduler: extract flows.zip for one clip
 
-        # tqdm.set_postfixstr
+        Return:
+            state: str, "success", "exist" or error message
+    """
+
+    if flow_algorithm not in _FLOW_ALGORITHMS:
+        _FLOW_ALGORITHMS[flow_algorithm] = create_flow_algorithm(flow_algorithm)
+    calc = _FLOW_ALGORITHMS[flow_algorithm]
+
+    if not os.path.exists(os.path.join(source, uid, clip_name, "frames.zip")):
+        return "cannot find frames.zip"
+
+    if os.path.exists(os.path.join(source, uid, clip_name, "flows.zip")):
+        # flows.zip already exists
+        try:
+            with zipfile.ZipFile(os.path.join(source, uid, clip_name, "flows.zip")) as zf:
+                flow_lst = zf.namelist()
+            return "exist"
+        except:
+            # flow zip corrupted
+            # do nothing and start re-extracting flow
+            pass
+
+    compute_clip_flow(
+        os.path.join(source, uid, clip_name, "frames.zip"),
+        os.path.join(source, uid, clip_name, "flows.zip"),
+        calc,
+        bound=bound,
+    )
 
-    print("emptying main process queue...")
-    while not queue.empty():
-        pack = queue.get()
-        if pack["process_end"]:
-            continue
-        write2log(pack, log_table)
+    return "success"
+
+
+def main(args):
+
+    tqdm.write("reading egoclip annotation file")
+    data_dict = read_egoclip_csv(args.anno_path)
 
+    # one job per clip, longest clips first
+    queue = JobQueue(args.jobfile)
+    queue.add([
+        (
+            c_meta["clip_name"],
+            c_meta["end_frame"] - c_meta["start_frame"] + 1,
+            {
+                "source": args.source,
+                "uid": c_meta["video_uid"],
+                "clip_name": c_meta["clip_name"],
+                "flow_algorithm": args.flow_algorithm,
+                "bound": args.bound,
+            },
+        )
+        for video_uid, clip_metas in data_dict.items() for c_meta in clip_metas
+    ])
+    if args.retry_failed:
+        queue.reset_failed()
+
+    states, _, _ = queue.summary()
+    tqdm.write(f"skipped {states['done']} clips, recording progress to: {args.jobfile}")
+    queue.close()
+
+    run_jobs(args.jobfile, extract_clip_flow, args.nprocess, max_retries=args.max_retries)
 
     print("done")
 
 if __name__ == "__main__":
 
     args = parse_terminal_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -14,25 +14,22 @@ from PIL import Image
 
 import shutil
 import zipfile
-import threading
-import multiprocessing as mlp
-from multiprocessing import Queue
 
 from ego4d_trim import _get_frames
-import wandb
-wandb.init(project="preprocess_egoclip")
+from job_scheduler import JobQueue, run_jobs
 
 def parse_terminal_args():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--logfile", type=str, default="processed_video.data", help="Path to log file")
+    parser.add_argument("--jobfile", type=str, default="processed_video.db", help="Path to job database that records progress")
     parser.add_argument("--anno_path", type=str, default="/data/shared/ssvl/ego4d/v1/annotations/egoclip.csv", help="Path to egoclip annotation file")
     parser.add_argument("--source", type=str, default="/data/shared/ssvl/ego4d/v1/full_scale/", help="Path to source videos")
     parser.add_argument("--dest", type=str, default="/data/shared/ssvl/ego4d/v1/egoclip/", help="Path to destination")
 
     parser.add_argument("--nprocess", type=int, default=2, help="Total number of processes used")
-    parser.add_argument("--max_num_threads", type=int, default=32, help="Number of threads used by each process")
+    parser.add_argument("--max_retries", type=int, default=3, help="Number of attempts for each video")
+    parser.add_argument("--retry_failed", action="store_true", help="Re-queue videos that failed in previous runs")
     parser.add_argument("--desired_shorter_side", type=int, default=256, help="shorter side size of final frame")
 
     return parser.parse_args()
@@ -143,37 +140,6 @@ def read_egoclip_csv(anno_path):
     return data_dict
 
 
-def split_data(data_dict, chunk_num=10):
-
-    """
-        split data dictionary for each process
-
-        Parameters:
-            data_dict: dict, whose key is video uid and value is a list of all frame indexes of the video 
-            chunk_num: int, number that data_dict will be separated into
-
-        Return:
-
-            chunked_data_dict: list, a list that contains {chunk} numbers of data_dict
-
-    """
-
-    chunked_data_dict = []
-    idx_lst = [i for i in range(len(data_dict.keys()))]
-    chunk_size = len(idx_lst) // chunk_num
-
-    chunk_size_lst =  [i * chunk_size for i in range(chunk_num)]
-
-    chunk_size_lst.append(len(idx_lst))
-    print(f"Chunksize: {chunk_size_lst}")
-
-    data_keys = list(data_dict.keys())
-    for i in range(chunk_num):
-        chunked_data_dict.append([[ key, *data_dict[key] ] for key in data_keys[chunk_size_lst[i]:chunk_size_lst[i+1]] ])
-
-    return chunked_data_dict
-
-
 def filter_data(data_dict, filter_list, keep_num=-1):
     """
         filter data_dict given a video list: only keep video that is in the given video list
@@ -199,22 +165,30 @@ def filter_data(data_dict, filter_list, keep_num=-1):
     return filtered_data_dict
 
 
-def td_worker(source, dest, data_dict, tmp_dir, td_queue, desired_shorter_side):
+def process_video(source, dest, uid, clip_list, desired_shorter_side):
+    """
+        job function of the scheduler: extract frames of one video and write frames.zip for each of its clips
+
+        Parameters:
+            uid: str, video uid
+            clip_list: list of (start, end, stride), frame indexes of each clip of the video as range arguments
+
+        Return:
+            state: str, "success,frames:{num},missed:{frame indexes}" or error message
+    """
 
-    thread = threading.current_thread()
-    thread_name = thread.name
     # create temporal directory locally
+    tmp_dir = f"./{os.getpid()}/{uid}"
     os.makedirs(tmp_dir, exist_ok=True)
 
-    uid, clip_list = data_dict[0], data_dict[1:]
-
     # make video directory on destination
     frame_save_path = os.path.join(dest, uid)
     os.makedirs(frame_save_path, exist_ok=True)
 
     frame_to_clip = {}  
     frames_list = []
-    for clip_idx, clip in enumerate(clip_list):
+    for clip_idx, clip_range in enumerate(clip_list):
+        clip = range(*clip_range)
         # make directory for each clip
         os.makedirs(os.path.join(dest, uid, uid + "_{:05d}".format(clip_idx)), exist_ok=True)
 
@@ -238,17 +212,14 @@ def td_worker(source, dest, data_dict, tmp_dir, td_queue, desired_shorter_side):
 
     frames_list = sorted(list(set(frames_list)))
 
-    # exist_frames = [frame_name.split(".")[0] for frame_name in os.listdir(frame_save_path)]
-
     video_path = os.path.join(source, uid+".mp4")
-    # print(video_path)
 
     try:
         container = av.open(video_path)
     except Exception as e:
         # corrupted video
-        td_queue.put({"error": str(e), "processed_frame_num": 0, "uid":uid, "thread_name":thread_name})
-        return
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return f"error:{str(e)}"
 
     iterable_frame_source = _get_frames(
             frames_list,
@@ -272,77 +243,14 @@ def td_worker(source, dest, data_dict, tmp_dir, td_queue, desired_shorter_side):
             # only transfer zip file that do not exist in dest
             shutil.move(tmp_dir +"/" + clip_name, os.path.join(dest, uid, uid + "_{:05d}".format(clip_idx), "frames.zip" ))
 
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
     # Last few frame indexes in frames_list might exceed video duration
     missed_frame = []
     if frame_num < len(frames_list):
         missed_frame = [str(idx) for idx in frames_list[frame_num:]]
 
-    td_queue.put({"processed_frame_num": frame_num, "uid":uid, "missed_frame":missed_frame, "thread_name":thread_name})
-    return
-
-
-def worker(lst_dict, source, dest, queue, max_num_threads, desired_shorter_side):
-
-    # communication function that communicates with main process
-    def comm_with_main_process(ret, queue):
-        processed_frame_num = ret["processed_frame_num"]
-        uid = ret["uid"]
-
-        if processed_frame_num == 0:
-            # error occurred
-            error = ret["error"]
-            queue.put({"video_uid":uid, "pid": os.getpid(), "state":"on", "error": str(error)})
-        else:
-            missed_frame = ret["missed_frame"]
-            queue.put({"video_uid":uid, "pid": os.getpid(), "state":"on", "error":0, "frame_processed":processed_frame_num, "missed_frame": missed_frame})
-
-    i = 0
-    thread_pool = {}
-    active_thread_num = 0
-    td_queue = Queue(maxsize=2*max_num_threads)
-    pid = os.getpid()
-    next_avail_thread_name = ""
-    while i < len(lst_dict):
-
-        data_dict = lst_dict[i]
-        if active_thread_num < max_num_threads:
-            
-            given_thread_name = f"{pid}-Thread:{i}" if next_avail_thread_name == "" else next_avail_thread_name
-            tmp_dir = f"./{pid}/{given_thread_name}" # temporal directory to store files locally
-            os.makedirs(tmp_dir, exist_ok=True)
-
-            thread = threading.Thread( target=td_worker, args=(source, dest, data_dict, tmp_dir, td_queue, desired_shorter_side), name=given_thread_name)
-            thread.start()
-
-            thread_pool[thread.name] = thread
-            active_thread_num += 1
-            i += 1
-        else:
-            # lock until thread return some result
-            # However, the thread might still be alive
-            ret = td_queue.get()
-            comm_with_main_process(ret, queue)
-            thread_name = ret["thread_name"]
-            next_avail_thread_name = thread_name
-
-            # call .join() to wait until some thread finished
-            thread_pool[thread_name].join()
-            active_thread_num -= 1
-
-
-    # wait for remaining threads to finish
-    print("Waiting for all threads to end")
-    for k, td in thread_pool.items():
-        td.join()
-
-    # obtain all remaining information
-    print("Emptying thread queue")
-    while not td_queue.empty():
-        # get ret from queue
-        ret = td_queue.get()
-        comm_with_main_process(ret, queue) 
-
-    queue.put({"video_uid":None, "pid": os.getpid(), "state":"off", "error":0})
+    return f"success,frames:{frame_num},missed:{','.join(missed_frame)}"
 
 
 def main(args):
@@ -353,28 +261,12 @@ def main(args):
     dest =  args.dest
     desired_shorter_side  = args.desired_shorter_side
 
-    nprocess = args.nprocess
-    max_num_threads = args.max_num_threads
-
 
     print("Reading egoclip annotation file..")
     data_dict = read_egoclip_csv(anno_path)
 
-    # obtain processed video list
-    processed_video_list = []
-    open(args.logfile, "a+").close()
-    with open(args.logfile, "r") as fp:
-        for line in fp.readlines():
-            if line == "\n":
-                continue
-            meta = line.split(",")
-            if meta[1] == "success":
-               processed_video_list.append(meta[0])
-
-    processed_video_list = list(set(processed_video_list))
-
-    # obtain exist videos that are not processed yet
-    # filter_list = [video.split(".")[0] for video in os.listdir(source) if video.split(".")[0] not in processed_video_list]
+    # obtain exist videos
+    # filter_list = [video.split(".")[0] for video in os.listdir(source)]
 
     filter_list = [
         # "ec344610-74f4-4765-9c3f-0837ef78055d",
@@ -389,92 +281,34 @@ def main(args):
 
     # filter data_dict according to filter_list
     data_dict = filter_data(data_dict, filter_list)
-    
-    # for debugging
-    # data_dict = {
-    #        "e14466f5-e646-4af2-a53f-1527cdf82cf9": data_dict["e14466f5-e646-4af2-a53f-1527cdf82cf9"],
-    #        "e70f4b34-432f-47dc-834f-5bc6bd67dc62": data_dict["e70f4b34-432f-47dc-834f-5bc6bd67dc62"],
-    #        }
-
-    # collect total number of frames
-    total_frame_num = 0
-    for k,v in data_dict.items():
-        _temp = []
-        for clip in v:
-            # clip: list
-            _temp.extend(clip)
-        total_frame_num += len(list(set(_temp)))
-
-    print("Splitting Data for Multi-Processing..")
-    chunked_data_dict = split_data(data_dict, chunk_num=nprocess)
-
-    queue = Queue(maxsize=2*max_num_threads*nprocess)
-    process_pool = []
-    # print(chunked_data_dict[0][0])
-    for i in range(nprocess):
-        process = mlp.Process(target=worker, args=(chunked_data_dict[i], source, dest, queue, max_num_threads, desired_shorter_side))
-        process.start()
-        process_pool.append(process)
-
-
-    done_process = 0
-    failed_video_num = 0
-    done_video_frame = 0
-    done_video = 0
-    pbar = tqdm(total=len(data_dict))
-
-    with open(args.logfile, "a+") as logger:
-        logger.write("\n")
-
-        while True:
-            pack = queue.get()
-
-            if pack["state"] == "on":
-
-                if pack["error"]:
-                    # error occurred while reading/processing the video
-                    failed_video_num += 1
-
-                    logger.write(f"{pack['video_uid']},error:{pack['error']}\n")
-                    # pbar.set_postfix_str(f"current processes:{nprocess-done_process}, processed frames:{done_video_frame}/[{total_frame_num}], failed video: {failed_video_num}")
-                    # pbar.update(1)
-                else:
-                    frame_processed = pack["frame_processed"]
-                    missed_frame = pack["missed_frame"]
-                    done_video_frame += frame_processed
-                    done_video += 1
-                    logger.write(f"{pack['video_uid']},success,frames:{frame_processed},missed:{','.join(missed_frame)}\n")
-
-                pbar.set_postfix_str(f"current processes:{nprocess-done_process}, processed frames:{done_video_frame}/[{total_frame_num}], failed video: {failed_video_num}")
-                pbar.update(1)
-                wandb.log({"video": done_video, "fail": failed_video_num})
-                
-
-            else:
-                done_process += 1
-
-            if done_process == nprocess:
-                break
-
-
-    tqdm.write(f"total videos: {len(data_dict)} failed num: {failed_video_num}")
-    tqdm.write("Waiting for all process to end")
-    for i in range(nprocess):
-        process_pool[i].join()
-
-    tqdm.write("Emptying process queue")
-    while not queue.empty():
-
-        pack = queue.get()
-
-        if pack["error"]:
-            # error occurred while reading/processing the video
-            logger.write(f"{pack['video_uid']},error:{pack['error']}\n")
-        else:
-            frame_processed = pack["frame_processed"]
-            missed_frame = pack["missed_frame"]
-            logger.write(f"{pack['video_uid']},success,frames:{frame_processed},missed:{','.join(missed_frame)}\n")
 
+    # one job per video, videos with the most frames to decode first
+    queue = JobQueue(args.jobfile)
+    jobs = []
+    for uid, clip_list in data_dict.items():
+        _temp = set()
+        for clip in clip_list:
+            _temp.update(clip)
+        # payloads keep only the frame range of each clip, expanded by process_video
+        clip_list = [(clip[0], clip[-1] + 1, 1) for clip in clip_list]
+        jobs.append((
+            uid,
+            len(_temp),
+            {
+                "source": source,
+                "dest": dest,
+                "uid": uid,
+                "clip_list": clip_list,
+                "desired_shorter_side": desired_shorter_side,
+            },
+        ))
+    queue.add(jobs)
+    if args.retry_failed:
+        queue.reset_failed()
+    queue.close()
+
+    print(f"recording progress to: {args.jobfile}")
+    run_jobs(args.jobfile, process_video, args.nprocess, max_retries=args.max_retries)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+"""
+persisted member index of tar files for random-access frame reads
+
+tarfile has to read every member header from the start of an archive before getmember()/extractfile()
+can find a frame, which every DataLoader worker and every preprocessing process pays again for every
+archive it opens. The index (member name -> data offset, size) of a tar file is built once in a single
+sequential pass and saved next to it as "<name>.tar.idx":
+
+    header:  magic, size and mtime of the tar file, number of members
+    arrays:  offsets (uint64), sizes (uint64), name lengths (uint16), then the utf-8 member names
+
+The sidecar is rebuilt when the tar file changes (size or mtime). Frames are then read with os.pread(),
+a batch of frames in one pass sorted by offset, neighbouring members being merged into a single read.
+
+Build the sidecars of all tar files under some directories once:
+
+    python tar_index.py /path/to/frames_rgb_flow --nprocess 16
+
+"""
+
+import os
+import struct
+import argparse
+import tarfile
+import multiprocessing as mlp
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+
+MAGIC = b"TARIDX01"
+# magic, tar size, tar mtime_ns, number of members
+HEADER = struct.Struct("<8sQQQ")
+SUFFIX = ".idx"
+
+# recently loaded indexes of the current process, keyed by (tar path, size, mtime_ns), least recently used first;
+# bounded since a worker opens the tars of every clip it is given over an epoch
+_indexes = OrderedDict()
+MAX_CACHED_INDEXES = 64
+
+
+def _member_name(name):
+    return name[2:] if name.startswith("./") else name
+
+
+def index_tarfile(tar_path):
+    """
+        build a member index of a tar file in one sequential pass
+
+        Parameters:
+            tar_path: str, path of tar file
+
+        Return:
+            index: dict, whose key is member name (leading "./" removed) and value is a tuple (offset, size),
+                where offset is the byte offset of member data in the tar file
+
+    """
+
+    index = {}
+    # stream mode ("r|") reads headers strictly sequentially and never seeks back
+    with tarfile.open(tar_path, "r|") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            index[_member_name(member.name)] = (member.offset_data, member.size)
+
+    return index
+
+
+def save_index(tar_path, index, index_path=None):
+    """
+        write the sidecar of tar_path, the file is written to a temporary path then renamed
+    """
+    index_path = index_path or tar_path + SUFFIX
+    stat = os.stat(tar_path)
+
+    names = [name.encode() for name in index.keys()]
+    offsets = np.array([offset for offset, _ in index.values()], dtype="<u8")
+    sizes = np.array([size for _, size in index.values()], dtype="<u8")
+    name_lengths = np.array([len(name) for name in names], dtype="<u2")
+
+    tmp_path = f"{index_path}.{os.getpid()}.part"
+    with open(tmp_path, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns, len(names)))
+        fp.write(offsets.tobytes())
+        fp.write(sizes.tobytes())
+        fp.write(name_lengths.tobytes())
+        fp.write(b"".join(names))
+    os.replace(tmp_path, index_path)
+
+
+def read_index(tar_path, index_path=None):
+    """
+        read the sidecar of tar_path
+
+        Return:
+            index: dict as returned by index_tarfile(), None if the sidecar is missing or out of date
+    """
+    index_path = index_path or tar_path + SUFFIX
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path, "rb") as fp:
+        data = fp.read()
+    magic, tar_size, tar_mtime_ns, count = HEADER.unpack_from(data, 0)
+    stat = os.stat(tar_path)
+    if magic != MAGIC or tar_size != stat.st_size or tar_mtime_ns != stat.st_mtime_ns:
+        return None
+
+    pos = HEADER.size
+    offsets = np.frombuffer(data, dtype="<u8", count=count, offset=pos).tolist()
+    pos += 8 * count
+    sizes = np.frombuffer(data, dtype="<u8", count=count, offset=pos).tolist()
+    pos += 8 * count
+    name_lengths = np.frombuffer(data, dtype="<u2", count=count, offset=pos)
+    pos += 2 * count
+
+    ends = (pos + np.cumsum(name_lengths, dtype=np.int64)).tolist()
+    starts = [pos] + ends[:-1]
+    names = [data[start:end].decode() for start, end in zip(starts, ends)]
+
+    return dict(zip(names, zip(offsets, sizes)))
+
+
+def load_index(tar_path, build=True, save=True):
+    """
+        index of tar_path from its sidecar, building (and saving, if the directory is writable) it if needed,
+        the MAX_CACHED_INDEXES most recently used indexes are kept in memory
+
+        Return:
+            index: dict as returned by index_tarfile(), None if there is no sidecar and build is False
+    """
+    st = os.stat(tar_path)
+    key = (tar_path, st.st_size, st.st_mtime_ns)
+    if key in _indexes:
+        _indexes.move_to_end(key)
+        return _indexes[key]
+
+    index = read_index(tar_path)
+    if index is None:
+        if not build:
+            return None
+        index = index_tarfile(tar_path)
+        if save:
+            try:
+                save_index(tar_path, index)
+            except OSError:
+                # read-only dataset directory, keep the index in memory only
+                pass
+
+    _indexes[key] = index
+    if len(_indexes) > MAX_CACHED_INDEXES:
+        _indexes.popitem(last=False)
+    return index
+
+
+class TarIndexReader(object):
+    """
+        random-access reader of tar members with os.pread() and the persisted index
+
+        Parameters:
+            tar_path: str, path of tar file
+            max_gap: int, members closer than max_gap bytes are fetched by a single read in read_batch()
+    """
+    def __init__(self, tar_path, max_gap=64 * 1024):
+        self.tar_path = tar_path
+        self.max_gap = max_gap
+        self.index = load_index(tar_path)
+        self.fd = os.open(tar_path, os.O_RDONLY)
+
+    def __contains__(self, name):
+        return _member_name(name) in self.index
+
+    def read(self, name):
+        offset, size = self.index[_member_name(name)]
+        return os.pread(self.fd, size, offset)
+
+    def read_batch(self, names):
+        """
+            read members in one pass sorted by offset
+
+            Return:
+                list of bytes in the order of names, None for members that are not in the tar file
+        """
+        entries = []
+        for i, name in enumerate(names):
+            entry = self.index.get(_member_name(name))
+            if entry is not None:
+                entries.append((entry[0], entry[1], i))
+        entries.sort()
+
+        outputs = [None] * len(names)
+        start = 0
+        while start < len(entries):
+            # merge members separated by less than max_gap bytes (tar headers, skipped frames) into one read
+            end = start + 1
+            while end < len(entries) and entries[end][0] - (entries[end - 1][0] + entries[end - 1][1]) <= self.max_gap:
+                end += 1
+
+            base = entries[start][0]
+            length = max(offset + size for offset, size, _ in entries[start:end]) - base
+            buffer = memoryview(os.pread(self.fd, length, base))
+            for offset, size, i in entries[start:end]:
+                outputs[i] = bytes(buffer[offset - base: offset - base + size])
+            start = end
+
+        return outputs
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def build_sidecar(tar_path):
+    try:
+        if read_index(tar_path) is not None:
+            return "exist"
+        save_index(tar_path, index_tarfile(tar_path))
+        return "success"
+    except Exception as e:
+        return f"{tar_path}: {e}"
+
+
+def main():
+    parser = argparse.ArgumentParser("build member index sidecars of tar files")
+    parser.add_argument("paths", nargs="+", help="tar files or directories searched recursively for tar files")
+    parser.add_argument("--nprocess", type=int, default=8, help="Total number of processes used")
+    args = parser.parse_args()
+
+    tar_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                tar_paths.extend(os.path.join(root, f) for f in files if f.endswith(".tar"))
+        else:
+            tar_paths.append(path)
+
+    states = {"success": 0, "exist": 0}
+    with mlp.Pool(args.nprocess) as pool:
+        for state in tqdm(pool.imap_unordered(build_sidecar, tar_paths), total=len(tar_paths)):
+            if state in states:
+                states[state] += 1
+            else:
+                tqdm.write(state)
+
+    print(f"indexed {states['success']} tar files, {states['exist']} up to date, "
+          f"{len(tar_paths) - states['success'] - states['exist']} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import io
 import os
 import math
+import contextlib
 import time
 import json
 from collections import defaultdict, deque, OrderedDict
@@ -12,13 +13,15 @@ from pathlib import Path
 import subprocess
 import torch
 import torch.distributed as dist
-from torch._six import inf
+from math import inf
 import random
 
 from timm.data.mixup import Mixup, mixup_target
 
 from tensorboardX import SummaryWriter
 
+from fast_init import load_checkpoint
+
 
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
@@ -85,6 +88,9 @@ class SmoothedValue(object):
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
+        # seconds spent in each stage of the iterations, see span()
+        self.spans = OrderedDict()
+        self._pending_spans = deque()
         self.delimiter = delimiter
 
     def update(self, **kwargs):
@@ -115,10 +121,100 @@ class MetricLogger(object):
     def synchronize_between_processes(self):
         for meter in self.meters.values():
             meter.synchronize_between_processes()
+        self.resolve_spans(block=True)
+        for meter in self.spans.values():
+            meter.synchronize_between_processes()
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
+    @contextlib.contextmanager
+    def span(self, name, cuda=None):
+        """
+            time the enclosed block as stage `name` of the current iteration, e.g.
+
+                with metric_logger.span("fwd"):
+                    outputs = model(videos, mask)
+
+            On gpu the block is timed by cuda events on the current stream. They are read once the gpu has
+            passed them (see resolve_spans), so timing does not synchronize the host with the gpu.
+            Otherwise (or with cuda=False, for host-only stages) it is timed by time.perf_counter.
+
+            Parameters:
+                name: str, name of the stage, a stage entered several times per iteration is summed
+                cuda: bool, time with cuda events, torch.cuda.is_available() if None
+        """
+        if cuda is None:
+            cuda = torch.cuda.is_available()
+
+        if cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self._pending_spans.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.update_spans(**{name: time.perf_counter() - start})
+
+    def update_spans(self, **kwargs):
+        """ add times in seconds to stages, e.g. the timings reported by dataloader workers """
+        for k, v in kwargs.items():
+            if isinstance(v, torch.Tensor):
+                v = v.item()
+            if k not in self.spans:
+                self.spans[k] = SmoothedValue(fmt="{avg:.4f}")
+            self.spans[k].update(v)
+
+    def resolve_spans(self, block=False):
+        """ read the cuda events of the spans the gpu has passed, or of all spans if block """
+        while self._pending_spans:
+            name, start, end = self._pending_spans[0]
+            if block:
+                end.synchronize()
+            elif not end.query():
+                # events of one stream complete in order
+                break
+            self._pending_spans.popleft()
+            self.update_spans(**{name: start.elapsed_time(end) / 1000})
+
+    def span_summary(self, log_writer=None, prefix="time_"):
+        """
+            print the milliseconds per iteration of every stage (see span()) and their share of the iteration
+            time, the time of stages reported by dataloader workers (worker_*) is summed over the samples of
+            a batch and runs in parallel to the iterations
+
+            Parameters:
+                log_writer: TensorboardLogger, the stages are written to the "time" head if given
+
+            Return:
+                stats: dict, {prefix + stage: milliseconds per iteration}
+        """
+        self.resolve_spans(block=True)
+        if "iter" not in self.spans or self.spans["iter"].count == 0:
+            return {}
+
+        num_iters = self.spans["iter"].count
+        stats = OrderedDict((name, meter.total / num_iters * 1000) for name, meter in self.spans.items())
+        iter_ms = stats["iter"]
+        other_ms = iter_ms - sum(ms for name, ms in stats.items() if name != "iter" and not name.startswith("worker_"))
+
+        rows = [(name, ms) for name, ms in stats.items() if name != "iter"] + [("other", other_ms), ("iter", iter_ms)]
+        lines = ["{:<16}{:>12}{:>12}".format("stage", "ms / iter", "% of iter")]
+        for name, ms in rows:
+            lines.append("{:<16}{:>12.2f}{:>11.1f}%".format(name, ms, ms / iter_ms * 100 if iter_ms > 0 else 0.))
+        print("\n".join(lines))
+
+        if log_writer is not None:
+            log_writer.update(head="time", **{f"{name}_ms": ms for name, ms in rows})
+
+        return {prefix + name: ms for name, ms in stats.items()}
+
     def log_every(self, iterable, print_freq, header=None):
         i = 0
         if not header:
@@ -142,8 +238,12 @@ class MetricLogger(object):
         MB = 1024.0 * 1024.0
         for obj in iterable:
             data_time.update(time.time() - end)
+            # time waiting for the dataloader, the data stall of the iteration
+            self.update_spans(data=data_time.value)
             yield obj
             iter_time.update(time.time() - end)
+            self.update_spans(iter=iter_time.value)
+            self.resolve_spans()
             if i % print_freq == 0 or i == len(iterable) - 1:
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
@@ -342,40 +442,59 @@ def load_state_dict(model, state_dict, prefix='', ignore_missing="relative_posit
         print('\n'.join(error_msgs))
 
 
+def no_sync_context(model, skip_sync):
+    """
+        context in which DistributedDataParallel does not all-reduce gradients,
+        used for the forward/backward of gradient accumulation steps
+
+        Parameters:
+            model: torch.nn.Module, DistributedDataParallel or not
+            skip_sync: bool, skip gradient synchronization (only effective for DistributedDataParallel)
+    """
+    if skip_sync and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
     def __init__(self):
         self._scaler = torch.cuda.amp.GradScaler()
 
-    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
-        self._scaler.scale(loss).backward(create_graph=create_graph)
+    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True,
+                 span=None):
+        # span: callable returning a context that times a stage, e.g. MetricLogger.span
+        span = span or (lambda name: contextlib.nullcontext())
+        with span("bwd"):
+            self._scaler.scale(loss).backward(create_graph=create_graph)
         if update_grad:
-            if clip_grad is not None:
-                assert parameters is not None
+            with span("opt"):
+                if clip_grad is not None:
+                    assert parameters is not None
 
-                if not isinstance(optimizer, list):
-                    self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
+                    if not isinstance(optimizer, list):
+                        self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
+                    else:
+                        for optim in optimizer:
+                            self._scaler.unscale_(optim)  # unscale the gradients of optimizer's assigned params in-place
+
+                    norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
                 else:
-                    for optim in optimizer:
-                        self._scaler.unscale_(optim)  # unscale the gradients of optimizer's assigned params in-place
+                    if not isinstance(optimizer, list):
+                        self._scaler.unscale_(optimizer)
+                    else:
+                        for optim in optimizer:
+                            self._scaler.unscale_(optim)
+
+                    norm = get_grad_norm_(parameters)
 
-                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
-            else:
                 if not isinstance(optimizer, list):
-                    self._scaler.unscale_(optimizer)
+                    self._scaler.step(optimizer)
                 else:
                     for optim in optimizer:
-                        self._scaler.unscale_(optim)
-
-                norm = get_grad_norm_(parameters)
-
-            if not isinstance(optimizer, list):
-                self._scaler.step(optimizer)
-            else:
-                for optim in optimizer:
-                    self._scaler.step(optim)
-            self._scaler.update()
+                        self._scaler.step(optim)
+                self._scaler.update()
 
         else:
             norm = None
@@ -479,7 +598,7 @@ def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, mode
                 checkpoint = torch.hub.load_state_dict_from_url(
                     args.resume, map_location='cpu', check_hash=True)
             else:
-                checkpoint = torch.load(args.resume, map_location='cpu')
+                checkpoint = load_checkpoint(args.resume)
             model_without_ddp.load_state_dict(checkpoint['model'])
             print("Resume checkpoint %s" % args.resume)
             if 'optimizer' in checkpoint and 'epoch' in checkpoint:
@@ -617,6 +736,48 @@ def samples_collate_fho(batch):
     return inputs, flows, target_lst
 
 
+def packed_samples_collate(batch):
+    """
+        Collate function for packed-sequence pretraining. Clips of different lengths
+        are concatenated along the temporal dimension (into shared memory in worker
+        processes, as default_collate does), flows are dropped.
+        Args:
+            batch (tuple or list): data batch of (frames, flows) or (frames, flows, metadata),
+                frames of shape C x T_i x H x W.
+        Returns:
+            videos (tensor): C x sum(T_i) x H x W.
+            num_frames (tensor): T_i of every clip.
+            metadata (dict): collated metadata of the clips, if given.
+    """
+    frames = [sample[0] for sample in batch]
+    num_frames = torch.tensor([clip.shape[1] for clip in frames])
+
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        elem = frames[0]
+        storage = elem._typed_storage()._new_shared(sum(x.numel() for x in frames), device=elem.device)
+        out = elem.new(storage).resize_(elem.shape[0], int(num_frames.sum()), *elem.shape[2:])
+
+    videos = torch.cat(frames, dim=1, out=out)
+    if len(batch[0]) > 2:
+        return videos, num_frames, default_collate([sample[2] for sample in batch])
+    return videos, num_frames
+
+
+def worker_timing(batch):
+    """
+        timings measured in dataloader workers, read from the "timing" dict of the metadata
+        collated as the last element of the batch (see Egoclip and Epickitchens)
+
+        Return:
+            dict, {"worker_" + stage: seconds spent on the samples of the batch}, empty if not reported
+    """
+    metadata = batch[-1] if isinstance(batch, (list, tuple)) and len(batch) > 0 else None
+    if not isinstance(metadata, dict) or "timing" not in metadata:
+        return {}
+    return {f"worker_{k}": float(torch.as_tensor(v, dtype=torch.float64).sum()) for k, v in metadata["timing"].items()}
+
+
 def filter_checkpoint_fho(checkpoint_model):
     all_keys = list(checkpoint_model.keys())
     new_dict = OrderedDict()